@@ -0,0 +1,324 @@
+#
+# This file provides the micro-benchmarks of the simulators and novelty search hot paths.
+# Each benchmark runs the kernel over fixed inputs generated with fixed seed and records
+# the number of operations per second along with percentiles of the mean operation duration
+# in timed samples.
+# The results can be stored as JSON and compared against previously stored baseline.
+#
+import os
+import sys
+import copy
+import time
+import json
+import platform
+import argparse
+from collections import namedtuple
+
+import numpy as np
+
+import pole.cart_pole as cart
+import pole.cart_two_pole as cart_two
+import maze.maze_environment as maze
+import maze.geometry as geometry
+import maze.novelty_archive as archive
+
+# The percentiles of the mean operation duration in timed samples to be recorded
+PERCENTILES = [50, 90, 99]
+
+# The number of distinct inputs each kernel cycles through
+N_INPUTS = 64
+
+# The minimal stand-in of genome used by the novelty archive
+Genome = namedtuple('Genome', ['key'])
+
+def bench_cart_pole_do_step(rng):
+    """
+    The single-pole cart state update for one cart.
+    """
+    states = [tuple(s) for s in rng.uniform(-0.1, 0.1, size=(N_INPUTS, 4))]
+    actions = rng.integers(0, 2, size=N_INPUTS).tolist()
+    inputs = list(zip(actions, states))
+
+    def op(i):
+        action, state = inputs[i % N_INPUTS]
+        cart.do_step(action, *state)
+    return op, 1
+
+def bench_cart_pole_do_step_batch(rng, batch_size=1000):
+    """
+    The single-pole carts state update for the batch of carts, one operation per cart.
+    """
+    states = rng.uniform(-0.1, 0.1, size=(batch_size, 4))
+    actions = rng.integers(0, 2, size=batch_size)
+
+    def op(i):
+        cart.do_step_batch(actions, states.copy())
+    return op, batch_size
+
+def bench_cart_two_pole_rk4(rng):
+    """
+    The Runge-Kutta integration step of the double-pole cart.
+    """
+    inputs = []
+    for state in rng.uniform(-0.05, 0.05, size=(N_INPUTS, 6)).tolist():
+        action = float(rng.integers(0, 2))
+        x_ddot, theta_1_ddot, theta_2_ddot = cart_two.calc_step(action, *state)
+        dydx = [state[1], x_ddot, state[3], theta_1_ddot, state[5], theta_2_ddot]
+        inputs.append((action, state, dydx))
+
+    def op(i):
+        action, state, dydx = inputs[i % N_INPUTS]
+        cart_two.rk4(action, list(state), dydx, 0.01)
+    return op, 1
+
+def bench_maze_rangefinder_sensors(rng, maze_file='medium_maze.txt'):
+    """
+    The range finder sensors update of the maze agent.
+    """
+    local_dir = os.path.dirname(os.path.abspath(__file__))
+    env = maze.read_environment(os.path.join(local_dir, 'maze', maze_file))
+    xs = [w.a.x for w in env.walls] + [w.b.x for w in env.walls]
+    ys = [w.a.y for w in env.walls] + [w.b.y for w in env.walls]
+    locations = [geometry.Point(x, y) for x, y in zip(rng.uniform(min(xs), max(xs), size=N_INPUTS).tolist(),
+                                                        rng.uniform(min(ys), max(ys), size=N_INPUTS).tolist())]
+    headings = rng.uniform(0, 360, size=N_INPUTS).tolist()
+
+    def op(i):
+        env.agent.location = locations[i % N_INPUTS]
+        env.agent.heading = headings[i % N_INPUTS]
+        env.update_rangefinder_sensors()
+    return op, 1
+
+def bench_line_intersection(rng):
+    """
+    The intersection test of two line segments.
+    """
+    points = rng.uniform(0, 300, size=(N_INPUTS, 2, 4)).tolist()
+    lines = [(geometry.Line(geometry.Point(a[0], a[1]), geometry.Point(a[2], a[3])),
+                geometry.Line(geometry.Point(b[0], b[1]), geometry.Point(b[2], b[3]))) for a, b in points]
+
+    def op(i):
+        first, second = lines[i % N_INPUTS]
+        first.intersection(second)
+    return op, 1
+
+def _novelty_items(rng, n_items, data_size=22):
+    """
+    The function to create novelty items with random data vectors similar to
+    the agent path points collected in the maze experiment.
+    """
+    items = []
+    for i, data in enumerate(rng.uniform(0, 300, size=(n_items, data_size)).tolist()):
+        item = archive.NoveltyItem(generation=0, genomeId=i)
+        item.data = data
+        items.append(item)
+    return items
+
+def bench_novelty_avg_knn(rng, archive_size=1000):
+    """
+    The novelty score of one item against the archive of novel items.
+    """
+    novelty_archive = archive.NoveltyArchive(threshold=6.0, metric=maze.maze_novelty_metric)
+    novelty_archive.novel_items = _novelty_items(rng, archive_size)
+    items = _novelty_items(rng, N_INPUTS)
+
+    def op(i):
+        novelty_archive._novelty_avg_knn(item=items[i % N_INPUTS], n_items_map=None)
+    return op, 1
+
+def bench_knn_average_distance(rng, archive_size=1000, population_size=250):
+    """
+    The novelty scores of population against the archive of novel items
+    calculated at once, one operation per item of population.
+    """
+    data = np.array([item.data for item in _novelty_items(rng, population_size)])
+    other_data = np.array([item.data for item in _novelty_items(rng, archive_size)])
+
+    def op(i):
+        archive.knn_average_distance(data, other_data, archive.KNNNoveltyScore,
+                                    maze.maze_novelty_metric_euclidean_batch)
+    return op, population_size
+
+def bench_update_fittest_with_genome(rng, fittest_size=1000):
+    """
+    The update of the full collection of NoveltyItems of the fittest genomes with
+    the item of one genome. Each operation pushes the fresh item into the collection
+    reset to the same initial items before each sample. Every other fresh item is fitter
+    than all items held and replaces the least fit one, while the rest are rejected, so
+    the cost of operation doesn't depend on the number of calls per sample.
+    """
+    initial = _novelty_items(rng, fittest_size)
+    for item, fitness in zip(initial, rng.uniform(0, 1, size=fittest_size).tolist()):
+        item.fitness = fitness
+    fittest = archive.FittestItems(capacity=fittest_size)
+    for item in initial:
+        fittest.push(item)
+    novelty_archive = archive.NoveltyArchive(threshold=6.0, metric=maze.maze_novelty_metric,
+                                            fittest_size=fittest_size)
+    inputs = {}
+
+    def reset(calls):
+        novelty_archive.fittest_items = copy.deepcopy(fittest)
+        items = [archive.NoveltyItem(generation=1, genomeId=fittest_size + i, fitness=1.0 + i if i % 2 == 0 else -1.0)
+                    for i in range(calls)]
+        inputs['n_items_map'] = dict((item.genomeId, item) for item in items)
+        inputs['genomes'] = [Genome(key=item.genomeId) for item in items]
+
+    def op(i):
+        novelty_archive.update_fittest_with_genome(genome=inputs['genomes'][i], n_items_map=inputs['n_items_map'])
+    return op, 1, reset
+
+# The benchmarks by name
+BENCHMARKS = {
+    'cart_pole.do_step':                    bench_cart_pole_do_step,
+    'cart_pole.do_step_batch':              bench_cart_pole_do_step_batch,
+    'cart_two_pole.rk4':                    bench_cart_two_pole_rk4,
+    'MazeEnvironment.update_rangefinder_sensors': bench_maze_rangefinder_sensors,
+    'Line.intersection':                    bench_line_intersection,
+    'NoveltyArchive._novelty_avg_knn':      bench_novelty_avg_knn,
+    'novelty_archive.knn_average_distance': bench_knn_average_distance,
+    'NoveltyArchive.update_fittest_with_genome': bench_update_fittest_with_genome,
+}
+
+def run_benchmark(setup, seed, samples=30, min_time=0.01):
+    """
+    The function to run one benchmark. The number of kernel calls per sample is calibrated
+    to make each sample last at least min_time seconds. The single calls are not timed, thus
+    the percentiles are of the mean operation duration in samples rather than of the single
+    operation duration.
+    Arguments:
+        setup:      The function to create the kernel operation over fixed inputs. It returns
+                    the tuple (op, ops_per_call) or (op, ops_per_call, reset), where reset(calls)
+                    is called before each sample outside of the timed loop to prepare fresh
+                    inputs of the given number of calls for the kernel changing its state.
+        seed:       The seed of random numbers generator used to create inputs.
+        samples:    The number of timed samples.
+        min_time:   The minimal duration of one sample in seconds.
+    Returns:
+        The dictionary with benchmark results.
+    """
+    bench = setup(np.random.default_rng(seed))
+    op, ops_per_call = bench[:2]
+    reset = bench[2] if len(bench) > 2 else None
+
+    # calibrate the number of calls per sample
+    calls = 1
+    while True:
+        if reset is not None:
+            reset(calls)
+        start_time = time.perf_counter()
+        for i in range(calls):
+            op(i)
+        duration = time.perf_counter() - start_time
+        if duration >= min_time:
+            break
+        calls *= 2
+
+    # collect samples with the duration of one operation
+    durations = np.zeros(samples)
+    for s in range(samples):
+        if reset is not None:
+            reset(calls)
+        start_time = time.perf_counter()
+        for i in range(calls):
+            op(i)
+        durations[s] = (time.perf_counter() - start_time) / (calls * ops_per_call)
+
+    results = {
+        'ops_per_sec':  1.0 / np.median(durations),
+        'mean_us':      np.mean(durations) * 1e6,
+        'sample_std_us': np.std(durations) * 1e6,
+        'samples':      samples,
+        'calls':        calls,
+        'ops_per_call': ops_per_call,
+    }
+    for p in PERCENTILES:
+        results['sample_p%d_us' % p] = np.percentile(durations, p) * 1e6
+    return dict((key, float(value)) for key, value in results.items())
+
+def compare_with_baseline(results, baseline, tolerance):
+    """
+    The function to compare benchmarks results against the baseline.
+    Arguments:
+        results:    The dictionary with benchmarks results by name.
+        baseline:   The dictionary with baseline benchmarks results by name.
+        tolerance:  The allowed relative decrease of operations per second.
+    Returns:
+        The list of names of regressed benchmarks.
+    """
+    regressions = []
+    print("\n%-45s %14s %14s %9s" % ("Benchmark", "ops/sec", "baseline", "change"))
+    for name, result in results.items():
+        if name not in baseline:
+            print("%-45s %14.1f %14s %9s" % (name, result['ops_per_sec'], "-", "-"))
+            continue
+        base_ops = baseline[name]['ops_per_sec']
+        change = result['ops_per_sec'] / base_ops - 1.0
+        regressed = change < -tolerance
+        if regressed:
+            regressions.append(name)
+        print("%-45s %14.1f %14.1f %+8.1f%%%s" %
+                (name, result['ops_per_sec'], base_ops, change * 100.0, " REGRESSION" if regressed else ""))
+    return regressions
+
+def print_results(results):
+    """
+    The function to print benchmarks results as easy to read formatted text.
+    Arguments:
+        results: The dictionary with benchmarks results by name.
+    """
+    print("The percentiles are of the mean operation duration in timed samples")
+    print("%-45s %14s %10s %10s %10s" % ("Benchmark", "ops/sec", "p50 us", "p90 us", "p99 us"))
+    for name, result in results.items():
+        print("%-45s %14.1f %10.3f %10.3f %10.3f" %
+                (name, result['ops_per_sec'], result['sample_p50_us'], result['sample_p90_us'], 
+                result['sample_p99_us']))
+
+if __name__ == '__main__':
+    # read command line parameters
+    parser = argparse.ArgumentParser(description="The micro-benchmarks of simulators and novelty search kernels.")
+    parser.add_argument('-b', '--benchmarks', nargs='*', default=None,
+                        help="The names of benchmarks to run (default - all): %s" % ", ".join(BENCHMARKS))
+    parser.add_argument('-n', '--samples', type=int, default=30,
+                        help="The number of timed samples of each benchmark.")
+    parser.add_argument('--min_time', type=float, default=0.01,
+                        help="The minimal duration of one sample in seconds.")
+    parser.add_argument('--seed', type=int, default=42,
+                        help="The seed of random numbers generator used to create benchmarks inputs.")
+    parser.add_argument('-o', '--output', default=None,
+                        help="The path to the JSON file to store results, which can be used as a baseline later.")
+    parser.add_argument('--baseline', default=None,
+                        help="The path to the JSON file with baseline results to compare against.")
+    parser.add_argument('--tolerance', type=float, default=0.1,
+                        help="The allowed relative decrease of operations per second before reporting regression.")
+    args = parser.parse_args()
+
+    names = args.benchmarks if args.benchmarks else list(BENCHMARKS)
+    for name in names:
+        if name not in BENCHMARKS:
+            parser.error("Unknown benchmark: %s" % name)
+
+    results = {}
+    for name in names:
+        results[name] = run_benchmark(BENCHMARKS[name], seed=args.seed, samples=args.samples, min_time=args.min_time)
+    print_results(results)
+
+    if args.output is not None:
+        report = {
+            'seed':         args.seed,
+            'python':       platform.python_version(),
+            'numpy':        np.__version__,
+            'platform':     platform.platform(),
+            'timestamp':    time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'benchmarks':   results,
+        }
+        with open(args.output, 'w') as file:
+            json.dump(report, file, indent=2)
+
+    if args.baseline is not None:
+        with open(args.baseline, 'r') as file:
+            baseline = json.load(file)['benchmarks']
+        regressions = compare_with_baseline(results, baseline, args.tolerance)
+        if regressions:
+            print("\nRegressions found: %s" % ", ".join(regressions))
+            sys.exit(1)
@@ -1,6 +1,17 @@
 import os
+import sys
+import csv
 import time
+import json
 import math
+import pickle
+import hashlib
+import importlib
+import tracemalloc
+
+from collections import OrderedDict
+from contextlib import contextmanager
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
 
 import numpy as np
 
@@ -17,6 +28,195 @@ class ANNWrapper:
         self.net.Activate()
         return self.net.Output()
 
+class GenomeListEvaluator:
+    """
+    The evaluator of the list of genomes. The list is split into chunks, which are
+    evaluated by the pool of workers started once and reused by all evaluations until
+    the evaluator closed. The workers are either processes or threads (for evaluation
+    routines releasing the GIL). With serial backend or one worker the list is 
+    evaluated in the current thread. For the pool of processes the time spent on
+    genomes pickling and unpickling is accumulated.
+    """
+    def __init__(self, evaluate_batch, workers=1, chunk_size=None, initializer=None, initargs=(), backend='process', 
+                cache=None, timer=None):
+        """
+        Creates new evaluator.
+        Arguments:
+            evaluate_batch: The function to evaluate the list of genomes returning the list
+                            of results in order of genomes. It must be defined at the module 
+                            level to be passed to the worker processes.
+            workers:        The number of workers.
+            chunk_size:     The number of genomes in one chunk or None to split the list
+                            evenly between workers.
+            initializer:    The function to initialize each worker.
+            initargs:       The arguments of the initializer.
+            backend:        The type of workers pool: 'process', 'thread', or 'serial'.
+            cache:          The FitnessCache to look up results of structurally identical
+                            genomes evaluated before or None to evaluate all genomes.
+            timer:          The PhaseTimer to collect counts reported by workers into or None.
+                            If provided, the evaluate_batch function receives the PhaseTimer
+                            of the worker as keyword argument timer.
+        """
+        self.evaluate_batch = evaluate_batch
+        self.cache = cache
+        self.timer = timer
+        self.workers = workers
+        self.chunk_size = chunk_size
+        self.backend = backend if workers > 1 else 'serial'
+        self.executor = None
+        if self.backend == 'process':
+            self.executor = ProcessPoolExecutor(max_workers=workers, 
+                                                initializer=initializer, 
+                                                initargs=initargs)
+        elif self.backend == 'thread':
+            self.executor = ThreadPoolExecutor(max_workers=workers, 
+                                                initializer=initializer, 
+                                                initargs=initargs)
+        elif self.backend == 'serial':
+            if initializer is not None:
+                initializer(*initargs)
+        else:
+            raise ValueError("Unsupported evaluator backend: %s" % backend)
+
+        # The evaluation statistics
+        self.evaluations = 0
+        self.evaluation_time = 0.0
+        self.pickled_bytes = 0
+        self.pickling_time = 0.0
+        self.unpickling_time = 0.0
+
+    def evaluate(self, genome_list, *args):
+        """
+        The function to evaluate provided list of genomes.
+        Arguments:
+            genome_list:    The list of genomes to evaluate.
+            args:           The additional arguments to be passed to the evaluate_batch function.
+        Returns:
+            The list of evaluation results in order of genome_list.
+        """
+        start_time = time.time()
+        if self.cache is None:
+            results = self._evaluate(genome_list, *args)
+        else:
+            results = self.cache.evaluate(genome_list, self._evaluate, *args)
+
+        self.evaluations += 1
+        self.evaluation_time += time.time() - start_time
+        return results
+
+    def _evaluate(self, genome_list, *args):
+        """
+        The function to evaluate provided list of genomes by workers.
+        Arguments:
+            genome_list:    The list of genomes to evaluate.
+            args:           The additional arguments to be passed to the evaluate_batch function.
+        Returns:
+            The list of evaluation results in order of genome_list.
+        """
+        if self.executor is None:
+            if self.timer is None:
+                results = list(self.evaluate_batch(genome_list, *args))
+            else:
+                results = list(self.evaluate_batch(genome_list, *args, timer=self.timer))
+        else:
+            chunk_size = self.chunk_size
+            if chunk_size is None:
+                chunk_size = max(1, int(math.ceil(len(genome_list) / float(self.workers))))
+            chunks = [genome_list[i:i + chunk_size] for i in range(0, len(genome_list), chunk_size)]
+            chunk_args = [[self.timer is not None] * len(chunks)] + [[arg] * len(chunks) for arg in args]
+            results = []
+            if self.backend == 'process':
+                # pickle genomes explicitly to measure the overhead
+                pickling_start = time.time()
+                chunks = [pickle.dumps(chunk, pickle.HIGHEST_PROTOCOL) for chunk in chunks]
+                self.pickling_time += time.time() - pickling_start
+                self.pickled_bytes += sum(len(chunk) for chunk in chunks)
+                batch_args = [[self.evaluate_batch] * len(chunks), chunks] + chunk_args
+                # the map preserves order of chunks
+                for chunk_results, chunk_timer, unpickling_time in self.executor.map(_evaluate_pickled, *batch_args):
+                    self.unpickling_time += unpickling_time
+                    self._merge(chunk_timer)
+                    results.extend(chunk_results)
+            else:
+                batch_args = [[self.evaluate_batch] * len(chunks), chunks] + chunk_args
+                for chunk_results, chunk_timer in self.executor.map(_evaluate_chunk, *batch_args):
+                    self._merge(chunk_timer)
+                    results.extend(chunk_results)
+        return results
+
+    def _merge(self, chunk_timer):
+        """
+        The function to merge counts reported by the worker into the evaluator timer.
+        Arguments:
+            chunk_timer: The PhaseTimer of the worker or None.
+        """
+        if chunk_timer is not None:
+            self.timer.merge(chunk_timer)
+
+    def print_statistics(self):
+        """
+        Prints the evaluation statistics including genomes pickling overhead.
+        """
+        print("Evaluator: %s, workers: %d, evaluations: %d, evaluation time: %.3f sec" % 
+                (self.backend, self.workers, self.evaluations, self.evaluation_time))
+        if self.backend == 'process' and self.evaluation_time > 0:
+            overhead = self.pickling_time + self.unpickling_time
+            print("\tpickled: %.1f KB, pickling: %.3f sec, unpickling: %.3f sec (%.1f%% of evaluation time)" % 
+                    (self.pickled_bytes / 1024.0, self.pickling_time, self.unpickling_time, 
+                    overhead / self.evaluation_time * 100.0))
+        if self.cache is not None:
+            self.cache.print_statistics()
+
+    def close(self):
+        """
+        The function to stop workers if any.
+        """
+        if self.executor is not None:
+            self.executor.shutdown()
+            self.executor = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+def _evaluate_chunk(evaluate_batch, genome_list, timed, *args):
+    """
+    The function to evaluate the chunk of genomes list in the worker.
+    Arguments:
+        evaluate_batch: The function to evaluate the list of genomes.
+        genome_list:    The list of genomes.
+        timed:          The flag to control whether evaluate_batch receives the PhaseTimer
+                        to report counts into.
+        args:           The additional arguments of the evaluate_batch function.
+    Returns:
+        The tuple with list of evaluation results and the PhaseTimer of the worker or None.
+    """
+    if not timed:
+        return list(evaluate_batch(genome_list, *args)), None
+    timer = PhaseTimer()
+    return list(evaluate_batch(genome_list, *args, timer=timer)), timer
+
+def _evaluate_pickled(evaluate_batch, data, timed, *args):
+    """
+    The function to evaluate pickled list of genomes in the worker process.
+    Arguments:
+        evaluate_batch: The function to evaluate the list of genomes.
+        data:           The pickled list of genomes.
+        timed:          The flag to control whether evaluate_batch receives the PhaseTimer
+                        to report counts into.
+        args:           The additional arguments of the evaluate_batch function.
+    Returns:
+        The tuple with list of evaluation results, the PhaseTimer of the worker or None, 
+        and the time spent on unpickling.
+    """
+    start_time = time.time()
+    genome_list = pickle.loads(data)
+    unpickling_time = time.time() - start_time
+    results, timer = _evaluate_chunk(evaluate_batch, genome_list, timed, *args)
+    return results, timer, unpickling_time
+
 class ExperimentEvaluationResults:
     """
     The class to hold experiment evaluation results
@@ -29,14 +229,31 @@ class ExperimentEvaluationResults:
         self.fitness = np.zeros(n_trials)
         self.trial_durations = np.zeros(n_trials)
         self.avg_epoch_durations = np.zeros(n_trials)
+        # The phases durations and counts of each trial as collected by PhaseTimer
+        self.phases = [None] * n_trials
+        # The CPU time (ms) of the process running each trial and its terminated children
+        self.cpu_times = np.zeros(n_trials)
+        self.avg_epoch_cpu_times = np.zeros(n_trials)
+        # The peak resident set size (MB) of the process running each trial since the start of
+        # the process, i.e., the running maximum over trials executed by the same process before
+        self.peak_rss = np.zeros(n_trials)
+        # The peak size (MB) of memory blocks traced by tracemalloc or NaN if not traced
+        self.peak_traced_memory = np.full(n_trials, np.nan)
+        # The flag to indicate whether the efficiency score is based on CPU time
+        self.cpu_time_score = False
         self.elapsed_time = 0
         self.success_run = 0
         self.success_rate = 0
         self.efficiency_score = 0
+        self.seed = None
 
-    def calculate_statistics(self, max_fitness):
+    def calculate_statistics(self, max_fitness, cpu_time_score=False):
         """
         The function to calculate the agregate statistics over collected experiment reults.
+        Arguments:
+            max_fitness:    The maximal fitness score value for experiment or -1 if not defined.
+            cpu_time_score: The flag to indicate whether the efficiency score should be based on the CPU
+                            time per epoch rather than on the wall-clock time per epoch.
         """
         self.success_run = np.count_nonzero(self.results)
         self.success_rate = float(self.success_run) / float(self.n_trials)
@@ -44,6 +261,12 @@ class ExperimentEvaluationResults:
         # Build averages
         self.avg_trial_duration = np.average(self.trial_durations)
         self.avg_epoch_duration = np.average(self.avg_epoch_durations)
+        self.avg_cpu_time = np.average(self.cpu_times)
+        self.avg_epoch_cpu_time = np.average(self.avg_epoch_cpu_times)
+        self.max_peak_rss = np.max(self.peak_rss)
+        self.max_peak_traced_memory = np.nan
+        if not np.isnan(self.peak_traced_memory).all():
+            self.max_peak_traced_memory = np.nanmax(self.peak_traced_memory)
         self.avg_trial_generations = np.average(self.generations)
 
         self.avg_complexity = np.average(self.complexity)
@@ -53,16 +276,31 @@ class ExperimentEvaluationResults:
         self.avg_winner_fitness = np.average(self.fitness[self.results])
         self.avg_winner_trial_generations = np.average(self.generations[self.results])
 
+        # The phases durations and counts averaged over trials
+        self.avg_phase_durations = OrderedDict()
+        self.avg_phase_counts = OrderedDict()
+        for phases in self.phases:
+            if phases is None:
+                continue
+            for name, duration in phases['durations'].items():
+                self.avg_phase_durations[name] = self.avg_phase_durations.get(name, 0.0) + duration / self.n_trials
+            for name, value in phases['counts'].items():
+                self.avg_phase_counts[name] = self.avg_phase_counts.get(name, 0.0) + value / float(self.n_trials)
+
         # Find solution's efficiency score
         # We are interested in efficient solver search solution that take 
         # less time per epoch, less generations per trial, and produce less complicated winner genomes.
+        # The time spent on output of results is not included into the epoch duration.
         # At the same time it should have maximal fitness score and maximal success rate among trials.
         fitness_score = self.avg_winner_fitness
         if max_fitness > 0:
             fitness_score /= max_fitness
             fitness_score *= 100
 
-        self.efficiency_score = self.avg_epoch_duration * self.avg_trial_generations * self.avg_winner_complexity
+        # The CPU time is not affected by the machine load and by trials running in parallel.
+        self.cpu_time_score = cpu_time_score
+        epoch_duration = self.avg_epoch_cpu_time if cpu_time_score else self.avg_epoch_duration
+        self.efficiency_score = epoch_duration * self.avg_trial_generations * self.avg_winner_complexity
         if self.efficiency_score > 0:
             self.efficiency_score = self.success_rate * fitness_score / math.log(self.efficiency_score)
 
@@ -73,46 +311,829 @@ class ExperimentEvaluationResults:
         print("\nSolved %d trials from %d, success rate: %f" % (self.success_run, self.n_trials, self.success_rate))
         print("Average\n\ttrial duration:\t\t%f ms\n\tepoch duration:\t\t%f ms\n\tgenerations/trial:\t%.1f\n" %
             (self.avg_trial_duration, self.avg_epoch_duration, self.avg_trial_generations))
+        print("Average CPU time\n\ttrial:\t\t\t%f ms\n\tepoch:\t\t\t%f ms\n" % (self.avg_cpu_time, self.avg_epoch_cpu_time))
+        print("Maximal memory usage\n\tpeak RSS:\t\t%.1f MB" % self.max_peak_rss)
+        if not np.isnan(self.max_peak_traced_memory):
+            print("\ttraced peak:\t\t%.1f MB" % self.max_peak_traced_memory)
+        print("")
         print("Average among winners\n\tComplexity:\t\t%f\n\tFitness:\t\t%f\n\tgenerations/trial:\t%.1f\n" % 
             (self.avg_winner_complexity, self.avg_winner_fitness, self.avg_winner_trial_generations))
         print("Average for all organisms evaluated during experiment\n\tComplexity:\t\t%f\n\tFitness:\t\t%f\n" %
             (self.avg_complexity, self.avg_fitness))
-        print("Efficiency score:\t\t%f\n" % self.efficiency_score)
+        if len(self.avg_phase_durations) > 0 or len(self.avg_phase_counts) > 0:
+            print("Average phases per trial")
+            for name, duration in self.avg_phase_durations.items():
+                print("\t%s:\t\t%f ms" % (name, duration))
+            for name, value in self.avg_phase_counts.items():
+                print("\t%s:\t\t%.1f" % (name, value))
+            print("")
+        print("Efficiency score:\t\t%f%s\n" % (self.efficiency_score, " (CPU time)" if self.cpu_time_score else ""))
         print("Experiment's elapsed time:\t%.3f sec\n" % (self.elapsed_time))
 
+    def trial_rows(self):
+        """
+        The function to create the list of rows with results of each trial.
+        Returns:
+            The list of dictionaries with results, phases durations (ms) and counts of each trial.
+        """
+        rows = []
+        for i in range(self.n_trials):
+            row = OrderedDict([
+                ('trial', i),
+                ('solved', bool(self.results[i])),
+                ('generations', int(self.generations[i])),
+                ('complexity', float(self.complexity[i])),
+                ('fitness', float(self.fitness[i])),
+                ('duration_ms', float(self.trial_durations[i])),
+                ('epoch_duration_ms', float(self.avg_epoch_durations[i])),
+                ('cpu_time_ms', float(self.cpu_times[i])),
+                ('epoch_cpu_time_ms', float(self.avg_epoch_cpu_times[i])),
+                ('running_peak_rss_mb', float(self.peak_rss[i])),
+            ])
+            if not np.isnan(self.peak_traced_memory[i]):
+                row['peak_traced_memory_mb'] = float(self.peak_traced_memory[i])
+            if self.phases[i] is not None:
+                for name, duration in self.phases[i]['durations'].items():
+                    row['%s_ms' % name] = duration
+                for name, value in self.phases[i]['counts'].items():
+                    row[name] = value
+            rows.append(row)
+        return rows
+
+    def write_json(self, path):
+        """
+        The function to write results of each trial along with phases durations and counts
+        of each generation into the JSON file.
+        Arguments:
+            path: The path to the output file.
+        """
+        data = {
+            'seed':                 self.seed,
+            'elapsed_time':         self.elapsed_time,
+            'success_rate':         self.success_rate,
+            'efficiency_score':     self.efficiency_score,
+            'cpu_time_score':       self.cpu_time_score,
+            'avg_phase_durations':  dict(self.avg_phase_durations),
+            'avg_phase_counts':     dict(self.avg_phase_counts),
+            'trials':               self.trial_rows(),
+        }
+        for row, phases in zip(data['trials'], self.phases):
+            row['phase_generations'] = phases['generations'] if phases is not None else []
+        with open(path, 'w') as file:
+            json.dump(data, file, indent=2)
+
+    def write_csv(self, path):
+        """
+        The function to write results of each trial along with phases durations and counts
+        into the CSV file with one row per trial.
+        Arguments:
+            path: The path to the output file.
+        """
+        rows = self.trial_rows()
+        fields = []
+        for row in rows:
+            fields.extend(key for key in row if key not in fields)
+        with open(path, 'w', newline='') as file:
+            writer = csv.DictWriter(file, fieldnames=fields, restval=0)
+            writer.writeheader()
+            writer.writerows(rows)
+
+class FitnessCache:
+    """
+    The bounded store of fitness scores keyed by the structural hash of genomes. 
+    The genomes carried over unchanged between generations (elites) or cloned
+    within generation have the same hash and evaluated only once. The least
+    recently used scores are evicted when the store is full. The cache must be
+    used only with deterministic evaluations, i.e., when the fitness score depends
+    only on the genome structure. For stochastic evaluations it is disabled and
+    all genomes are passed to the evaluation function.
+    """
+    def __init__(self, genome_hash, max_size=10000, deterministic=True):
+        """
+        Creates new cache.
+        Arguments:
+            genome_hash:    The function to calculate structural hash of genome.
+            max_size:       The maximal number of stored fitness scores, zero disables the cache.
+            deterministic:  The flag to indicate whether evaluation is deterministic. 
+                            If False the cache is disabled.
+        """
+        self.genome_hash = genome_hash
+        self.max_size = max_size
+        self.enabled = deterministic and max_size > 0
+        self.store = OrderedDict()
+        # The lookup statistics
+        self.hits = 0
+        self.misses = 0
+
+    def evaluate(self, genome_list, evaluate_batch, *args):
+        """
+        The function to evaluate provided list of genomes, evaluating only those 
+        not found in the cache. Structurally identical genomes in the list are 
+        evaluated once.
+        Arguments:
+            genome_list:    The list of genomes to evaluate.
+            evaluate_batch: The function to evaluate the list of genomes returning the list
+                            of results in order of genomes.
+            args:           The additional arguments to be passed to the evaluate_batch function.
+        Returns:
+            The list of evaluation results in order of genome_list.
+        """
+        if not self.enabled:
+            return list(evaluate_batch(genome_list, *args))
+
+        keys = [self.genome_hash(genome) for genome in genome_list]
+        results = [None] * len(genome_list)
+        # The indices of genomes to evaluate by the key
+        missed = OrderedDict()
+        for i, key in enumerate(keys):
+            if key in self.store:
+                self.store.move_to_end(key)
+                results[i] = self.store[key]
+                self.hits += 1
+            elif key in missed:
+                missed[key].append(i)
+                self.hits += 1
+            else:
+                missed[key] = [i]
+                self.misses += 1
+
+        if len(missed) > 0:
+            missed_genomes = [genome_list[indices[0]] for indices in missed.values()]
+            missed_results = evaluate_batch(missed_genomes, *args)
+            for (key, indices), result in zip(missed.items(), missed_results):
+                for i in indices:
+                    results[i] = result
+                self.store[key] = result
+                if len(self.store) > self.max_size:
+                    self.store.popitem(last=False)
+
+        return results
+
+    def print_statistics(self):
+        """
+        Prints the cache lookup statistics.
+        """
+        if not self.enabled:
+            print("Fitness cache: disabled")
+            return
+        lookups = self.hits + self.misses
+        hit_rate = float(self.hits) / lookups * 100.0 if lookups > 0 else 0.0
+        print("Fitness cache: size: %d/%d, hits: %d, misses: %d, hit rate: %.1f%%" % 
+                (len(self.store), self.max_size, self.hits, self.misses, hit_rate))
+
+def neat_genome_hash(genome):
+    """
+    The function to calculate structural hash of the NEAT-Python genome. The hash
+    includes node genes with their biases, responses, activation and aggregation
+    functions and the enabled connection genes with their weights.
+    Arguments:
+        genome: The NEAT-Python genome
+    Returns:
+        The hash digest bytes
+    """
+    nodes = sorted((key, node.bias, node.response, node.activation, node.aggregation) 
+                    for key, node in genome.nodes.items())
+    connections = sorted((key, conn.weight) for key, conn in genome.connections.items() if conn.enabled)
+    return hashlib.sha1(repr((nodes, connections)).encode()).digest()
+
+def multineat_genome_hash(genome):
+    """
+    The function to calculate structural hash of the MultiNEAT genome. The hash
+    includes neuron genes with their types, activation function parameters, biases
+    and activation functions and link genes with their weights. The genes are read
+    from the genome directly without building the phenotype ANN.
+    Arguments:
+        genome: The MultiNEAT genome
+    Returns:
+        The hash digest bytes
+    """
+    neurons = sorted((n.ID(), n.Type(), n.A, n.B, n.TimeConstant, n.Bias, n.ActFunction) 
+                    for n in genome.NeuronGenes)
+    links = sorted((l.FromNeuronID(), l.ToNeuronID(), l.GetWeight()) for l in genome.LinkGenes)
+    return hashlib.sha1(repr((neurons, links)).encode()).digest()
+
+def prune_multineat_network(multi_net):
+    """
+    The function to prune the MultiNEAT phenotype network. The MultiNEAT network 
+    propagates signals through all its connections and activates all its neurons 
+    on each activation step, thus the neurons which can not reach any output are
+    removed with their connections. The neurons not reachable from inputs are kept,
+    because their activation is driven by the bias and contributes to the outputs.
+    Arguments:
+        multi_net:  The MultiNEAT network built from genome. The inputs neurons are expected
+                    to be first followed by outputs neurons and hidden neurons.
+    Returns:
+        The tuple (pruned, removed_neurons, removed_links) with pruned network or provided 
+        network if nothing to prune, and the numbers of removed neurons and connections.
+    """
+    import MultiNEAT as NEAT
+
+    neurons, connections = multi_net.neurons, multi_net.connections
+    n_inputs, n_outputs = multi_net.NumInputs(), multi_net.NumOutputs()
+
+    # walk backward from the outputs through the connections
+    incoming = {}
+    for c in connections:
+        incoming.setdefault(c.target_neuron_idx, []).append(c.source_neuron_idx)
+    used = set(range(n_inputs + n_outputs))
+    pending = list(range(n_inputs, n_inputs + n_outputs))
+    while pending:
+        neuron = pending.pop()
+        for source in incoming.get(neuron, []):
+            if source not in used:
+                used.add(source)
+                pending.append(source)
+
+    if len(used) == len(neurons):
+        return multi_net, 0, 0
+
+    # build the network of used neurons keeping their order
+    index = dict((neuron, i) for i, neuron in enumerate(sorted(used)))
+    pruned = NEAT.NeuralNetwork()
+    pruned.SetInputOutputDimentions(n_inputs, n_outputs)
+    for neuron in sorted(used):
+        pruned.AddNeuron(neurons[neuron])
+    n_links = 0
+    for c in connections:
+        if c.target_neuron_idx in used:
+            conn = NEAT.Connection()
+            conn.source_neuron_idx = index[c.source_neuron_idx]
+            conn.target_neuron_idx = index[c.target_neuron_idx]
+            conn.weight = c.weight
+            conn.recur_flag = c.recur_flag
+            pruned.AddConnection(conn)
+            n_links += 1
+    pruned.Flush()
+    return pruned, len(neurons) - len(used), len(connections) - n_links
+
+#
+# The phases timing instrumentation
+#
+
+# The name of phase holding time spent on plotting and saving of results, which is not
+# charged to the library under evaluation
+OUTPUT_PHASE = 'output'
+
+class PhaseTimer:
+    """
+    The lightweight timers and counters of the experiment trial phases, e.g., phenotype 
+    creation, simulation, novelty scoring, reproduction, and output. The durations and 
+    counts are aggregated per generation and can be summed over the trial.
+    """
+    def __init__(self):
+        # The list of (durations, counts) dictionaries of each generation
+        self.generations = []
+        # The CPU time of the current process spent on each phase summed over all generations
+        self.cpu_durations = OrderedDict()
+
+    def start_generation(self):
+        """
+        Starts aggregation of durations and counts of the next generation.
+        """
+        self.generations.append((OrderedDict(), OrderedDict()))
+
+    @contextmanager
+    def phase(self, name):
+        """
+        The context manager to measure duration of the phase.
+        Arguments:
+            name: The name of the phase.
+        """
+        start_time = time.perf_counter()
+        start_cpu_time = time.process_time()
+        try:
+            yield
+        finally:
+            self.add_time(name, time.perf_counter() - start_time)
+            self.cpu_durations[name] = self.cpu_durations.get(name, 0.0) + time.process_time() - start_cpu_time
+
+    def add_time(self, name, duration):
+        """
+        Adds the duration of the phase to the current generation.
+        Arguments:
+            name:       The name of the phase.
+            duration:   The duration in seconds.
+        """
+        durations, _ = self._current()
+        durations[name] = durations.get(name, 0.0) + duration
+
+    def count(self, name, value=1):
+        """
+        Increments the counter in the current generation.
+        Arguments:
+            name:   The name of the counter.
+            value:  The value to be added.
+        """
+        _, counts = self._current()
+        counts[name] = counts.get(name, 0) + value
+
+    def merge(self, other):
+        """
+        Adds durations and counts of all generations of other timer to the current 
+        generation, e.g., the phases measured by the worker process.
+        Arguments:
+            other: The PhaseTimer to be merged.
+        """
+        for durations, counts in other.generations:
+            for name, duration in durations.items():
+                self.add_time(name, duration)
+            for name, value in counts.items():
+                self.count(name, value)
+        for name, duration in other.cpu_durations.items():
+            self.cpu_durations[name] = self.cpu_durations.get(name, 0.0) + duration
+
+    def totals(self):
+        """
+        Returns:
+            The tuple (durations, counts) with durations in milliseconds and counts
+            of each phase summed over all generations.
+        """
+        durations, counts = OrderedDict(), OrderedDict()
+        for gen_durations, gen_counts in self.generations:
+            for name, duration in gen_durations.items():
+                durations[name] = durations.get(name, 0.0) + duration * 1000
+            for name, value in gen_counts.items():
+                counts[name] = counts.get(name, 0) + value
+        return durations, counts
+
+    def to_dict(self):
+        """
+        Returns:
+            The dictionary with durations in milliseconds and counts of each generation
+            and their totals along with the CPU time of phases in milliseconds, which can 
+            be pickled or stored as JSON.
+        """
+        durations, counts = self.totals()
+        generations = [{'durations': dict((name, d * 1000) for name, d in gen_durations.items()), 
+                        'counts': dict(gen_counts)} for gen_durations, gen_counts in self.generations]
+        cpu_durations = dict((name, d * 1000) for name, d in self.cpu_durations.items())
+        return {'durations': dict(durations), 'counts': dict(counts), 'cpu_durations': cpu_durations, 
+                'generations': generations}
+
+    def print_statistics(self):
+        """
+        Prints the durations and counts of phases summed over all generations.
+        """
+        durations, counts = self.totals()
+        print("Phases of %d generations" % len(self.generations))
+        for name, duration in durations.items():
+            print("\t%s:\t%.3f ms" % (name, duration))
+        for name, value in counts.items():
+            print("\t%s:\t%d" % (name, value))
+
+    def write_json(self, path):
+        """
+        Writes durations and counts of each generation into the JSON file.
+        Arguments:
+            path: The path to the output file.
+        """
+        with open(path, 'w') as file:
+            json.dump(self.to_dict(), file, indent=2)
+
+    def write_csv(self, path):
+        """
+        Writes durations (ms) and counts of each generation into the CSV file
+        with one row per generation.
+        Arguments:
+            path: The path to the output file.
+        """
+        durations, counts = self.totals()
+        with open(path, 'w', newline='') as file:
+            writer = csv.writer(file)
+            writer.writerow(['generation'] + ['%s_ms' % name for name in durations] + list(counts))
+            for generation, (gen_durations, gen_counts) in enumerate(self.generations):
+                writer.writerow([generation] + [gen_durations.get(name, 0.0) * 1000 for name in durations] +
+                                [gen_counts.get(name, 0) for name in counts])
+
+    def _current(self):
+        if len(self.generations) == 0:
+            self.start_generation()
+        return self.generations[-1]
+
+class PhaseTimerReporter:
+    """
+    The NEAT-Python reporter to start generations of the PhaseTimer and to measure the
+    reproduction phase, i.e., the time spent on reproduction and speciation after
+    evaluation of the population.
+    """
+    def __init__(self, timer):
+        self.timer = timer
+        self.evaluated_time = None
+
+    def start_generation(self, generation):
+        self.timer.start_generation()
+
+    def post_evaluate(self, config, population, species, best_genome):
+        self.evaluated_time = time.perf_counter()
+
+    def end_generation(self, config, population, species_set):
+        if self.evaluated_time is not None:
+            self.timer.add_time('reproduction', time.perf_counter() - self.evaluated_time)
+            self.evaluated_time = None
+
+    def post_reproduction(self, config, population, species):
+        pass
+
+    def complete_extinction(self):
+        pass
+
+    def found_solution(self, config, generation, best):
+        pass
+
+    def species_stagnant(self, sid, species):
+        pass
+
+    def info(self, msg):
+        pass
+
+#
+# The settings of worker processes
+#
+def worker_settings(module_name, names):
+    """
+    The function to collect the experiment settings held by module globals, which are assigned
+    from command line arguments in the main process only, while the worker processes started
+    by spawn or forkserver methods re-import the module with default settings.
+    Arguments:
+        module_name:    The name of module holding the settings, i.e., __name__ of the runner
+        names:          The names of module globals holding the settings
+    Returns:
+        The tuple (initializer, initargs) to initialize worker processes with current settings.
+    """
+    module = sys.modules[module_name]
+    settings = {name: getattr(module, name) for name in names}
+    return init_worker_settings, (module_name, settings)
+
+def init_worker_settings(module_name, settings):
+    """
+    The function to initialize the worker process with the experiment settings.
+    Arguments:
+        module_name:    The name of module holding the settings
+        settings:       The dictionary with values of module globals to assign
+    """
+    module = sys.modules.get(module_name)
+    if module is None:
+        module = importlib.import_module(module_name)
+    for name, value in settings.items():
+        setattr(module, name, value)
+
+#
+# The random numbers streams
+#
+def derive_seed(master_seed, *keys):
+    """
+    The function to derive the seed of independent random numbers stream from
+    the master seed and the keys identifying the stream, e.g., the trial ID.
+    Arguments:
+        master_seed:    The master seed of the experiment
+        keys:           The non-negative integer keys of the stream
+    Returns:
+        The 32-bit seed value
+    """
+    return int(np.random.SeedSequence([master_seed] + list(keys)).generate_state(1)[0])
+
+def create_rng(seed, *keys):
+    """
+    The function to create the counter-based (Philox) random numbers generator for
+    the stream identified by the seed and the keys, e.g., the generation and the genome ID.
+    The same seed and keys always produce the same stream regardless of the order
+    or the process in which generators are created.
+    Arguments:
+        seed:   The seed, e.g., of the trial
+        keys:   The non-negative integer keys of the stream
+    Returns:
+        The NumPy random numbers generator
+    """
+    return np.random.Generator(np.random.Philox(np.random.SeedSequence([seed] + list(keys))))
+
+#
+# The persistence of trials results
+#
+
+# The name of file in the output directory to store results of finished trials
+TRIALS_FILE = 'trials.jsonl'
+
+# The command line options which don't affect results of trials, thus they are not
+# included into the configuration hash
+EXECUTION_OPTIONS = ('trials', 'workers', 'seed', 'resume', 'eval_backend', 'eval_workers', 'eval_chunk_size', 
+                    'fitness_cache_size', 'trace_memory', 'cpu_time_score', 'save_results')
+
+def config_hash(config, settings=None):
+    """
+    The function to calculate hash of experiment configuration used to identify stored
+    results of trials run with the same configuration.
+    Arguments:
+        config:     The path to the configuration file or the configuration parameters object
+                    (e.g., MultiNEAT Parameters), which public attributes are hashed.
+        settings:   The dictionary with additional settings affecting results, e.g., the 
+                    command line arguments.
+    Returns:
+        The hex digest of the configuration hash.
+    """
+    h = hashlib.sha1()
+    if isinstance(config, str) and os.path.isfile(config):
+        with open(config, 'rb') as file:
+            h.update(file.read())
+    else:
+        names = sorted(name for name in dir(config) if not name.startswith('_'))
+        values = [(name, repr(getattr(config, name))) for name in names if not callable(getattr(config, name))]
+        h.update(repr(values).encode('utf-8'))
+    if settings is not None:
+        values = sorted((name, repr(value)) for name, value in settings.items() if name not in EXECUTION_OPTIONS)
+        h.update(repr(values).encode('utf-8'))
+    return h.hexdigest()
+
+class TrialResultsStore:
+    """
+    The append-only JSON Lines file holding results of finished trials. Each line is
+    written and flushed to the disk as soon as the trial finished, so the results survive
+    the crash of experiment. The records are keyed by the experiment name, the library name,
+    the configuration hash and the random seed of the trial. The file can be shared by
+    different experiments and configurations.
+    """
+    def __init__(self, path, experiment, library, config_hash):
+        """
+        Creates new store.
+        Arguments:
+            path:           The path to the JSON Lines file.
+            experiment:     The name of the experiment.
+            library:        The name of the library.
+            config_hash:    The hash of the experiment configuration.
+        """
+        self.path = path
+        self.key = {'experiment': experiment, 'library': library, 'config_hash': config_hash}
+
+    def load(self):
+        """
+        Loads the records of trials with the same experiment, library and configuration.
+        The incomplete last line left by the crash is skipped.
+        Returns:
+            The list of records in order of writing.
+        """
+        records = []
+        if not os.path.isfile(self.path):
+            return records
+        with open(self.path, 'r') as file:
+            for line in file:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    continue
+                if all(record.get(name) == value for name, value in self.key.items()):
+                    records.append(record)
+        return records
+
+    def completed_trials(self, master_seed):
+        """
+        Finds stored results of trials run with seeds derived from the master seed.
+        Arguments:
+            master_seed: The master seed of experiment.
+        Returns:
+            The dictionary with tuples of trial results as returned by run_trial by the trial seed.
+        """
+        completed = {}
+        for record in self.load():
+            if record['master_seed'] == master_seed:
+                completed[record['seed']] = (record['solved'], record['generation'], record['complexity'], 
+                                            record['fitness'], record['duration'], record['phases'], 
+                                            record['usage'])
+        return completed
+
+    def last_master_seed(self):
+        """
+        Returns:
+            The master seed of the last stored trial or None if no trials stored.
+        """
+        records = self.load()
+        if len(records) == 0:
+            return None
+        return records[-1]['master_seed']
+
+    def append(self, trial_id, master_seed, seed, trial_results):
+        """
+        Appends results of the trial and flushes them to the disk.
+        Arguments:
+            trial_id:       The ID of the trial.
+            master_seed:    The master seed of experiment.
+            seed:           The random seed of the trial.
+            trial_results:  The tuple of trial results as returned by run_trial.
+        """
+        solved, generation, complexity, fitness, duration, phases, usage = trial_results
+        record = dict(self.key)
+        record.update({
+            'trial':        trial_id,
+            'master_seed':  master_seed,
+            'seed':         seed,
+            'solved':       bool(solved),
+            'generation':   int(generation),
+            'complexity':   float(complexity),
+            'fitness':      float(fitness),
+            'duration':     float(duration),
+            'phases':       phases,
+            'usage':        usage,
+        })
+        prefix = ''
+        if os.path.isfile(self.path) and os.path.getsize(self.path) > 0:
+            with open(self.path, 'rb') as file:
+                file.seek(-1, os.SEEK_END)
+                if file.read(1) != b'\n':
+                    # terminate the incomplete line left by the crash
+                    prefix = '\n'
+        with open(self.path, 'a') as file:
+            file.write(prefix + json.dumps(record) + '\n')
+            file.flush()
+            os.fsync(file.fileno())
+
 #
 # The common experiment evaluator code
 #
-def evaluate_experiment(args, eval_function, config, out_dir, max_fitness=-1, save_results=False, view_results=False):
+def evaluate_experiment(args, eval_function, config, out_dir, max_fitness=-1, save_results=False, view_results=False,
+                        experiment_name=None, library=None, initializer=None, initargs=()):
     """
     The function to evaluate given experiment specified by provided evaluation function. The evaluation
-    results will be returned as data object.
+    results will be returned as data object. The results of each finished trial are appended to the
+    file in the output directory, which allows to resume interrupted experiment with the same
+    master seed skipping already finished trials.
+    Arguments:
+        args:               The command line arguments
+        eval_function:      The evaluation function running one trial of experiment
+        config:             The algorithm-specific configuration parameters
+        out_dir:            The directory to store ouput results if any
+        max_fitness:        The maximal fitness score value for experiment or -1 if not defined.
+        save_results:       The flag to control if output results should be saved into output directory
+        view_results:       The flag to control whether intermediate output reults should be printed.
+        experiment_name:    The name of experiment to identify stored results of trials.
+        library:            The name of library to identify stored results of trials.
+        initializer:        The function to initialize each worker process running trials, e.g.,
+                            with experiment settings assigned from command line arguments.
+        initargs:           The arguments of the initializer.
+    Returns:
+        The ExperimentEvaluationResults holding statistics about experiment results.
+    """
+    experiment = ExperimentEvaluationResults(args.trials)
+    # the store of finished trials results
+    store = TrialResultsStore(os.path.join(out_dir, TRIALS_FILE), 
+                            experiment=experiment_name, 
+                            library=library, 
+                            config_hash=config_hash(config, vars(args)))
+    resume = getattr(args, 'resume', False)
+    # the master seed to derive seeds of trials
+    master_seed = getattr(args, 'seed', None)
+    if master_seed is None and resume:
+        # continue the last interrupted experiment
+        master_seed = store.last_master_seed()
+    if master_seed is None:
+        master_seed = int(time.time())
+    experiment.seed = master_seed
+    print("Master seed: %d" % master_seed)
+
+    # restore results of trials finished before
+    completed = store.completed_trials(master_seed) if resume else {}
+    pending = []
+    for i in range(args.trials):
+        seed = derive_seed(master_seed, i)
+        if seed in completed:
+            _store_trial_results(experiment, i, completed[seed])
+        else:
+            pending.append(i)
+    if resume:
+        print("Resumed %d finished trials from: %s" % (args.trials - len(pending), store.path))
+
+    # the number of worker processes to run trials in parallel
+    workers = getattr(args, 'workers', 1)
+    # the flag to trace memory allocations of trials with tracemalloc
+    trace_memory = getattr(args, 'trace_memory', False)
+    start_time = time.time()
+    if workers is not None and workers > 1:
+        # fan out trials to the pool of worker processes
+        with ProcessPoolExecutor(max_workers=workers, initializer=initializer, initargs=initargs) as executor:
+            futures = {}
+            for i in pending:
+                future = executor.submit(run_trial, eval_function, config, 
+                                        trial_id=i, 
+                                        n_generations=args.generations, 
+                                        out_dir=out_dir, 
+                                        save_results=save_results, 
+                                        view_results=view_results,
+                                        seed=derive_seed(master_seed, i),
+                                        trace_memory=trace_memory)
+                futures[future] = i
+            # store results as soon as trials finished
+            for future in as_completed(futures):
+                i = futures[future]
+                trial_results = future.result()
+                store.append(i, master_seed, derive_seed(master_seed, i), trial_results)
+                _store_trial_results(experiment, i, trial_results)
+    else:
+        for i in pending:
+            trial_results = run_trial(eval_function, config, 
+                                    trial_id=i, 
+                                    n_generations=args.generations, 
+                                    out_dir=out_dir, 
+                                    save_results=save_results, 
+                                    view_results=view_results,
+                                    seed=derive_seed(master_seed, i),
+                                    trace_memory=trace_memory)
+            store.append(i, master_seed, derive_seed(master_seed, i), trial_results)
+            _store_trial_results(experiment, i, trial_results)
+
+    experiment.elapsed_time = time.time() - start_time
+    experiment.calculate_statistics(max_fitness=max_fitness, cpu_time_score=getattr(args, 'cpu_time_score', False))
+    return experiment
+
+def run_trial(eval_function, config, trial_id, n_generations, out_dir, save_results=False, view_results=False, seed=None, 
+            trace_memory=False):
+    """
+    The function to run one trial of experiment and measure its duration and resources usage. 
+    It is executed either in the main process or in the worker process of the pool, thus the trial 
+    duration and resources usage are measured by the process running the trial.
     Arguments:
-        args:           The command line arguments
         eval_function:  The evaluation function running one trial of experiment
         config:         The algorithm-specific configuration parameters
+        trial_id:       The ID of the trial
+        n_generations:  The number of evolutionary generations
         out_dir:        The directory to store ouput results if any
-        max_fitness:    The maximal fitness score value for experiment or -1 if not defined.
         save_results:   The flag to control if output results should be saved into output directory
         view_results:   The flag to control whether intermediate output reults should be printed.
+        seed:           The random seed of the trial.
+        trace_memory:   The flag to trace memory allocations with tracemalloc (slows down the trial).
     Returns:
-        The ExperimentEvaluationResults holding statistics about experiment results.
+        The tuple (solved, generation, complexity, fitness, duration, phases, usage) with trial results, 
+        the trial duration in milliseconds, the dictionary with phases durations and counts, and
+        the dictionary with resources usage.
     """
-    experiment = ExperimentEvaluationResults(args.trials)
-    start_time = time.time()
-    for i in range(args.trials):
-        trial_start_time = time.time()
-        trial_out_dir = os.path.join(out_dir, "%d" % i)
-        experiment.results[i], generation, experiment.complexity[i], experiment.fitness[i] = eval_function(config, 
-                                                                        trial_id=i, 
-                                                                        n_generations=args.generations,
-                                                                        out_dir=trial_out_dir,
-                                                                        save_results=save_results,
-                                                                        view_results=view_results)
-        experiment.trial_durations[i] = (time.time() - trial_start_time) * 1000 # ms
-        experiment.avg_epoch_durations[i] = experiment.trial_durations[i] / float(generation + 1)
-        experiment.generations[i] = generation
+    timer = PhaseTimer()
+    if trace_memory:
+        tracemalloc.start()
+    start_cpu_time, _ = resource_usage()
+    trial_start_time = time.time()
+    trial_out_dir = os.path.join(out_dir, "%d" % trial_id)
+    solved, generation, complexity, fitness = eval_function(config, 
+                                                            trial_id=trial_id, 
+                                                            n_generations=n_generations,
+                                                            out_dir=trial_out_dir,
+                                                            save_results=save_results,
+                                                            view_results=view_results,
+                                                            seed=seed,
+                                                            timer=timer)
+    duration = (time.time() - trial_start_time) * 1000 # ms
+    cpu_time, peak_rss = resource_usage()
+    usage = {
+        'cpu_time':             (cpu_time - start_cpu_time) * 1000, # ms
+        'peak_rss':             peak_rss / 1048576.0, # MB
+        'peak_traced_memory':   None,
+    }
+    if trace_memory:
+        usage['peak_traced_memory'] = tracemalloc.get_traced_memory()[1] / 1048576.0 # MB
+        tracemalloc.stop()
+    return solved, generation, complexity, fitness, duration, timer.to_dict(), usage
 
-    experiment.elapsed_time = time.time() - start_time
-    experiment.calculate_statistics(max_fitness=max_fitness)
-    return experiment
\ No newline at end of file
+def resource_usage():
+    """
+    The function to get resources usage of the current process. The CPU time includes
+    the time of terminated child processes, e.g., the genomes evaluation workers closed
+    at the end of the trial. The peak resident set size is the maximal one of the process
+    and its terminated child processes since the start of the process, thus for the trials 
+    executed one after another in the same process it holds the maximum among them.
+    Returns:
+        The tuple (cpu_time, peak_rss) with the CPU time in seconds and the peak resident
+        set size in bytes or zero if not available on this platform.
+    """
+    try:
+        import resource
+    except ImportError:
+        return time.process_time(), 0
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    cpu_time = usage.ru_utime + usage.ru_stime + children.ru_utime + children.ru_stime
+    # the maximal resident set size is in kilobytes on Linux and in bytes on macOS
+    peak_rss = max(usage.ru_maxrss, children.ru_maxrss)
+    if sys.platform != 'darwin':
+        peak_rss *= 1024
+    return cpu_time, peak_rss
+
+def _store_trial_results(experiment, trial_id, trial_results):
+    """
+    The function to store results of one trial into the experiment evaluation results.
+    Arguments:
+        experiment:     The ExperimentEvaluationResults to hold trial results
+        trial_id:       The ID of the trial
+        trial_results:  The tuple (solved, generation, complexity, fitness, duration, phases, usage) 
+                        returned by run_trial
+    """
+    solved, generation, complexity, fitness, duration, phases, usage = trial_results
+    experiment.results[trial_id] = solved
+    experiment.complexity[trial_id] = complexity
+    experiment.fitness[trial_id] = fitness
+    experiment.trial_durations[trial_id] = duration
+    experiment.phases[trial_id] = phases
+    # the output of results is not charged to the library
+    output_duration = phases['durations'].get(OUTPUT_PHASE, 0.0)
+    experiment.avg_epoch_durations[trial_id] = (duration - output_duration) / float(generation + 1)
+    experiment.cpu_times[trial_id] = usage['cpu_time']
+    output_cpu_time = phases.get('cpu_durations', {}).get(OUTPUT_PHASE, 0.0)
+    experiment.avg_epoch_cpu_times[trial_id] = (usage['cpu_time'] - output_cpu_time) / float(generation + 1)
+    experiment.peak_rss[trial_id] = usage['peak_rss']
+    if usage['peak_traced_memory'] is not None:
+        experiment.peak_traced_memory[trial_id] = usage['peak_traced_memory']
+    experiment.generations[trial_id] = generation
@@ -0,0 +1,419 @@
+#
+# This file provides the tool to record the golden trajectories of the reference scalar
+# simulators and to check that alternative simulation engines (e.g., vectorized or JIT-compiled)
+# reproduce them. The trajectories are produced by fixed linear controllers from fixed
+# initial states and the states are recorded every N steps into the compressed NumPy file.
+# The pole-balancing runs are stopped when the constraints are violated and the states
+# recorded after that are NaN. The pole-balancing engines are checked over the segments
+# between records started from the golden states, since the chaotic dynamics amplifies
+# rounding differences over the whole trajectory. Along with the states the minimal margin
+# to the constraints bounds is recorded for each segment, which allows the engine to fail
+# differently only where the golden states come within tolerance of the bounds.
+#
+import os
+import sys
+import argparse
+import importlib
+
+import numpy as np
+
+import pole.cart_pole as cart
+import pole.cart_two_pole as cart_two
+import maze.maze_environment as maze
+
+# The maze configuration file used to record the maze agent trajectories
+MAZE_FILE = 'medium_maze.txt'
+
+# The bounds of absolute values of state variables by their indices for the systems
+# which fail once any of the bounds exceeded
+BOUNDS = {
+    'cart_pole':        {0: 2.4, 2: 0.21},
+    'cart_two_pole':    {0: 2.4, 2: cart_two.THIRTY_SIX_DEG_IN_RAD, 4: cart_two.THIRTY_SIX_DEG_IN_RAD},
+}
+
+def bounds_margin(system, state):
+    """
+    The function to find the margin of the state to the constraints bounds of the system.
+    Arguments:
+        system: The name of simulated system.
+        state:  The state variables.
+    Returns:
+        The minimal distance of state variables to their bounds, which is negative if
+        any of the bounds exceeded.
+    """
+    return min(bound - abs(state[i]) for i, bound in BOUNDS[system].items())
+
+def _update_margin(margins, system, run, step, record_every, state):
+    """
+    The function to update the minimal margin to the bounds of the segment including the step.
+    """
+    if margins is not None:
+        segment = (step + record_every - 1) // record_every
+        margins[run, segment] = min(margins[run, segment], bounds_margin(system, state))
+
+#
+# The fixed controllers. The controllers of all runs are evaluated at once with the same
+# sequence of floating point operations regardless of the number of runs, thus the scalar
+# and the batch engines receive identical control signals for identical states.
+#
+def linear_actions(states, weights):
+    """
+    The function to find the binary actions of the linear controllers.
+    Arguments:
+        states:     The array of states with shape (runs, dim)
+        weights:    The array of controllers weights with shape (runs, dim + 1), the last is a bias.
+    Returns:
+        The array of binary actions of each run.
+    """
+    dim = states.shape[1]
+    z = (states * weights[:, :dim]).sum(axis=1) + weights[:, dim]
+    return (z > 0).astype(int)
+
+def sigmoid_signals(inputs, weights):
+    """
+    The function to find the control signals of the single-layer sigmoid controllers.
+    Arguments:
+        inputs:     The array of inputs with shape (runs, n_inputs)
+        weights:    The array of controllers weights with shape (runs, n_outputs, n_inputs + 1),
+                    the last is a bias.
+    Returns:
+        The array of control signals with shape (runs, n_outputs).
+    """
+    n_inputs = inputs.shape[1]
+    z = (inputs[:, None, :] * weights[:, :, :n_inputs]).sum(axis=2) + weights[:, :, n_inputs]
+    return 1.0 / (1.0 + np.exp(-z))
+
+#
+# The single-pole cart engines
+#
+def cart_pole_scalar(starts, weights, n_steps, record_every, margins=None):
+    """
+    The single-pole cart simulated with reference do_step function, one run after another.
+    Arguments:
+        starts:         The array of initial states with shape (runs, 4)
+        weights:        The array of linear controllers weights with shape (runs, 5)
+        n_steps:        The number of simulation steps.
+        record_every:   The number of steps between recorded states.
+        margins:        The array with shape (runs, records) filled with infinity to store
+                        the minimal margin to the bounds over the steps of the segment ending
+                        at each record or None. It is provided by the recorder only.
+    Returns:
+        The array of recorded states with shape (runs, records, 4)
+    """
+    records = np.full((len(starts), n_steps // record_every + 1, starts.shape[1]), np.nan)
+    for r in range(len(starts)):
+        state = tuple(starts[r])
+        records[r, 0] = state
+        for step in range(1, n_steps + 1):
+            action = linear_actions(np.array([state]), weights[r:r + 1])[0]
+            state = cart.do_step(action, *state)
+            _update_margin(margins, 'cart_pole', r, step, record_every, state)
+            x, _, theta, _ = state
+            if x < -2.4 or x > 2.4 or theta < -0.21 or theta > 0.21:
+                break
+            if step % record_every == 0:
+                records[r, step // record_every] = state
+    return records
+
+def cart_pole_batch(starts, weights, n_steps, record_every):
+    """
+    The single-pole carts simulated at once with do_step_batch function.
+    """
+    records = np.full((len(starts), n_steps // record_every + 1, starts.shape[1]), np.nan)
+    state = starts.copy()
+    failed = np.zeros(len(starts), dtype=bool)
+    records[:, 0] = state
+    for step in range(1, n_steps + 1):
+        state = cart.do_step_batch(linear_actions(state, weights), state)
+        failed |= (state[:, 0] < -2.4) | (state[:, 0] > 2.4) | (state[:, 2] < -0.21) | (state[:, 2] > 0.21)
+        if step % record_every == 0:
+            records[~failed, step // record_every] = state[~failed]
+    return records
+
+#
+# The double-pole cart engines
+#
+def cart_two_pole_scalar(starts, weights, n_steps, record_every, margins=None):
+    """
+    The double-pole cart simulated with reference apply_action function (calc_step and rk4),
+    one run after another. The arguments and results are the same as of cart_pole_scalar
+    with states of shape (runs, 6).
+    """
+    records = np.full((len(starts), n_steps // record_every + 1, starts.shape[1]), np.nan)
+    for r in range(len(starts)):
+        state = starts[r].tolist()
+        records[r, 0] = state
+        for step in range(1, n_steps + 1):
+            action = linear_actions(np.array([state]), weights[r:r + 1])[0]
+            state = cart_two.apply_action(action=action, state=state, step_number=step)
+            _update_margin(margins, 'cart_two_pole', r, step, record_every, state)
+            if cart_two.outside_bounds(x=state[0], theta1=state[2], theta2=state[4]):
+                break
+            if step % record_every == 0:
+                records[r, step // record_every] = state
+    return records
+
+def cart_two_pole_batch(starts, weights, n_steps, record_every):
+    """
+    The double-pole carts simulated at once with CartTwoPoleBatch.
+    """
+    records = np.full((len(starts), n_steps // record_every + 1, starts.shape[1]), np.nan)
+    batch = cart_two.CartTwoPoleBatch(len(starts))
+    batch.state[:] = starts
+    failed = np.zeros(len(starts), dtype=bool)
+    records[:, 0] = starts
+    for step in range(1, n_steps + 1):
+        state = batch.apply_action(linear_actions(batch.state, weights))
+        failed |= batch.outside_bounds()
+        if step % record_every == 0:
+            records[~failed, step // record_every] = state[~failed]
+    return records
+
+#
+# The maze agent engines. The starts hold the initial agent state (x, y, heading, speed, angular_vel),
+# which is the same for all runs as given by the maze configuration.
+#
+def _maze_environment():
+    local_dir = os.path.dirname(os.path.abspath(__file__))
+    return maze.read_environment(os.path.join(local_dir, 'maze', MAZE_FILE))
+
+def _maze_agent_state(env):
+    a = env.agent
+    return [a.location.x, a.location.y, a.heading, a.speed, a.angular_vel]
+
+def maze_scalar(starts, weights, n_steps, record_every):
+    """
+    The maze agents simulated with reference MazeEnvironment.update, one run after another.
+    Arguments:
+        starts:         The array of initial agent states with shape (runs, 5)
+        weights:        The array of controllers weights with shape (runs, 2, n_inputs + 1)
+        n_steps:        The number of simulation steps.
+        record_every:   The number of steps between recorded states.
+    Returns:
+        The array of recorded states with shape (runs, records, 5)
+    """
+    maze_env = _maze_environment()
+    records = np.zeros((len(starts), n_steps // record_every + 1, starts.shape[1]))
+    for r in range(len(starts)):
+        env = maze_env.spawn_agent()
+        records[r, 0] = _maze_agent_state(env)
+        for step in range(1, n_steps + 1):
+            inputs = np.array([env.create_net_inputs()])
+            env.update(sigmoid_signals(inputs, weights[r:r + 1])[0])
+            if step % record_every == 0:
+                records[r, step // record_every] = _maze_agent_state(env)
+    return records
+
+def maze_batch(starts, weights, n_steps, record_every):
+    """
+    The maze agents simulated at once with MazeEnvironmentBatch.
+    """
+    batch = maze.MazeEnvironmentBatch(_maze_environment(), len(starts))
+    records = np.zeros((len(starts), n_steps // record_every + 1, starts.shape[1]))
+    records[:, 0] = starts
+    for step in range(1, n_steps + 1):
+        batch.update(sigmoid_signals(batch.create_net_inputs(), weights))
+        if step % record_every == 0:
+            records[:, step // record_every] = np.stack((batch.x, batch.y, batch.heading,
+                                                        batch.speed, batch.angular_vel), axis=1)
+    return records
+
+# The systems which state is fully described by the recorded state variables, thus their
+# engines can be restarted from any recorded state
+RESTARTABLE = ('cart_pole', 'cart_two_pole')
+
+# The simulation engines of each system by name. The 'scalar' engine is the reference one.
+ENGINES = {
+    'cart_pole':        {'scalar': cart_pole_scalar, 'batch': cart_pole_batch},
+    'cart_two_pole':    {'scalar': cart_two_pole_scalar, 'batch': cart_two_pole_batch},
+    'maze':             {'scalar': maze_scalar, 'batch': maze_batch},
+}
+
+def create_inputs(system, runs, seed):
+    """
+    The function to create fixed initial states and controllers weights of the system.
+    Arguments:
+        system: The name of simulated system.
+        runs:   The number of runs.
+        seed:   The seed of random numbers generator.
+    Returns:
+        The tuple (starts, weights) with arrays of initial states and controllers weights.
+    """
+    rng = np.random.default_rng(seed)
+    if system == 'cart_pole':
+        # the same ranges as of cart.random_start_state
+        starts = rng.uniform(-1.0, 1.0, size=(runs, 4)) * [1.2, 0.375, 0.105, 0.5]
+        # the perturbed balancing controller, some runs fail early
+        weights = np.array([0.5, 1.0, 10.0, 2.0, 0.0]) + rng.normal(scale=0.3, size=(runs, 5))
+    elif system == 'cart_two_pole':
+        starts = np.zeros((runs, 6))
+        starts[:, 2] = np.pi / 180.0 # the one_degree
+        starts += rng.normal(scale=0.001, size=(runs, 6))
+        # the perturbed balancing controller, some runs fail early
+        weights = np.array([-0.02, -0.35, -0.47, -2.0, 1.74, 0.47, 0.04]) * \
+                    (1.0 + rng.normal(scale=0.1, size=(runs, 7)))
+    elif system == 'maze':
+        env = _maze_environment()
+        starts = np.tile(_maze_agent_state(env), (runs, 1))
+        n_inputs = len(env.create_net_inputs())
+        weights = rng.normal(scale=0.05, size=(runs, 2, n_inputs + 1))
+    else:
+        raise ValueError("Unknown system: %s" % system)
+    return starts, weights
+
+def record(path, systems, runs, n_steps, record_every, seed):
+    """
+    The function to record the golden trajectories of the reference engines into the file.
+    Arguments:
+        path:           The path to the output file.
+        systems:        The list of systems names to record.
+        runs:           The number of runs of each system.
+        n_steps:        The dictionary with the number of simulation steps by system name.
+        record_every:   The number of steps between recorded states.
+        seed:           The seed of random numbers generator.
+    """
+    data = {'seed': seed, 'record_every': record_every}
+    for system in systems:
+        starts, weights = create_inputs(system, runs, seed)
+        if system in BOUNDS:
+            margins = np.full((runs, n_steps[system] // record_every + 1), np.inf)
+            states = ENGINES[system]['scalar'](starts, weights, n_steps[system], record_every, margins=margins)
+            data['%s/margins' % system] = margins
+        else:
+            states = ENGINES[system]['scalar'](starts, weights, n_steps[system], record_every)
+        data['%s/starts' % system] = starts
+        data['%s/weights' % system] = weights
+        data['%s/states' % system] = states
+        print("%-15s runs: %d, steps: %d, records: %d" % (system, runs, n_steps[system], states.shape[1]))
+    with open(path, 'wb') as file:
+        np.savez_compressed(file, **data)
+
+def replay(simulate, system, golden):
+    """
+    The function to replay the simulation engine over the golden trajectories of the system.
+    The engines of RESTARTABLE systems are started from each recorded golden state and run for
+    the number of steps between records, so rounding differences are not amplified by chaotic
+    dynamics over the whole trajectory. The other engines replay the whole trajectories.
+    Arguments:
+        simulate:   The engine function with the same signature as of cart_pole_scalar.
+        system:     The name of simulated system.
+        golden:     The loaded file with golden trajectories.
+    Returns:
+        The tuple (states, expected, runs, steps, margins) with arrays of replayed and golden states
+        with shape (N, dim), the run index and the simulation step of each of them, and the minimal
+        margins of golden states to the bounds over the segments ending at them or None if the
+        margins were not recorded.
+    """
+    record_every = int(golden['record_every'])
+    expected = golden['%s/states' % system]
+    weights = golden['%s/weights' % system]
+    margins = golden['%s/margins' % system] if '%s/margins' % system in golden.files else None
+    n_runs, n_records, dim = expected.shape
+    if system in RESTARTABLE:
+        # the segments starting from the states recorded before the failure
+        runs, records = np.nonzero(~np.isnan(expected[:, :-1]).any(axis=2))
+        states = simulate(expected[runs, records], weights[runs], record_every, record_every)[:, 1]
+        if margins is not None:
+            margins = margins[runs, records + 1]
+        return states, expected[runs, records + 1], runs, (records + 1) * record_every, margins
+
+    states = simulate(golden['%s/starts' % system], weights, (n_records - 1) * record_every, record_every)
+    runs = np.repeat(np.arange(n_runs), n_records - 1)
+    steps = np.tile(np.arange(1, n_records) * record_every, n_runs)
+    if margins is not None:
+        margins = margins[:, 1:].reshape(-1)
+    return states[:, 1:].reshape(-1, dim), expected[:, 1:].reshape(-1, dim), runs, steps, margins
+
+def check(path, engine, tolerance=1e-9):
+    """
+    The function to replay the simulation engine over the golden trajectories and to
+    report the maximal deviation and the first diverging step of each system. The engine
+    diverges if it fails in other segment than the golden run, unless the golden states of
+    the segment come within tolerance of the constraints bounds, because rounding differences
+    allowed by tolerance may move such states across the bounds. The allowed changes of
+    failure are reported separately.
+    Arguments:
+        path:       The path to the file with golden trajectories.
+        engine:     The name of engine in ENGINES or 'module:function' path of the engine function
+                    with the same signature as of cart_pole_scalar.
+        tolerance:  The maximal allowed absolute deviation of state variables.
+    Returns:
+        The list of names of systems diverged from the golden trajectories.
+    """
+    golden = np.load(path)
+    systems = [key.split('/')[0] for key in golden.files if key.endswith('/states')]
+    diverged = []
+    print("%-15s %-10s %14s %16s %16s %12s" % ("System", "Engine", "max deviation", "first diverged", 
+                                                "failure changed", "near bounds"))
+    for system in systems:
+        if ':' in engine:
+            module_name, function_name = engine.split(':')
+            simulate = getattr(importlib.import_module(module_name), function_name)
+        elif engine in ENGINES[system]:
+            simulate = ENGINES[system][engine]
+        else:
+            print("%-15s %-10s %14s %16s %16s %12s" % (system, engine, "-", "-", "-", "-"))
+            continue
+        states, expected, runs, steps, margins = replay(simulate, system, golden)
+
+        # the states failed by one of engines are not compared
+        failed = np.isnan(states).any(axis=1)
+        expected_failed = np.isnan(expected).any(axis=1)
+        compared = ~failed & ~expected_failed
+        deviation = np.abs(states[compared] - expected[compared]).max(axis=1)
+        max_deviation = deviation.max() if len(deviation) > 0 else 0.0
+
+        # the changed failure is allowed only in the segments passing within tolerance of the bounds
+        changed = failed != expected_failed
+        near_bounds = np.zeros(len(changed), dtype=bool)
+        if margins is not None:
+            near_bounds = np.abs(margins) <= tolerance
+        diverging_steps = np.concatenate((steps[compared][deviation > tolerance], steps[changed & ~near_bounds]))
+        first = "-"
+        if len(diverging_steps) > 0:
+            first = "step %d" % diverging_steps.min()
+            diverged.append(system)
+        n_runs = golden['%s/states' % system].shape[0]
+        print("%-15s %-10s %14g %16s %16s %12d" % (system, engine.split(':')[-1], max_deviation, first, 
+                                                    "%d of %d runs" % (len(np.unique(runs[changed])), n_runs),
+                                                    len(np.unique(runs[changed & near_bounds]))))
+    return diverged
+
+if __name__ == '__main__':
+    # read command line parameters
+    parser = argparse.ArgumentParser(description="The golden trajectories of the simulators recorder and checker.")
+    subparsers = parser.add_subparsers(dest='command')
+    record_parser = subparsers.add_parser('record', help="Record the golden trajectories of the reference engines.")
+    record_parser.add_argument('-o', '--output', default='golden_trajectories.npz',
+                        help="The path to the output file.")
+    record_parser.add_argument('--systems', nargs='*', default=list(ENGINES), choices=list(ENGINES),
+                        help="The simulated systems to record.")
+    record_parser.add_argument('--runs', type=int, default=32,
+                        help="The number of runs of each system with different initial states and controllers.")
+    record_parser.add_argument('--pole_steps', type=int, default=10000,
+                        help="The number of simulation steps of the pole-balancing systems.")
+    record_parser.add_argument('--maze_steps', type=int, default=400,
+                        help="The number of simulation steps of the maze agents.")
+    record_parser.add_argument('--record_every', type=int, default=10,
+                        help="The number of simulation steps between recorded states.")
+    record_parser.add_argument('--seed', type=int, default=42,
+                        help="The seed of random numbers generator to create initial states and controllers.")
+    check_parser = subparsers.add_parser('check', help="Check the engine against the golden trajectories.")
+    check_parser.add_argument('golden', help="The path to the file with golden trajectories.")
+    check_parser.add_argument('-e', '--engine', default='batch',
+                        help="The engine name (%s) or the 'module:function' path of engine function." %
+                            ", ".join(sorted(set(e for engines in ENGINES.values() for e in engines))))
+    check_parser.add_argument('--tolerance', type=float, default=1e-9,
+                        help="The maximal allowed absolute deviation of state variables.")
+    args = parser.parse_args()
+
+    if args.command == 'record':
+        n_steps = {'cart_pole': args.pole_steps, 'cart_two_pole': args.pole_steps, 'maze': args.maze_steps}
+        record(args.output, args.systems, args.runs, n_steps, args.record_every, args.seed)
+    elif args.command == 'check':
+        diverged = check(args.golden, args.engine, args.tolerance)
+        if diverged:
+            print("\nDiverged from golden trajectories: %s" % ", ".join(diverged))
+            sys.exit(1)
+    else:
+        parser.print_help()
@@ -201,4 +201,97 @@ class Line:
         """
         Returns the nicely formatted string representation of this line.
         """
-        return "Line (%.1f, %.1f) -> (%.1f, %.1f)" % (self.a.x, self.a.y, self.b.x, self.b.y)
\ No newline at end of file
+        return "Line (%.1f, %.1f) -> (%.1f, %.1f)" % (self.a.x, self.a.y, self.b.x, self.b.y)
+
+class SegmentGrid:
+    """
+    The uniform grid spatial index over line segments. Each grid cell holds the
+    segments passing nearby it, so that queries within a given area only touch the
+    segments located in the covered cells instead of testing all segments.
+    """
+    def __init__(self, lines, cell_size=None):
+        """
+        Creates new grid index over provided line segments.
+        Arguments:
+            lines:      The list of line segments to be indexed.
+            cell_size:  The size of the grid cell or None to estimate it from the
+                        extent of segments and their number.
+        """
+        self.lines = lines
+        xs = [p.x for l in lines for p in (l.a, l.b)]
+        ys = [p.y for l in lines for p in (l.a, l.b)]
+        self.min_x, self.min_y = min(xs, default=0.0), min(ys, default=0.0)
+        width, height = max(xs, default=0.0) - self.min_x, max(ys, default=0.0) - self.min_y
+        if cell_size is None:
+            # about one cell per segment along each side of the grid
+            cell_size = max(width, height, 1.0) / max(1, math.ceil(math.sqrt(len(lines))))
+        self.cell_size = cell_size
+        self.n_cols = int(width // cell_size) + 1
+        self.n_rows = int(height // cell_size) + 1
+        self.cells = [[] for _ in range(self.n_cols * self.n_rows)]
+
+        # the radius of the circle enclosing the grid cell
+        cell_radius = cell_size * math.sqrt(2.0) / 2.0
+        for i, line in enumerate(lines):
+            col_min, row_min, col_max, row_max = self._cells_range(min(line.a.x, line.b.x), min(line.a.y, line.b.y),
+                                                                   max(line.a.x, line.b.x), max(line.a.y, line.b.y))
+            for row in range(row_min, row_max + 1):
+                for col in range(col_min, col_max + 1):
+                    # store the segment only into cells it passes through
+                    center = Point(self.min_x + (col + 0.5) * cell_size, self.min_y + (row + 0.5) * cell_size)
+                    if line.distance(center) <= cell_radius:
+                        self.cells[row * self.n_cols + col].append(i)
+
+    def query(self, min_x, min_y, max_x, max_y):
+        """
+        The function to find line segments which can be located within given 
+        axis-aligned rectangle.
+        Arguments:
+            min_x, min_y: The bottom left corner of the rectangle.
+            max_x, max_y: The top right corner of the rectangle.
+        Returns:
+            The list of line segments passing through the grid cells covered by the rectangle.
+        """
+        col_min, row_min, col_max, row_max = self._cells_range(min_x, min_y, max_x, max_y)
+        found = set()
+        for row in range(row_min, row_max + 1):
+            offset = row * self.n_cols
+            for col in range(col_min, col_max + 1):
+                found.update(self.cells[offset + col])
+
+        return [self.lines[i] for i in sorted(found)]
+
+    def query_line(self, line):
+        """
+        The function to find line segments which can intersect the given line segment.
+        Arguments:
+            line: The line segment to test against.
+        Returns:
+            The list of line segments located near the given line segment.
+        """
+        return self.query(min(line.a.x, line.b.x), min(line.a.y, line.b.y),
+                          max(line.a.x, line.b.x), max(line.a.y, line.b.y))
+
+    def query_point(self, point, radius):
+        """
+        The function to find line segments which can be located within given distance
+        from the point.
+        Arguments:
+            point:  The point to test against.
+            radius: The distance from the point.
+        Returns:
+            The list of line segments located near the given point.
+        """
+        return self.query(point.x - radius, point.y - radius, point.x + radius, point.y + radius)
+
+    def _cells_range(self, min_x, min_y, max_x, max_y):
+        """
+        The function to find range of grid cells covered by the axis-aligned rectangle.
+        Returns:
+            The tuple (col_min, row_min, col_max, row_max) with the covered cells clamped to the grid bounds.
+        """
+        col_min = min(max(int((min_x - self.min_x) // self.cell_size), 0), self.n_cols - 1)
+        col_max = min(max(int((max_x - self.min_x) // self.cell_size), 0), self.n_cols - 1)
+        row_min = min(max(int((min_y - self.min_y) // self.cell_size), 0), self.n_rows - 1)
+        row_max = min(max(int((max_y - self.min_y) // self.cell_size), 0), self.n_rows - 1)
+        return col_min, row_min, col_max, row_max
@@ -5,12 +5,17 @@
 # and interaction with his sensors.
 #
 import math
+import copy
+
+import numpy as np
 
 import maze.agent as agent
 import maze.geometry as geometry
 
 from maze.novelty_archive import NoveltyItem
 
+from utils.compiled_net import as_population
+
 # The maximal allowed speed for the maze solver agent
 MAX_AGENT_SPEED = 3.0
 
@@ -58,22 +63,75 @@ def maze_novelty_metric_euclidean(first_item, second_item):
     
     return math.sqrt(diff_accum)
 
-class MazeEnvironment:
+def maze_novelty_metric_batch(data, other_data):
+    """
+    The function to calculate the novelty metric scores as distances between all pairs of
+    data vectors from two arrays. It is the vectorized counterpart of maze_novelty_metric
+    (the mean L1 distance).
+    Arguments:
+        data:       The array of data vectors with shape (n, d)
+        other_data: The array of data vectors with shape (m, d)
+    Returns:
+        The matrix of distances with shape (n, m)
+    """
+    return np.abs(data[:, None, :] - other_data[None, :, :]).sum(axis=2) / float(data.shape[1])
+
+def maze_novelty_metric_euclidean_batch(data, other_data):
     """
-    This class encapsulates the maze simulation environment.
+    The function to calculate the novelty metric scores as distances between all pairs of
+    data vectors from two arrays. It is the vectorized counterpart of maze_novelty_metric_euclidean
+    (the L2 distance).
+    Arguments:
+        data:       The array of data vectors with shape (n, d)
+        other_data: The array of data vectors with shape (m, d)
+    Returns:
+        The matrix of distances with shape (n, m)
+    """
+    diff = data[:, None, :] - other_data[None, :, :]
+    return np.sqrt((diff * diff).sum(axis=2))
+
+class MazeGeometry:
     """
-    def __init__(self, agent, walls, exit_point, exit_range=5.0):
+    This class holds the maze geometry, which never changes during simulation.
+    It is shared by all environments simulating agents in the same maze.
+    """
+    def __init__(self, walls, exit_point, exit_range=5.0, walls_index=None):
         """
-        Creates new maze environment with specified walls and exit point.
+        Creates new maze geometry with specified walls and exit point.
         Arguments:
-            agent:      The maze navigating agent
-            walls:      The maze walls
-            exit_point: The maze exit point
-            exit_range: The range arround exit point marking exit area
+            walls:          The maze walls
+            exit_point:     The maze exit point
+            exit_range:     The range arround exit point marking exit area
+            walls_index:    The spatial index over maze walls or None to build new one.
         """
         self.walls = walls
+        # The spatial index to find walls nearby agent
+        if walls_index is None:
+            walls_index = geometry.SegmentGrid(walls)
+        self.walls_index = walls_index
         self.exit_point = exit_point
         self.exit_range = exit_range
+
+class MazeEnvironment:
+    """
+    This class encapsulates the maze simulation environment. It consists of the
+    shared maze geometry and the state of the maze navigating agent.
+    """
+    def __init__(self, agent, walls, exit_point, exit_range=5.0, walls_index=None):
+        """
+        Creates new maze environment with specified walls and exit point.
+        Arguments:
+            agent:          The maze navigating agent
+            walls:          The maze walls
+            exit_point:     The maze exit point
+            exit_range:     The range arround exit point marking exit area
+            walls_index:    The spatial index over maze walls or None to build new one.
+        """
+        # The maze geometry
+        self.geometry = MazeGeometry(walls=walls, 
+                                    exit_point=exit_point, 
+                                    exit_range=exit_range, 
+                                    walls_index=walls_index)
         # The maze navigating agent
         self.agent = agent
         # The flag to indicate if exit was found
@@ -88,6 +146,57 @@ class MazeEnvironment:
         self.update_rangefinder_sensors()
         self.update_radars()
 
+        # The initial state of the agent to be restored on reset
+        self.initial_state = (agent.location.x, agent.location.y, agent.heading, agent.speed, agent.angular_vel)
+        self.initial_sensors = (list(agent.range_finders), list(agent.radar))
+
+    @property
+    def walls(self):
+        return self.geometry.walls
+
+    @property
+    def walls_index(self):
+        return self.geometry.walls_index
+
+    @property
+    def exit_point(self):
+        return self.geometry.exit_point
+
+    @property
+    def exit_range(self):
+        return self.geometry.exit_range
+
+    def reset(self):
+        """
+        The function to reset the agent to its initial state, i.e. to the state
+        at the time this environment was created.
+        """
+        x, y, heading, speed, angular_vel = self.initial_state
+        self.agent.location = geometry.Point(x, y)
+        self.agent.heading = heading
+        self.agent.speed = speed
+        self.agent.angular_vel = angular_vel
+        # the sensors readings at the initial state are known already
+        range_finders, radar = self.initial_sensors
+        self.agent.range_finders = list(range_finders)
+        self.agent.radar = list(radar)
+        self.exit_found = False
+
+    def spawn_agent(self):
+        """
+        The function to create new environment with the agent at the initial state
+        of this environment. The maze geometry is shared with this environment, thus
+        it is much cheaper than the deep copy of this environment.
+        Returns:
+            The new maze environment ready for simulation.
+        """
+        env = copy.copy(self)
+        env.agent = agent.Agent(location=geometry.Point(0, 0),
+                                radius=self.agent.radius,
+                                range_finder_range=self.agent.range_finder_range)
+        env.reset()
+        return env
+
     def agent_distance_to_exit(self):
         """
         The function to estimate distance from maze solver agent to the maze exit.
@@ -105,7 +214,7 @@ class MazeEnvironment:
         Returns:
             The True if agent at new location will collide with any of the maze walls.
         """
-        for w in self.walls:
+        for w in self.walls_index.query_point(loc, self.agent.radius):
             if w.distance(loc) < self.agent.radius:
                 return True
 
@@ -173,9 +282,9 @@ class MazeEnvironment:
             # set range to maximum detection range
             min_range = self.agent.range_finder_range
 
-            # now test against maze walls to see if projection line hits any wall
-            # and find the closest hit
-            for wall in self.walls:
+            # now test against maze walls nearby projection line to see if it hits 
+            # any wall and find the closest hit
+            for wall in self.walls_index.query_line(projection_line):
                 found, intersection = wall.intersection(projection_line)
                 if found:
                     found_range = intersection.distance(self.agent.location)
@@ -266,6 +375,235 @@ class MazeEnvironment:
         
         return str
 
+class MazeEnvironmentBatch:
+    """
+    This class encapsulates the maze simulation environment for the population of
+    agents navigating the same maze in lockstep. The state of all agents is kept
+    in arrays and updated with vectorized routines replicating the MazeEnvironment.
+    """
+    def __init__(self, maze_env, size):
+        """
+        Creates new batch of agents at the initial state of provided maze environment.
+        Arguments:
+            maze_env:   The maze environment to take walls, exit and the initial agent state from.
+            size:       The number of agents in the batch.
+        """
+        self.walls = walls_array(maze_env.walls)
+        self.exit_point = maze_env.exit_point
+        self.exit_range = maze_env.exit_range
+        self.initial_distance = maze_env.initial_distance
+        self.location_sample_rate = maze_env.location_sample_rate
+        # The agent parameters common to all agents
+        maze_agent = maze_env.agent
+        self.radius = maze_agent.radius
+        self.range_finder_range = maze_agent.range_finder_range
+        self.range_finder_angles = maze_agent.range_finder_angles
+        self.radar_angles = maze_agent.radar_angles
+        # The agents state
+        self.x = np.full(size, float(maze_agent.location.x))
+        self.y = np.full(size, float(maze_agent.location.y))
+        self.heading = np.full(size, float(maze_agent.heading))
+        self.speed = np.full(size, float(maze_agent.speed))
+        self.angular_vel = np.full(size, float(maze_agent.angular_vel))
+        # The flags to indicate if exit was found by agents
+        self.exit_found = np.zeros(size, dtype=bool)
+        # The agents sensors
+        self.range_finders = np.zeros((size, len(self.range_finder_angles)))
+        self.radar = np.zeros((size, len(self.radar_angles)))
+
+        # Update sensors
+        self.update_rangefinder_sensors()
+        self.update_radars()
+
+    def __len__(self):
+        return len(self.x)
+
+    def agent_distance_to_exit(self):
+        """
+        The function to estimate distance from maze solver agents to the maze exit.
+        Returns:
+            The array with distances from maze solver agents to the maze exit.
+        """
+        dx = self.x - self.exit_point.x
+        dy = self.y - self.exit_point.y
+        return np.sqrt(dx*dx + dy*dy)
+
+    def create_net_inputs(self):
+        """
+        The function to create the ANN input values from the simulation environment.
+        Returns:
+            The array of ANN inputs of shape (agents, inputs) consist of values get from
+            solver agents sensors.
+        """
+        return np.hstack((self.range_finders, self.radar))
+
+    def update_rangefinder_sensors(self):
+        """
+        The function to update the agents range finder sensors.
+        """
+        self.range_finders = cast_rays(x=self.x, y=self.y, 
+                                    headings=self.heading, 
+                                    angles=self.range_finder_angles, 
+                                    max_range=self.range_finder_range, 
+                                    walls=self.walls)
+
+    def update_radars(self):
+        """
+        The function to update the agents radar sensors.
+        """
+        rad = self.heading / 180.0 * math.pi
+        cos_rad, sin_rad = np.cos(rad), np.sin(rad)
+        # rotate target with respect to the agent's heading to align it with heading direction
+        ox = self.exit_point.x - self.x
+        oy = self.exit_point.y - self.y
+        tx = (cos_rad * ox - sin_rad * oy) + self.x
+        ty = (sin_rad * ox - cos_rad * oy) + self.y
+        # translate with respect to the agent's location
+        tx -= self.x
+        ty -= self.y
+        # the angle between maze exit point and the agent's heading direction
+        angle = np.arctan2(ty, tx) / math.pi * 180.0
+        angle = np.where(angle < 0.0, angle + 360, angle)
+        # find the appropriate radar sensor to be fired
+        for i, r_angles in enumerate(self.radar_angles):
+            fired = ((angle >= r_angles[0]) & (angle < r_angles[1])) | \
+                    ((angle + 360 >= r_angles[0]) & (angle + 360 < r_angles[1]))
+            self.radar[:, i] = np.where(fired, 1.0, 0.0)
+
+    def update(self, control_signals):
+        """
+        The function to update solver agents positions within maze. The agents which
+        already found the maze exit are not updated.
+        Arguments:
+            control_signals: The array of control signals of shape (agents, 2) received from the control ANNs
+        Returns:
+            The array with flags indicating whether maze exit was found by each agent after update
+            or was already found in previous simulation cycles.
+        """
+        active = ~self.exit_found
+        control_signals = np.asarray(control_signals, dtype=float)
+
+        # Apply control signals
+        angular_vel = np.clip(self.angular_vel + (control_signals[:, 0] - 0.5), -MAX_AGENT_SPEED, MAX_AGENT_SPEED)
+        speed = np.clip(self.speed + (control_signals[:, 1] - 0.5), -MAX_AGENT_SPEED, MAX_AGENT_SPEED)
+
+        # get X and Y velocity components
+        rad = self.heading / 180.0 * math.pi
+        vx = np.cos(rad) * speed
+        vy = np.sin(rad) * speed
+
+        # Update current Agents heading and enforce angular velocity bounds by wrapping
+        heading = self.heading + angular_vel
+        heading = np.where(heading > 360, heading - 360, np.where(heading < 0, heading + 360, heading))
+
+        # find the next location of the agents and test it for collisions with walls
+        new_x, new_y = self.x + vx, self.y + vy
+        moved = active & ~np.any(segments_distance(new_x, new_y, self.walls) < self.radius, axis=1)
+
+        self.angular_vel = np.where(active, angular_vel, self.angular_vel)
+        self.speed = np.where(active, speed, self.speed)
+        self.heading = np.where(active, heading, self.heading)
+        self.x = np.where(moved, new_x, self.x)
+        self.y = np.where(moved, new_y, self.y)
+
+        # update agents sensors
+        self.update_rangefinder_sensors()
+        self.update_radars()
+
+        # check if agents reached exit point
+        self.exit_found |= active & (self.agent_distance_to_exit() < self.exit_range)
+        return self.exit_found
+
+def walls_array(walls):
+    """
+    The function to convert the list of maze walls into array.
+    Arguments:
+        walls: The list of maze walls line segments.
+    Returns:
+        The array of shape (walls, 4) where each row holds wall coordinates (x1, y1, x2, y2)
+    """
+    return np.array([[w.a.x, w.a.y, w.b.x, w.b.y] for w in walls], dtype=float).reshape(-1, 4)
+
+def cast_rays(x, y, headings, angles, max_range, walls, chunk_size=100000):
+    """
+    The function to cast the range finder rays of all agents at once and to find
+    the distances to the closest walls hit by each ray. The rays are tested against
+    chunks of walls, so that the intermediate arrays never hold more than chunk_size
+    ray-wall pairs regardless of the number of walls.
+    Arguments:
+        x, y:       The arrays with agents coordinates.
+        headings:   The array with agents headings in degrees.
+        angles:     The list of range finder angles in degrees relative to the heading.
+        max_range:  The maximal detection range of the range finders.
+        walls:      The walls array as returned by walls_array.
+        chunk_size: The maximal number of ray-wall pairs to be tested at once.
+    Returns:
+        The range finders matrix of shape (agents, rays).
+    """
+    x, y = x[:, None], y[:, None]
+    rad = np.array([geometry.deg_to_rad(angle) for angle in angles])
+    heading_rad = (headings / 180.0 * math.pi)[:, None]
+    cos_h, sin_h = np.cos(heading_rad), np.sin(heading_rad)
+    # project points from agents locations outwards and rotate them by the agents heading angle
+    ox = (x + np.cos(rad) * max_range) - x
+    oy = (y + np.sin(rad) * max_range) - y
+    dx = ((cos_h * ox - sin_h * oy) + x)[:, :, None]
+    dy = ((sin_h * ox - cos_h * oy) + y)[:, :, None]
+    x, y = x[:, :, None], y[:, :, None]
+    dcx, dcy = dx - x, dy - y
+
+    ranges = np.full(dx.shape[:2], float(max_range))
+    n_walls = max(1, chunk_size // max(1, dx.size))
+    for start in range(0, len(walls), n_walls):
+        # test all rays against the chunk of walls (see geometry.Line.intersection)
+        chunk = walls[start:start + n_walls]
+        ax, ay, bx, by = chunk[:, 0], chunk[:, 1], chunk[:, 2], chunk[:, 3]
+        bax, bay = bx - ax, by - ay
+        acx, acy = ax - x, ay - y
+        r_top = acy * dcx - acx * dcy
+        s_top = acy * bax - acx * bay
+        bot = bax * dcy - bay * dcx
+        with np.errstate(divide='ignore', invalid='ignore'):
+            r = r_top / bot
+            s = s_top / bot
+            ix = ax + r * bax - x
+            iy = ay + r * bay - y
+        hit = (bot != 0) & (r > 0) & (r < 1) & (s > 0) & (s < 1)
+        distance = np.sqrt(ix*ix + iy*iy)
+
+        # find the closest hit within the detection range
+        np.minimum(ranges, np.min(np.where(hit, distance, max_range), axis=2), out=ranges)
+
+    return ranges
+
+def segments_distance(x, y, walls):
+    """
+    The function to find distances from points to the maze walls.
+    Arguments:
+        x, y:   The arrays with points coordinates.
+        walls:  The walls array as returned by walls_array.
+    Returns:
+        The distances matrix of shape (points, walls).
+    """
+    x, y = x[:, None], y[:, None]
+    ax, ay, bx, by = walls[:, 0], walls[:, 1], walls[:, 2], walls[:, 3]
+    bax, bay = bx - ax, by - ay
+    # see geometry.Line.distance
+    utop = (x - ax) * bax + (y - ay) * bay
+    ubot = np.sqrt((ax - bx) * (ax - bx) + (ay - by) * (ay - by))
+    ubot *= ubot
+    with np.errstate(divide='ignore', invalid='ignore'):
+        u = utop / ubot
+        # the distance to the projection point
+        px = (ax + u * bax) - x
+        py = (ay + u * bay) - y
+        dp = np.sqrt(px*px + py*py)
+    # the distance to the closest end point
+    d1 = np.sqrt((ax - x) * (ax - x) + (ay - y) * (ay - y))
+    d2 = np.sqrt((bx - x) * (bx - x) + (by - y) * (by - y))
+    distance = np.where((u < 0) | (u > 1), np.minimum(d1, d2), dp)
+    return np.where(ubot == 0.0, 0.0, distance)
+
 def read_environment(file_path):
     """
     The function to read maze environment configuration from provided
@@ -308,11 +646,14 @@ def read_environment(file_path):
 
     assert len(walls) == num_lines
 
+    # build the spatial index over walls to speed up sensors and collisions tests
+    walls_index = geometry.SegmentGrid(walls)
+
     print("Maze environment configured successfully from the file: %s" % file_path)
     # create and return the maze environment
-    return MazeEnvironment(agent=maze_agent, walls=walls, exit_point=maze_exit)
+    return MazeEnvironment(agent=maze_agent, walls=walls, exit_point=maze_exit, walls_index=walls_index)
 
-def maze_simulation_evaluate(env, net, time_steps, mcns=0.0, n_item=None, path_points=None):
+def maze_simulation_evaluate(env, net, time_steps, mcns=0.0, n_item=None, path_points=None, timer=None):
     """
     The function to evaluate maze simulation for specific environment
     and controll ANN provided. The results will be saved into provided
@@ -325,12 +666,15 @@ def maze_simulation_evaluate(env, net, time_steps, mcns=0.0, n_item=None, path_p
         n_item:         The NoveltyItem to store evaluation results.
         path_points:    The holder for path points collected during simulation. If
                         provided None then nothing will be collected.
+        timer:          The PhaseTimer to count simulation steps or None.
     Returns:
         The goal-oriented fitness value, i.e., how close is agent to the exit at
         the end of simulation.
     """
     exit_found = False
+    steps = 0
     for i in range(time_steps):
+        steps += 1
         if maze_simulation_step(env, net):
             print("Maze solved in %d steps" % (i + 1))
             exit_found = True
@@ -368,6 +712,9 @@ def maze_simulation_evaluate(env, net, time_steps, mcns=0.0, n_item=None, path_p
     if n_item is not None:
         n_item.fitness = fitness
 
+    if timer is not None:
+        timer.count('simulation_steps', steps)
+
     return fitness
 
 
@@ -386,3 +733,62 @@ def maze_simulation_step(env, net):
     output = net.activate(inputs)
     # apply control signal to the environment and update
     return env.update(output)
+
+def maze_simulation_evaluate_batch(env, nets, time_steps, mcns=0.0, n_items=None, timer=None):
+    """
+    The function to evaluate maze simulation for the batch of agents navigating the
+    same maze in lockstep. It is the batch counterpart of maze_simulation_evaluate.
+    Arguments:
+        env:            The batch maze simulation environment.
+        nets:           The list of control ANNs of agents or the PopulationNetwork.
+        time_steps:     The number of time steps for maze simulation.
+        mcns:           The minimal criteria fitness value.
+        n_items:        The list of NoveltyItems to store evaluation results of each agent.
+        timer:          The PhaseTimer to count simulation steps of all agents or None.
+    Returns:
+        The array with goal-oriented fitness values, i.e., how close is each agent 
+        to the exit at the end of simulation.
+    """
+    population = as_population(nets)
+    steps = 0
+    for i in range(time_steps):
+        active = ~env.exit_found
+        if not active.any():
+            break
+        steps += int(np.count_nonzero(active))
+
+        # create inputs from the current state of the environment, activate control
+        # ANNs and apply control signals to the environment
+        outputs = population.activate(env.create_net_inputs())
+        exit_found = env.update(outputs)
+        for a in np.flatnonzero(active & exit_found):
+            print("Maze solved in %d steps" % (i + 1))
+
+        # store agents path points at a given sample size rate
+        if (time_steps - i) % env.location_sample_rate == 0 and n_items is not None:
+            for a in np.flatnonzero(active & ~exit_found):
+                n_items[a].data.append(float(env.x[a]))
+                n_items[a].data.append(float(env.y[a]))
+
+    # store final agents coordinates as genome's novelty characteristics
+    if n_items is not None:
+        for a, n_item in enumerate(n_items):
+            n_item.data.append(float(env.x[a]))
+            n_item.data.append(float(env.y[a]))
+
+    # Calculate the fitness scores based on distance from exit
+    fitness = (env.initial_distance - env.agent_distance_to_exit()) / env.initial_distance
+    fitness = np.where(fitness <= 0, 0.01, fitness)
+    fitness = np.where(env.exit_found, 1.0, fitness)
+
+    # Use minimal criteria fitness value to signal if genome should be included into population
+    fitness = np.where(fitness < mcns, -1, fitness)
+
+    if n_items is not None:
+        for a, n_item in enumerate(n_items):
+            n_item.fitness = float(fitness[a])
+
+    if timer is not None:
+        timer.count('simulation_steps', steps)
+
+    return fitness
@@ -9,8 +9,8 @@ import shutil
 import math
 import random
 import time
-import copy
 import argparse
+from concurrent.futures import ProcessPoolExecutor
 
 # The NEAT-Python library imports
 import neat
@@ -18,11 +18,16 @@ import neat
 import utils.visualize as visualize
 import utils
 
+# The compiled phenotypes
+from utils.compiled_net import CompiledNetwork, PopulationNetwork
+
 # The maze environment
 import maze.maze_environment as maze
 import maze.agent as agent
 import maze.novelty_archive as archive
 
+from experiment import PhaseTimer, PhaseTimerReporter, OUTPUT_PHASE
+
 # The current working directory
 local_dir = os.path.dirname(__file__)
 # The directory to store outputs
@@ -33,18 +38,24 @@ out_dir = os.path.join(out_dir, 'maze_ns')
 SOLVER_TIME_STEPS = 400
 # The minimal goal fitness criterion
 MCNS = 0.1
+# The number of genomes to be simulated together in one batch. It is fixed
+# independently of the number of workers to get the same results in any case.
+SIMULATION_CHUNK_SIZE = 64
 
 class MazeSimulationTrial:
     """
     The class to hold maze simulator execution parameters and results.
     """
-    def __init__(self, maze_env, population, archive):
+    def __init__(self, maze_env, population, archive, executor=None, chunk_size=SIMULATION_CHUNK_SIZE):
         """
         Creates new instance and initialize fileds.
         Arguments:
             maze_env:   The maze environment as loaded from configuration file.
             population: The population for this trial run
             archive:    The archive to hold NoveltyItems
+            executor:   The pool of worker processes to simulate genomes or None
+                        to simulate them in the current process.
+            chunk_size: The number of genomes to be simulated together in one batch.
         """
         # The initial maze simulation environment
         self.orig_maze_environment = maze_env
@@ -54,64 +65,120 @@ class MazeSimulationTrial:
         self.population = population
         # The NoveltyItem archive
         self.archive = archive
+        # The pool of simulation worker processes
+        self.executor = executor
+        # The number of genomes per simulation batch
+        self.chunk_size = chunk_size
+        # The timers and counters of trial phases
+        self.timer = PhaseTimer()
 
 # The simulation results holder for a one trial.
 # It must be initialized before start of each trial.
 trial_sim = None
 
-def eval_individual(genome_id, genome, genomes, n_items_map, config):
+# The maze environment and configuration of the simulation worker process
+worker_maze_env = None
+worker_config = None
+
+def init_simulation_worker(maze_env, config):
+    """
+    The function to initialize the simulation worker process with the data
+    shared by all its tasks.
+    Arguments:
+        maze_env:   The maze environment as loaded from configuration file.
+        config:     The configuration settings with algorithm hyper-parameters
+    """
+    global worker_maze_env, worker_config
+    worker_maze_env = maze_env
+    worker_config = config
+
+def simulate_genomes(genomes, config, maze_env, generation, timer=None):
+    """
+    The function to simulate the batch of genomes navigating the maze in lockstep.
+    It doesn't touch the trial state, so it can be executed by worker processes.
+    Arguments:
+        genomes:    The list of (genome_id, genome) tuples to simulate.
+        config:     The configuration settings with algorithm hyper-parameters
+        maze_env:   The maze environment as loaded from configuration file.
+        generation: The current generation.
+        timer:      The PhaseTimer to report phenotype creation and simulation phases into or None.
+    Returns:
+        The tuple with lists of NoveltyItems holding behaviour vectors and AgenRecords
+        holding simulation results in order of genomes.
+    """
+    if timer is None:
+        timer = PhaseTimer()
+    n_items = [archive.NoveltyItem(generation=generation, genomeId=genome_id) for genome_id, _ in genomes]
+    env = maze.MazeEnvironmentBatch(maze_env, size=len(genomes))
+    with timer.phase('phenotype'):
+        control_net = PopulationNetwork.create([genome for _, genome in genomes], config)
+    with timer.phase('simulation'):
+        goal_fitness = maze.maze_simulation_evaluate_batch(
+                                            env=env, 
+                                            nets=control_net, 
+                                            time_steps=SOLVER_TIME_STEPS,
+                                            n_items=n_items,
+                                            mcns=MCNS,
+                                            timer=timer)
+    records = []
+    for i, (genome_id, _) in enumerate(genomes):
+        record = agent.AgenRecord(generation=generation, agent_id=genome_id)
+        record.fitness = float(goal_fitness[i])
+        record.x = float(env.x[i])
+        record.y = float(env.y[i])
+        record.hit_exit = bool(env.exit_found[i])
+        records.append(record)
+
+    return n_items, records
+
+def simulate_genomes_worker(genomes, generation):
+    """
+    The function to simulate the batch of genomes within the worker process.
+    Arguments:
+        genomes:    The list of (genome_id, genome) tuples to simulate.
+        generation: The current generation.
+    Returns:
+        The results of simulate_genomes along with the PhaseTimer holding phenotype
+        creation and simulation phases of the worker.
+    """
+    timer = PhaseTimer()
+    n_items, records = simulate_genomes(genomes, worker_config, worker_maze_env, generation, timer=timer)
+    return n_items, records, timer
+
+def eval_individual(genome_id, genome, genomes, n_items_map, record):
     """
-    Evaluates the individual represented by genome.
+    Evaluates the individual represented by genome using results of its maze simulation.
     Arguments:
         genome_id:      The ID of genome.
         genome:         The genome to evaluate.
         genomes:        The genomes population for current generation.
         n_items_map:    The map to hold novelty items for current generation.
-        config:         The NEAT configuration holder.
+        record:         The AgenRecord with results of genome's maze simulation.
     Return:
         The True if successful solver found.
     """
-    # create NoveltyItem for genome and store it into map
-    n_item = archive.NoveltyItem(generation=trial_sim.population.generation,
-                                genomeId=genome_id)
-    n_items_map[genome_id] = n_item
-    # run the simulation
-    maze_env = copy.deepcopy(trial_sim.orig_maze_environment)
-    control_net = neat.nn.FeedForwardNetwork.create(genome, config)
-    goal_fitness = maze.maze_simulation_evaluate(
-                                        env=maze_env, 
-                                        net=control_net, 
-                                        time_steps=SOLVER_TIME_STEPS,
-                                        n_item=n_item,
-                                        mcns=MCNS)
-
-    if goal_fitness == -1:
+    if record.fitness == -1:
         # The individual doesn't meet the minimal fitness criterion
         print("Individ with ID: %d marked for extiction, MCNS: %f" % (genome_id, MCNS))
         return False
 
-    # Store simulation results into the agent record
-    record = agent.AgenRecord(
-        generation=trial_sim.population.generation,
-        agent_id=genome_id)
-    record.fitness = goal_fitness
-    record.x = maze_env.agent.location.x
-    record.y = maze_env.agent.location.y
-    record.hit_exit = maze_env.exit_found
+    exit_found = record.hit_exit
+
+    # Complete the agent record with species data
     record.species_id = trial_sim.population.species.get_species_id(genome_id)
     record.species_age = record.generation - trial_sim.population.species.get_species(genome_id).created
     # add record to the store
     trial_sim.record_store.add_record(record)
 
     # Evaluate the novelty of a genome and add the novelty item to the archive of Novelty items if appropriate
-    if not maze_env.exit_found:
+    if not exit_found:
         # evaluate genome novelty and add it to the archive if appropriate
         record.novelty = trial_sim.archive.evaluate_individual_novelty(genome=genome, genomes=genomes, n_items_map=n_items_map)
 
     # update fittest organisms list
     trial_sim.archive.update_fittest_with_genome(genome=genome, n_items_map=n_items_map)
 
-    return maze_env.exit_found
+    return exit_found
 
 def eval_genomes(genomes, config):
     """
@@ -123,33 +190,60 @@ def eval_genomes(genomes, config):
         config:  The configuration settings with algorithm
                  hyper-parameters
     """
-    n_items_map = {} # The map to hold the novelty items for current generation
-    solver_genome = None
-    for genome_id, genome in genomes:
-        found = eval_individual(genome_id=genome_id, 
-                                genome=genome, 
-                                genomes=genomes, 
-                                n_items_map=n_items_map, 
-                                config=config)
-        if found:
-            solver_genome = genome
-
-    # now adjust the archive settings and evaluate population
-    trial_sim.archive.end_of_generation()
-    for genome_id, genome in genomes:
-        # set fitness value as a logarithm of a novelty score of a genome in the population
-        fitness = trial_sim.archive.evaluate_individual_novelty(genome=genome,
-                                                                genomes=genomes,
-                                                                n_items_map=n_items_map,
-                                                                only_fitness=True)
-        # To avoid negative genome fitness scores we just set to zero all obtained
-        # fitness scores that is less than 1 (note we use the natural logarithm)
-        if fitness > 1:
-            fitness = math.log(fitness)
-        else:
-            fitness = 0
-        # assign the adjusted fitness score to the genome
-        genome.fitness = fitness
+    # run the simulation of genomes in lockstep batches, which are executed
+    # by the worker processes if available
+    generation = trial_sim.population.generation
+    chunks = [genomes[i:i + trial_sim.chunk_size] for i in range(0, len(genomes), trial_sim.chunk_size)]
+    timer = trial_sim.timer
+    if trial_sim.executor is None:
+        results = [simulate_genomes(chunk, config, trial_sim.orig_maze_environment, generation, timer=timer) 
+                    for chunk in chunks]
+    else:
+        # the phases of workers are summed over all workers, while the wall-clock
+        # time of parallel simulation is measured separately
+        with timer.phase('parallel_simulation'):
+            results = []
+            for chunk_items, chunk_records, chunk_timer in trial_sim.executor.map(simulate_genomes_worker, chunks, 
+                                                                                [generation] * len(chunks)):
+                timer.merge(chunk_timer)
+                results.append((chunk_items, chunk_records))
+    timer.count('evaluated_genomes', len(genomes))
+
+    n_items, records = [], []
+    for chunk_items, chunk_records in results:
+        n_items.extend(chunk_items)
+        records.extend(chunk_records)
+
+    with timer.phase('novelty'):
+        # store NoveltyItem of each genome into map
+        n_items_map = {} # The map to hold the novelty items for current generation
+        for (genome_id, _), n_item in zip(genomes, n_items):
+            n_items_map[genome_id] = n_item
+
+        # merge simulation results into the trial state in order of genomes
+        solver_genome = None
+        for (genome_id, genome), record in zip(genomes, records):
+            found = eval_individual(genome_id=genome_id, 
+                                    genome=genome, 
+                                    genomes=genomes, 
+                                    n_items_map=n_items_map, 
+                                    record=record)
+            if found:
+                solver_genome = genome
+
+        # now adjust the archive settings and evaluate population
+        trial_sim.archive.end_of_generation()
+        novelty_scores = trial_sim.archive.evaluate_population_novelty(genomes=genomes, n_items_map=n_items_map)
+        for (genome_id, genome), fitness in zip(genomes, novelty_scores):
+            # set fitness value as a logarithm of a novelty score of a genome in the population
+            # To avoid negative genome fitness scores we just set to zero all obtained
+            # fitness scores that is less than 1 (note we use the natural logarithm)
+            if fitness > 1:
+                fitness = math.log(fitness)
+            else:
+                fitness = 0
+            # assign the adjusted fitness score to the genome
+            genome.fitness = fitness
 
     # if successful maze solver was found then adjust its fitness 
     # to signal the finish evolution
@@ -192,12 +286,24 @@ def run_experiment(config_file, maze_env, novelty_archive, trial_out_dir, checkp
     else:
         p = neat.Population(config)
 
+    # Create the pool of simulation worker processes
+    executor = None
+    workers = getattr(args, 'workers', 1)
+    if workers > 1:
+        executor = ProcessPoolExecutor(max_workers=workers, 
+                                        initializer=init_simulation_worker, 
+                                        initargs=(maze_env, config))
+
     # Create the trial simulation
     global trial_sim
     trial_sim = MazeSimulationTrial(maze_env=maze_env, 
                                     population=p,
-                                    archive=novelty_archive)
+                                    archive=novelty_archive,
+                                    executor=executor)
 
+    # Add the reporter of generations and reproduction phase durations first to not
+    # charge the output of other reporters to the reproduction phase
+    p.add_reporter(PhaseTimerReporter(trial_sim.timer))
     # Add a stdout reporter to show progress in the terminal.
     p.add_reporter(neat.StdOutReporter(True))
     stats = neat.StatisticsReporter()
@@ -206,9 +312,14 @@ def run_experiment(config_file, maze_env, novelty_archive, trial_out_dir, checkp
 
     # Run for up to N generations.
     start_time = time.time()
-    best_genome = p.run(eval_genomes, n=n_generations)
+    try:
+        best_genome = p.run(eval_genomes, n=n_generations)
+    finally:
+        if executor is not None:
+            executor.shutdown()
 
     elapsed_time = time.time() - start_time
+    timer = trial_sim.timer
 
     # Display the best genome among generations.
     print('\nBest genome:\n%s' % (best_genome))
@@ -221,48 +332,57 @@ def run_experiment(config_file, maze_env, novelty_archive, trial_out_dir, checkp
 
     # write the record store data
     rs_file = os.path.join(trial_out_dir, "data.pickle")
-    trial_sim.record_store.dump(rs_file)
+    with timer.phase(OUTPUT_PHASE):
+        trial_sim.record_store.dump(rs_file)
 
     print("Record store file: %s" % rs_file)
+    print("Novelty archive size: %d, added: %d, evicted: %d" % 
+            (len(trial_sim.archive.novel_items), trial_sim.archive.items_added, trial_sim.archive.items_evicted))
     print("Random seed:", seed)
     print("Trial elapsed time: %.3f sec" % (elapsed_time))
 
     # Visualize the experiment results
     if not silent or solution_found:
-        node_names =   {-1:'RF_R', -2:'RF_FR', -3:'RF_F', -4:'RF_FL', -5:'RF_L', -6: 'RF_B', 
-                        -7:'RAD_F', -8:'RAD_L', -9:'RAD_B', -10:'RAD_R', 
-                        0:'ANG_VEL', 1:'VEL'}
-        visualize.draw_net(config, best_genome, True, node_names=node_names, directory=trial_out_dir, fmt='svg')
-        if args is None:
-            visualize.draw_maze_records(maze_env, trial_sim.record_store.records, view=True)
-        else:
-            visualize.draw_maze_records(maze_env, trial_sim.record_store.records, 
+        with timer.phase(OUTPUT_PHASE):
+            node_names =   {-1:'RF_R', -2:'RF_FR', -3:'RF_F', -4:'RF_FL', -5:'RF_L', -6: 'RF_B', 
+                            -7:'RAD_F', -8:'RAD_L', -9:'RAD_B', -10:'RAD_R', 
+                            0:'ANG_VEL', 1:'VEL'}
+            visualize.draw_net(config, best_genome, True, node_names=node_names, directory=trial_out_dir, fmt='svg')
+            if args is None:
+                visualize.draw_maze_records(maze_env, trial_sim.record_store.records, view=True)
+            else:
+                visualize.draw_maze_records(maze_env, trial_sim.record_store.records, 
+                                            view=True, 
+                                            width=args.width,
+                                            height=args.height,
+                                            filename=os.path.join(trial_out_dir, 'maze_records.svg'))
+            visualize.plot_stats(stats, ylog=False, view=True, filename=os.path.join(trial_out_dir, 'avg_fitness.svg'))
+            visualize.plot_species(stats, view=True, filename=os.path.join(trial_out_dir, 'speciation.svg'))
+
+            # store NoveltyItems archive data
+            trial_sim.archive.write_fittest_to_file(path=os.path.join(trial_out_dir, 'ns_items_fittest.txt'))
+            trial_sim.archive.write_to_file(path=os.path.join(trial_out_dir, 'ns_items_all.txt'))
+
+            # create the best genome simulation path and render
+            maze_env = trial_sim.orig_maze_environment.spawn_agent()
+            control_net = CompiledNetwork.create(best_genome, config)
+            path_points = []
+            evaluate_fitness = maze.maze_simulation_evaluate(
+                                        env=maze_env, 
+                                        net=control_net, 
+                                        time_steps=SOLVER_TIME_STEPS,
+                                        path_points=path_points)
+            print("Evaluated fitness of best agent: %f" % evaluate_fitness)
+            visualize.draw_agent_path(trial_sim.orig_maze_environment, path_points, best_genome,
                                         view=True, 
                                         width=args.width,
                                         height=args.height,
-                                        filename=os.path.join(trial_out_dir, 'maze_records.svg'))
-        visualize.plot_stats(stats, ylog=False, view=True, filename=os.path.join(trial_out_dir, 'avg_fitness.svg'))
-        visualize.plot_species(stats, view=True, filename=os.path.join(trial_out_dir, 'speciation.svg'))
-
-        # store NoveltyItems archive data
-        trial_sim.archive.write_fittest_to_file(path=os.path.join(trial_out_dir, 'ns_items_fittest.txt'))
-        trial_sim.archive.write_to_file(path=os.path.join(trial_out_dir, 'ns_items_all.txt'))
-
-        # create the best genome simulation path and render
-        maze_env = copy.deepcopy(trial_sim.orig_maze_environment)
-        control_net = neat.nn.FeedForwardNetwork.create(best_genome, config)
-        path_points = []
-        evaluate_fitness = maze.maze_simulation_evaluate(
-                                    env=maze_env, 
-                                    net=control_net, 
-                                    time_steps=SOLVER_TIME_STEPS,
-                                    path_points=path_points)
-        print("Evaluated fitness of best agent: %f" % evaluate_fitness)
-        visualize.draw_agent_path(trial_sim.orig_maze_environment, path_points, best_genome,
-                                    view=True, 
-                                    width=args.width,
-                                    height=args.height,
-                                    filename=os.path.join(trial_out_dir, 'best_solver_path.svg'))
+                                        filename=os.path.join(trial_out_dir, 'best_solver_path.svg'))
+
+    # Report durations and counts of trial phases
+    timer.print_statistics()
+    timer.write_json(os.path.join(trial_out_dir, 'phases.json'))
+    timer.write_csv(os.path.join(trial_out_dir, 'phases.csv'))
 
     return solution_found
 
@@ -277,6 +397,16 @@ if __name__ == '__main__':
                         help="The novelty threshold value for the archive of NoveltyItems.")
     parser.add_argument('-r', '--location_sample_rate', type=int, default=40,
                         help="The sample rate of agent position points saving during simulation steps.")
+    parser.add_argument('--archive_size', type=int, default=None,
+                        help="The maximal number of items in the novelty archive (None - not bounded).")
+    parser.add_argument('--archive_eviction', default='oldest', choices=archive.EvictionPolicies,
+                        help="The policy to select the item evicted from the full novelty archive.")
+    parser.add_argument('--fittest_size', type=int, default=archive.FittestAllowedSize,
+                        help="The number of NoveltyItems of the fittest genomes to keep.")
+    parser.add_argument('--knn_index', default='kdtree', choices=['linear', 'kdtree', 'approximate'],
+                        help="The nearest neighbors index to use for novelty scores estimation.")
+    parser.add_argument('-w', '--workers', type=int, default=1,
+                        help="The number of worker processes to simulate genomes.")
     parser.add_argument('--width', type=int, default=400, help='The width of the records subplot')
     parser.add_argument('--height', type=int, default=400, help='The height of the records subplot')
     parser.add_argument('--checkpoint', type=str, default=None, help="The name of checkpoint to start from")
@@ -301,9 +431,19 @@ if __name__ == '__main__':
     maze_env = maze.read_environment(maze_env_config)
     maze_env.location_sample_rate = args.location_sample_rate
 
+    # Create the nearest neighbors index over archived items
+    knn_index = None
+    if args.knn_index != 'linear':
+        knn_index = archive.KDTreeIndex(p=2, approximate=(args.knn_index == 'approximate'))
+
     # Create novelty archive
     novelty_archive = archive.NoveltyArchive(threshold=args.ns_threshold,
-                                        metric=maze.maze_novelty_metric_euclidean)
+                                        metric=maze.maze_novelty_metric_euclidean,
+                                        knn_index=knn_index,
+                                        batch_metric=maze.maze_novelty_metric_euclidean_batch,
+                                        max_size=args.archive_size,
+                                        eviction=args.archive_eviction,
+                                        fittest_size=args.fittest_size)
 
     print("Starting the %s maze experiment (Novelty Search)" % args.maze)
     run_experiment( config_file=config_path, 
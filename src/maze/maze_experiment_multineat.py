@@ -9,7 +9,6 @@ import shutil
 import math
 import random
 import time
-import copy
 import argparse
 import pickle
 
@@ -26,6 +25,10 @@ import maze.maze_environment as maze
 import maze.agent as agent
 import maze.novelty_archive as archive
 
+from experiment import GenomeListEvaluator
+from experiment import prune_multineat_network
+from experiment import PhaseTimer, OUTPUT_PHASE
+
 # The current working directory
 local_dir = os.path.dirname(__file__)
 # The directory to store outputs
@@ -69,13 +72,15 @@ class MazeSimulationTrial:
     """
     The class to hold maze simulator execution parameters and results.
     """
-    def __init__(self, maze_env, population, archive):
+    def __init__(self, maze_env, population, archive, evaluator, timer):
         """
         Creates new instance and initialize fileds.
         Arguments:
             maze_env:   The maze environment as loaded from configuration file.
             population: The population for this trial run
             archive:    The archive to hold NoveltyItems
+            evaluator:  The GenomeListEvaluator to run simulation of genomes
+            timer:      The PhaseTimer to collect phases durations and counts of the trial
         """
         # The initial maze simulation environment
         self.orig_maze_environment = maze_env
@@ -85,46 +90,83 @@ class MazeSimulationTrial:
         self.population = population
         # The NoveltyItem archive
         self.archive = archive
+        # The evaluator running simulation of genomes
+        self.evaluator = evaluator
+        # The timers and counters of trial phases
+        self.timer = timer
+
+# The maze environment of the simulation worker process
+worker_maze_env = None
 
-def eval_individual(genome_id, genome, genomes, n_items_map, generation):
+def init_simulation_worker(maze_env):
+    """
+    The function to initialize the simulation worker process with the maze
+    environment shared by all its tasks.
+    Arguments:
+        maze_env:   The maze environment as loaded from configuration file.
+    """
+    global worker_maze_env
+    worker_maze_env = maze_env
+
+def simulate_genomes(genome_list, generation, timer=None):
+    """
+    The function to run the maze simulation for each genome in the list. It doesn't
+    touch the trial state, so it can be executed by worker processes.
+    Arguments:
+        genome_list:    The list of genomes to simulate.
+        generation:     The current generation.
+        timer:          The PhaseTimer to count neurons and links removed by pruning into or None.
+    Returns:
+        The list of (NoveltyItem, AgenRecord) tuples with behaviour vectors and
+        simulation results in order of genomes.
     """
-    Evaluates the individual represented by genome.
+    results = []
+    for genome in genome_list:
+        genome_id = genome.GetID()
+        n_item = archive.NoveltyItem(generation=generation, genomeId=genome_id)
+        # run the simulation
+        maze_env = worker_maze_env.spawn_agent()
+        multi_net = NEAT.NeuralNetwork()
+        genome.BuildPhenotype(multi_net)
+        multi_net, removed_neurons, removed_links = prune_multineat_network(multi_net)
+        if timer is not None:
+            timer.count('pruned_nodes', removed_neurons)
+            timer.count('pruned_links', removed_links)
+        control_net = ANN(multi_net)
+        goal_fitness = maze.maze_simulation_evaluate(
+                                            env=maze_env, 
+                                            net=control_net, 
+                                            time_steps=SOLVER_TIME_STEPS,
+                                            n_item=n_item)
+
+        # Store simulation results into the agent record
+        record = agent.AgenRecord(generation=generation, agent_id=genome_id)
+        record.fitness = goal_fitness
+        record.x = maze_env.agent.location.x
+        record.y = maze_env.agent.location.y
+        record.hit_exit = maze_env.exit_found
+        results.append((n_item, record))
+
+    return results
+
+def eval_individual(genome, genomes, n_items_map, record):
+    """
+    Evaluates the individual represented by genome using results of its maze simulation.
     Arguments:
-        genome_id:      The ID of genome.
         genome:         The genome to evaluate.
         genomes:        The genomes population for current generation.
         n_items_map:    The map to hold novelty items for current generation.
-        generation:     The current generation.
+        record:         The AgenRecord with results of genome's maze simulation.
     Return:
         The True if successful solver found.
     """
-    # create NoveltyItem for genome and store it into map
-    n_item = archive.NoveltyItem(generation=generation, genomeId=genome_id)
-    n_items_map[genome_id] = n_item
-    # run the simulation
-    maze_env = copy.deepcopy(trial_sim.orig_maze_environment)
-    multi_net = NEAT.NeuralNetwork()
-    genome.BuildPhenotype(multi_net)
-    control_net = ANN(multi_net)
-    goal_fitness = maze.maze_simulation_evaluate(
-                                        env=maze_env, 
-                                        net=control_net, 
-                                        time_steps=SOLVER_TIME_STEPS,
-                                        n_item=n_item)
-
-    # Store simulation results into the agent record
-    record = agent.AgenRecord(generation=generation, agent_id=genome_id)
-    record.fitness = goal_fitness
-    record.x = maze_env.agent.location.x
-    record.y = maze_env.agent.location.y
-    record.hit_exit = maze_env.exit_found
     #record.species_id = trial_sim.population.species.get_species_id(genome_id)
     #record.species_age = record.generation - trial_sim.population.species.get_species(genome_id).created
     # add record to the store
     trial_sim.record_store.add_record(record)
 
     # Evaluate the novelty of a genome and add the novelty item to the archive of Novelty items if appropriate
-    if not maze_env.exit_found:
+    if not record.hit_exit:
         # evaluate genome novelty and add it to the archive if appropriate
         record.novelty = trial_sim.archive.evaluate_individual_novelty(genome=Genome(genome), 
                                                                         genomes=genomes, n_items_map=n_items_map)
@@ -132,37 +174,43 @@ def eval_individual(genome_id, genome, genomes, n_items_map, generation):
     # update fittest organisms list
     trial_sim.archive.update_fittest_with_genome(genome=Genome(genome), n_items_map=n_items_map)
 
-    return (maze_env.exit_found, goal_fitness)
+    return (record.hit_exit, record.fitness)
 
 def eval_genomes(genomes, generation):
-    n_items_map = {} # The map to hold the novelty items for current generation
-    solver_genome = None
-    best_genome = None
-    max_fitness = 0
-    for _, genome in genomes:
-        found, goal_fitness = eval_individual(genome_id=genome.GetID(), 
-                                                genome=genome, 
-                                                genomes=genomes, 
-                                                n_items_map=n_items_map, 
-                                                generation=generation)
-        if found:
-            solver_genome = genome
-            max_fitness = goal_fitness
-        elif goal_fitness > max_fitness:
-            max_fitness = goal_fitness
-            best_genome = genome
-
-    # now adjust the archive settings and evaluate population
-    trial_sim.archive.end_of_generation()
-    for _, genome in genomes:
-        # set fitness value as a logarithm of a novelty score of a genome in the population
-        fitness = trial_sim.archive.evaluate_individual_novelty(genome=Genome(genome),
-                                                                genomes=genomes,
-                                                                n_items_map=n_items_map,
-                                                                only_fitness=True)
-
-        # assign the adjusted fitness score to the genome
-        genome.SetFitness(fitness)
+    # run the simulation of genomes, which is executed by the worker processes if available
+    timer = trial_sim.timer
+    with timer.phase('simulation'):
+        results = trial_sim.evaluator.evaluate([genome for _, genome in genomes], generation)
+    timer.count('evaluated_genomes', len(genomes))
+
+    with timer.phase('novelty'):
+        n_items_map = {} # The map to hold the novelty items for current generation
+        for (genome_id, _), (n_item, _) in zip(genomes, results):
+            n_items_map[genome_id] = n_item
+
+        # merge simulation results into the trial state in order of genomes
+        solver_genome = None
+        best_genome = None
+        max_fitness = 0
+        for (_, genome), (_, record) in zip(genomes, results):
+            found, goal_fitness = eval_individual(genome=genome, 
+                                                    genomes=genomes, 
+                                                    n_items_map=n_items_map, 
+                                                    record=record)
+            if found:
+                solver_genome = genome
+                max_fitness = goal_fitness
+            elif goal_fitness > max_fitness:
+                max_fitness = goal_fitness
+                best_genome = genome
+
+        # now adjust the archive settings and evaluate population
+        trial_sim.archive.end_of_generation()
+        novelty_scores = trial_sim.archive.evaluate_population_novelty(genomes=genomes, n_items_map=n_items_map)
+        for (_, genome), fitness in zip(genomes, novelty_scores):
+            # set fitness value as a logarithm of a novelty score of a genome in the population
+            # assign the adjusted fitness score to the genome
+            genome.SetFitness(fitness)
 
     if solver_genome is not None:
         return (solver_genome, True, max_fitness)
@@ -196,9 +244,19 @@ def run_experiment(params, maze_env, novelty_archive, trial_out_dir, args=None,
                         NEAT.ActivationFunction.UNSIGNED_SIGMOID, 0, params, 0)
     pop = NEAT.Population(genome, params, True, 1.0, seed)  
 
+    # Create the evaluator to run simulation of genomes
+    timer = PhaseTimer()
+    workers = getattr(args, 'workers', 1)
+    evaluator = GenomeListEvaluator(simulate_genomes, 
+                                    workers=workers, 
+                                    initializer=init_simulation_worker, 
+                                    initargs=(maze_env,),
+                                    timer=timer)
+
     # Create the trial simulation
     global trial_sim
-    trial_sim = MazeSimulationTrial(maze_env=maze_env, population=pop, archive=novelty_archive)
+    trial_sim = MazeSimulationTrial(maze_env=maze_env, population=pop, archive=novelty_archive, evaluator=evaluator,
+                                    timer=timer)
 
     # Run for up to N generations.
     start_time = time.time()
@@ -208,6 +266,7 @@ def run_experiment(params, maze_env, novelty_archive, trial_out_dir, args=None,
     solution_found = False
 
     for generation in range(n_generations):
+        timer.start_generation()
         gen_time = time.time()
         # get list of current genomes
         genomes = NEAT.GetGenomeList(pop)
@@ -229,7 +288,8 @@ def run_experiment(params, maze_env, novelty_archive, trial_out_dir, args=None,
             break
 
         # advance to the next generation
-        pop.Epoch()
+        with timer.phase('reproduction'):
+            pop.Epoch()
 
         # print statistics
         gen_elapsed_time = time.time() - gen_time
@@ -240,20 +300,24 @@ def run_experiment(params, maze_env, novelty_archive, trial_out_dir, args=None,
         print("Best objective fitness ever: %f, genome ID: %d" % (best_ever_goal_fitness, best_id))
         print("Best novelty score: %f, genome ID: %d\n" % (pop.GetBestFitnessEver(), pop.GetBestGenome().GetID()))
 
+    evaluator.close()
     elapsed_time = time.time() - start_time
 
     best_genome = pickle.loads(best_genome_ser)
 
-    # write best genome to the file
-    best_genome_file = os.path.join(trial_out_dir, "best_genome.pickle")
-    with open(best_genome_file, 'wb') as genome_file:
-        pickle.dump(best_genome, genome_file)
+    with timer.phase(OUTPUT_PHASE):
+        # write best genome to the file
+        best_genome_file = os.path.join(trial_out_dir, "best_genome.pickle")
+        with open(best_genome_file, 'wb') as genome_file:
+            pickle.dump(best_genome, genome_file)
 
-    # write the record store data
-    rs_file = os.path.join(trial_out_dir, "data.pickle")
-    trial_sim.record_store.dump(rs_file)
+        # write the record store data
+        rs_file = os.path.join(trial_out_dir, "data.pickle")
+        trial_sim.record_store.dump(rs_file)
 
     print("Record store file: %s" % rs_file)
+    print("Novelty archive size: %d, added: %d, evicted: %d" % 
+            (len(trial_sim.archive.novel_items), trial_sim.archive.items_added, trial_sim.archive.items_evicted))
     print("Random seed:", seed)
     print("Trial elapsed time: %.3f sec" % (elapsed_time))
     print("Best objective fitness: %f, genome ID: %d" % (best_ever_goal_fitness, best_genome.GetID()))
@@ -261,37 +325,44 @@ def run_experiment(params, maze_env, novelty_archive, trial_out_dir, args=None,
 
     # Visualize the experiment results
     if not silent or solution_found:
-        """
-        if args is None:
-            visualize.draw_maze_records(maze_env, trial_sim.record_store.records, view=True)
-        else:
-            visualize.draw_maze_records(maze_env, trial_sim.record_store.records, 
+        with timer.phase(OUTPUT_PHASE):
+            """
+            if args is None:
+                visualize.draw_maze_records(maze_env, trial_sim.record_store.records, view=True)
+            else:
+                visualize.draw_maze_records(maze_env, trial_sim.record_store.records, 
+                                            view=True, 
+                                            width=args.width,
+                                            height=args.height,
+                                            filename=os.path.join(trial_out_dir, 'maze_records.svg'))
+            """
+            # store NoveltyItems archive data
+            trial_sim.archive.write_fittest_to_file(path=os.path.join(trial_out_dir, 'ns_items_fittest.txt'))
+            trial_sim.archive.write_to_file(path=os.path.join(trial_out_dir, 'ns_items_all.txt'))
+
+            # create the best genome simulation path and render
+            maze_env = trial_sim.orig_maze_environment.spawn_agent()
+            multi_net = NEAT.NeuralNetwork()
+            best_genome.BuildPhenotype(multi_net)
+            control_net = ANN(multi_net)
+            path_points = []
+            evaluate_fitness = maze.maze_simulation_evaluate(
+                                        env=maze_env, 
+                                        net=control_net, 
+                                        time_steps=SOLVER_TIME_STEPS,
+                                        path_points=path_points)
+            print("Evaluated fitness: %f, of best agent ID: %d" % (evaluate_fitness, best_genome.GetID()))
+            visualize.draw_agent_path(trial_sim.orig_maze_environment, path_points, Genome(best_genome),
                                         view=True, 
                                         width=args.width,
                                         height=args.height,
-                                        filename=os.path.join(trial_out_dir, 'maze_records.svg'))
-        """
-        # store NoveltyItems archive data
-        trial_sim.archive.write_fittest_to_file(path=os.path.join(trial_out_dir, 'ns_items_fittest.txt'))
-        trial_sim.archive.write_to_file(path=os.path.join(trial_out_dir, 'ns_items_all.txt'))
+                                        filename=os.path.join(trial_out_dir, 'best_solver_path.svg'))
+
+    # Report durations and counts of trial phases
+    timer.print_statistics()
+    timer.write_json(os.path.join(trial_out_dir, 'phases.json'))
+    timer.write_csv(os.path.join(trial_out_dir, 'phases.csv'))
 
-        # create the best genome simulation path and render
-        maze_env = copy.deepcopy(trial_sim.orig_maze_environment)
-        multi_net = NEAT.NeuralNetwork()
-        best_genome.BuildPhenotype(multi_net)
-        control_net = ANN(multi_net)
-        path_points = []
-        evaluate_fitness = maze.maze_simulation_evaluate(
-                                    env=maze_env, 
-                                    net=control_net, 
-                                    time_steps=SOLVER_TIME_STEPS,
-                                    path_points=path_points)
-        print("Evaluated fitness: %f, of best agent ID: %d" % (evaluate_fitness, best_genome.GetID()))
-        visualize.draw_agent_path(trial_sim.orig_maze_environment, path_points, Genome(best_genome),
-                                    view=True, 
-                                    width=args.width,
-                                    height=args.height,
-                                    filename=os.path.join(trial_out_dir, 'best_solver_path.svg'))
 
 def create_params():
     params = NEAT.Parameters()
@@ -349,6 +420,16 @@ if __name__ == '__main__':
                         help="The novelty threshold value for the archive of NoveltyItems.")
     parser.add_argument('-r', '--location_sample_rate', type=int, default=40,
                         help="The sample rate of agent position points saving during simulation steps.")
+    parser.add_argument('--archive_size', type=int, default=None,
+                        help="The maximal number of items in the novelty archive (None - not bounded).")
+    parser.add_argument('--archive_eviction', default='oldest', choices=archive.EvictionPolicies,
+                        help="The policy to select the item evicted from the full novelty archive.")
+    parser.add_argument('--fittest_size', type=int, default=archive.FittestAllowedSize,
+                        help="The number of NoveltyItems of the fittest genomes to keep.")
+    parser.add_argument('--knn_index', default='kdtree', choices=['linear', 'kdtree', 'approximate'],
+                        help="The nearest neighbors index to use for novelty scores estimation.")
+    parser.add_argument('-w', '--workers', type=int, default=1,
+                        help="The number of worker processes to simulate genomes.")
     parser.add_argument('--width', type=int, default=400, help='The width of the records subplot')
     parser.add_argument('--height', type=int, default=400, help='The height of the records subplot')
     args = parser.parse_args()
@@ -367,9 +448,19 @@ if __name__ == '__main__':
     maze_env = maze.read_environment(maze_env_config)
     maze_env.location_sample_rate = args.location_sample_rate
 
+    # Create the nearest neighbors index over archived items
+    knn_index = None
+    if args.knn_index != 'linear':
+        knn_index = archive.KDTreeIndex(p=2, approximate=(args.knn_index == 'approximate'))
+
     # Create novelty archive
     novelty_archive = archive.NoveltyArchive(threshold=args.ns_threshold,
-                                        metric=maze.maze_novelty_metric_euclidean)
+                                        metric=maze.maze_novelty_metric_euclidean,
+                                        knn_index=knn_index,
+                                        batch_metric=maze.maze_novelty_metric_euclidean_batch,
+                                        max_size=args.archive_size,
+                                        eviction=args.archive_eviction,
+                                        fittest_size=args.fittest_size)
 
     print("Starting the %s maze experiment (Novelty Search) with MultiNEAT" % args.maze)
     run_experiment( params=create_params(),
@@ -2,14 +2,22 @@
 # The script providing implementation of structures and functions used in 
 # the Novelty Search method.
 #
+import heapq
+import random
 from functools import total_ordering
 
+import numpy as np
+
 # how many nearest neighbors to consider for calculating novelty score?
 KNNNoveltyScore = 15
 # The maximal allowed size for fittest items list
 FittestAllowedSize = 5
 # The minimal number of items to include in the archive unconditionaly
 ArchiveSeedAmount = 1
+# The policies to select the item evicted from the archive of bounded size:
+# 'oldest' - the earliest added item, 'least_novel' - the item closest to its nearest
+# neighbor in the archive, 'reservoir' - the random item selected by reservoir sampling
+EvictionPolicies = ('oldest', 'least_novel', 'reservoir')
 
 @total_ordering
 class NoveltyItem:
@@ -99,16 +107,39 @@ class NoveltyArchive:
     """
     The novelty archive contains all of the novel items we have encountered thus far.
     """
-    def __init__(self, threshold, metric):
+    def __init__(self, threshold, metric, knn_index=None, batch_metric=None, max_size=None, eviction='oldest', seed=None,
+                fittest_size=FittestAllowedSize):
         """
         Creates new instance with specified novelty threshold and function
         defined novelty metric.
         Arguments:
-            threshold:  The minimal novelty score of the item to be included into this archive.
-            metric:     The function to calculate the novelty score of specific genome.
+            threshold:      The minimal novelty score of the item to be included into this archive.
+            metric:         The function to calculate the novelty score of specific genome.
+            knn_index:      The nearest neighbors index over archived items (e.g. KDTreeIndex) or None
+                            to map the novelty metric across all archived items.
+            batch_metric:   The function to calculate the matrix of novelty metric values between
+                            two arrays of data vectors, which is the vectorized counterpart of
+                            the metric function, or None if not available.
+            max_size:       The maximal number of items in the archive or None if not bounded.
+            eviction:       The policy to select the item evicted when the archive is full
+                            (one of EvictionPolicies).
+            seed:           The seed of random numbers generator used by the 'reservoir' policy or
+                            None to use the global generator of the random module.
+            fittest_size:   The maximal number of items related to the fittest genomes to keep.
         """
+        if eviction not in EvictionPolicies:
+            raise ValueError("Unknown eviction policy: %s" % eviction)
         self.novelty_metric = metric
+        self.batch_novelty_metric = batch_metric
         self.novelty_threshold = threshold
+        # the nearest neighbors index over novel items
+        self.knn_index = knn_index
+        # the nearest neighbors index over current population items and related genomes list
+        self._population_index = None
+        self._population_genomes = None
+        # the distances between current population items and archived items and related genomes list
+        self._context = None
+        self._context_genomes = None
 
         # the minimal possible value of novelty threshold
         self.novelty_floor = 0.25
@@ -123,11 +154,28 @@ class NoveltyArchive:
         # the current evolutionary generation
         self.generation = 0
 
+        # the maximal size of the archive and the eviction policy
+        self.max_size = max_size
+        self.eviction = eviction
+        self._random = random.Random(seed) if seed is not None else random
+        # the total number of items added to and evicted from the archive
+        self.items_added = 0
+        self.items_evicted = 0
+        # the distance from each archived item to its nearest neighbor in the archive and
+        # that neighbor, which are maintained incrementally for the 'least_novel' policy
+        self._track_nearest = max_size is not None and eviction == 'least_novel'
+        self._nn_distances = np.zeros(0)
+        self._nn_items = []
+        # the data vectors of archived items compared with the batch metric or None if 
+        # the batch metric is not available or the items have different dimensions
+        self._nn_data = None
+        self._nn_batch = batch_metric is not None
+
         # list with all novel items found so far
         self.novel_items = []
-        # list with all novel items found that is related to the fittest 
+        # the top of novel items found that is related to the fittest 
         # genomes (using the goal-oriented fitness score)
-        self.fittest_items = []
+        self.fittest_items = FittestItems(capacity=fittest_size)
 
     def evaluate_individual_novelty(self, genome, genomes, n_items_map, only_fitness=False):
         """
@@ -159,7 +207,11 @@ class NoveltyArchive:
             result = self._novelty_avg_knn(item=item, genomes=genomes, n_items_map=n_items_map)
         else:
             # consider adding a NoveltyItem to the archive based on the distance to a closest neighbor
-            result = self._novelty_avg_knn(item=item, neighbors=1, n_items_map=n_items_map)
+            context = self._novelty_context(genomes, n_items_map)
+            if context is not None and item in context:
+                result = context.nearest_archived_distance(item)
+            else:
+                result = self._novelty_avg_knn(item=item, neighbors=1, n_items_map=n_items_map)
             if result > self.novelty_threshold or len(self.novel_items) < ArchiveSeedAmount:
                 print("Novelty: %f, threshold: %f" % (result, self.novelty_threshold))
                 self._add_novelty_item(item)
@@ -170,6 +222,83 @@ class NoveltyArchive:
 
         return result
     
+    def evaluate_population_novelty(self, genomes, n_items_map):
+        """
+        The function to evaluate the novelty scores of all genomes within population
+        to be used as their fitness values. It is the batch counterpart of
+        evaluate_individual_novelty with only_fitness=True, which computes the novelty
+        metric between population items and archived items with the batch metric
+        function in one call or reuses the distances already calculated for this population
+        by evaluate_individual_novelty.
+        Arguments:
+            genomes:        The current population of genomes as the list of (genome_id, genome) tuples
+            n_items_map:    The map of novelty items for the current population by genome ID
+        Returns:
+            The list of calculated novelty scores in order of genomes.
+        """
+        scores = [None] * len(genomes)
+        items = [n_items_map.get(genome_id) for genome_id, _ in genomes]
+        dims = set(len(item.data) for item in items if item is not None)
+        dims.update(len(item.data) for item in self.novel_items)
+        if self.batch_novelty_metric is None or len(dims) > 1:
+            # the data vectors can not be stacked - evaluate one by one
+            for i, item in enumerate(items):
+                if item is not None:
+                    scores[i] = self._evaluate_item_fitness(item, genomes, n_items_map)
+            return scores
+
+        if self._context is not None and self._context_genomes is genomes:
+            # reuse distances calculated for this population
+            density = self._context.knn_average_distance(k=self.neighbors)
+        else:
+            # stack data vectors of population and archive
+            population_data = np.array([item.data for item in items if item is not None], dtype=float)
+            archive_data = np.array([item.data for item in self.novel_items], dtype=float)
+            archive_data = archive_data.reshape(len(self.novel_items), population_data.shape[1])
+            density = knn_average_distance(population_data, np.vstack((archive_data, population_data)),
+                                            k=self.neighbors, metric=self.batch_novelty_metric)
+        # the distances are not needed anymore
+        self._context = None
+        self._context_genomes = None
+
+        j = 0
+        for i, (genome_id, _) in enumerate(genomes):
+            item = items[i]
+            if item is None:
+                print("WARNING! Found Genome without novelty point associated: %s" % genome_id +
+                    "\nNovelty evaluation will be skipped for it. Probably winner found!")
+                continue
+            scores[i] = -1.0
+            if item.fitness != -1.0:
+                # store found values to the novelty item
+                scores[i] = float(density[j])
+                item.novelty = scores[i]
+                item.generation = self.generation
+            j += 1
+
+        return scores
+
+    def _evaluate_item_fitness(self, item, genomes, n_items_map):
+        """
+        The function to evaluate the novelty score of a single item within
+        population to be used as fitness value.
+        Arguments:
+            item:           The NoveltyItem to evaluate
+            genomes:        The current population of genomes
+            n_items_map:    The map of novelty items for the current population by genome ID
+        Returns:
+            The calculated novelty score for the item.
+        """
+        # Check if individual was marked for extinction due to failure to meet minimal fitness criterion
+        if item.fitness == -1.0:
+            return -1.0
+
+        result = self._novelty_avg_knn(item=item, genomes=genomes, n_items_map=n_items_map)
+        # store found values to the novelty item
+        item.novelty = result
+        item.generation = self.generation
+        return result
+
     def update_fittest_with_genome(self, genome, n_items_map):
         """
         The function to update list of NovelItems for the genomes with the higher
@@ -181,20 +310,7 @@ class NoveltyArchive:
         assert genome.key in n_items_map
         item = n_items_map[genome.key]
 
-        if len(self.fittest_items) < FittestAllowedSize:
-            # store novelty item into fittest
-            self.fittest_items.append(item)
-            # sort in descending order by fitness
-            self.fittest_items.sort(reverse=True)
-        else:
-            last_item = self.fittest_items[-1]
-            if item.fitness > last_item.fitness:
-                # store novelty item into fittest
-                self.fittest_items.append(item)
-                # sort in descending order by fitness
-                self.fittest_items.sort(reverse=True)
-                # remove the less fit item
-                del self.fittest_items[-1]
+        self.fittest_items.push(item)
 
     def end_of_generation(self):
         """
@@ -235,6 +351,139 @@ class NoveltyArchive:
         item.generation = self.generation
         self.novel_items.append(item)
         self.items_added_in_generation += 1
+        self.items_added += 1
+        if self.knn_index is not None:
+            self.knn_index.add(item)
+        if self._context is not None and not self._context.add_to_archive(item):
+            # the item is not from the population of the context
+            self._context = None
+            self._context_genomes = None
+        if self._track_nearest:
+            self._add_nearest_neighbor(item)
+
+        if self.max_size is not None and len(self.novel_items) > self.max_size:
+            self._evict_item(self._select_evicted_index())
+
+    def _select_evicted_index(self):
+        """
+        The function to select the item to be evicted from the full archive according to
+        the eviction policy.
+        Returns:
+            The index of the item in the list of novel items.
+        """
+        if self.eviction == 'reservoir':
+            # keep the new item with probability max_size / items_added replacing random old one
+            r = self._random.randrange(self.items_added)
+            return r if r < self.max_size else len(self.novel_items) - 1
+        elif self.eviction == 'least_novel':
+            # the item closest to its nearest neighbor in the archive, the ties
+            # are resolved in favor of the oldest item
+            return int(np.argmin(self._nn_distances))
+        # the oldest item
+        return 0
+
+    def _evict_item(self, index):
+        """
+        The function to remove the item from this archive.
+        Arguments:
+            index: The index of the item in the list of novel items.
+        """
+        item = self.novel_items.pop(index)
+        item.in_archive = False
+        self.items_evicted += 1
+        if self.knn_index is not None:
+            self.knn_index.remove(item)
+        if self._context is not None and not self._context.remove_from_archive(item):
+            self._context = None
+            self._context_genomes = None
+        if self._track_nearest:
+            self._remove_nearest_neighbor(index, item)
+
+    def _add_nearest_neighbor(self, item):
+        """
+        The function to update the nearest neighbors of archived items with the item
+        just appended to the archive and to find the nearest neighbor of that item.
+        Arguments:
+            item: The NoveltyItem appended to the archive.
+        """
+        vector = np.array([item.data], dtype=float)
+        if self._nn_data is not None and self._nn_data.shape[1] != vector.shape[1]:
+            # the items of different dimensions are compared with the novelty metric
+            self._nn_batch = False
+            self._nn_data = None
+        if self._nn_batch:
+            self._nn_data = vector if self._nn_data is None else np.vstack((self._nn_data, vector))
+
+        distances = self._distances_to(len(self.novel_items) - 1)[:-1]
+        nearest_distance, nearest_item = np.inf, None
+        if len(distances) > 0:
+            closer = np.flatnonzero(distances < self._nn_distances)
+            self._nn_distances[closer] = distances[closer]
+            for j in closer:
+                self._nn_items[j] = item
+            nearest = int(np.argmin(distances))
+            nearest_distance, nearest_item = distances[nearest], self.novel_items[nearest]
+        self._nn_distances = np.append(self._nn_distances, nearest_distance)
+        self._nn_items.append(nearest_item)
+
+    def _remove_nearest_neighbor(self, index, item):
+        """
+        The function to update the nearest neighbors of archived items after the item
+        was evicted. Only the items which nearest neighbor was evicted are recalculated.
+        Arguments:
+            index:  The index of evicted item in the list of novel items.
+            item:   The evicted NoveltyItem.
+        """
+        self._nn_distances = np.delete(self._nn_distances, index)
+        del self._nn_items[index]
+        if self._nn_data is not None:
+            self._nn_data = np.delete(self._nn_data, index, axis=0)
+        for j, neighbor in enumerate(self._nn_items):
+            if neighbor is not item:
+                continue
+            distances = self._distances_to(j)
+            distances[j] = np.inf
+            nearest = int(np.argmin(distances))
+            self._nn_distances[j] = distances[nearest]
+            self._nn_items[j] = self.novel_items[nearest] if np.isfinite(distances[nearest]) else None
+
+    def _distances_to(self, index):
+        """
+        The function to calculate the novelty metric values between the archived item
+        and each of archived items.
+        Arguments:
+            index: The index of the item in the list of novel items.
+        Returns:
+            The array of distances in order of novel items.
+        """
+        if self._nn_data is not None:
+            return self.batch_novelty_metric(self._nn_data[index:index + 1], self._nn_data)[0]
+        item = self.novel_items[index]
+        return np.array([self.novelty_metric(item, n) for n in self.novel_items], dtype=float)
+
+    def _novelty_context(self, genomes, n_items_map):
+        """
+        The function to get the distances between the items of the current population and 
+        the archived items, which are calculated once per population.
+        Arguments:
+            genomes:     The list of genomes from current population.
+            n_items_map: The map of novelty items for the current population by genome ID.
+        Returns:
+            The NoveltyContext or None if distances can not be calculated with the batch metric.
+        """
+        if self._context_genomes is genomes:
+            return self._context
+
+        self._context = None
+        self._context_genomes = genomes
+        if self.batch_novelty_metric is None:
+            return None
+        items = [n_items_map[genome_id] for genome_id, _ in genomes if genome_id in n_items_map]
+        dims = set(len(item.data) for item in items)
+        dims.update(len(item.data) for item in self.novel_items)
+        if len(items) > 0 and len(dims) == 1:
+            self._context = NoveltyContext(self.novel_items, items, self.batch_novelty_metric)
+        return self._context
 
     def _adjust_archive_settings(self):
         """
@@ -305,6 +554,39 @@ class NoveltyArchive:
 
         return distances
 
+    def _map_novelty_knn(self, item, neighbors, genomes, n_items_map):
+        """
+        The function to map the novelty metric against provided item only for its nearest 
+        neighbors found with the nearest neighbors index among the archived items and
+        the current population items if provided.
+        Arguments:
+            item:        The NoveltyItem to be used for mapping.
+            neighbors:   The number of nearest neighbors to find.
+            genomes:     The list of genomes from current population or None.
+            n_items_map: The map of novelty items for the current population by genome ID.
+        Returns:
+            The list with distances (novelty scores) of provided item from its nearest neighbors.
+        """
+        candidates = self.knn_index.knn(item, neighbors)
+        if genomes is not None:
+            if self._population_genomes is not genomes:
+                # build index over the population items once per population
+                self._population_index = self.knn_index.new_index()
+                for genome_id, _ in genomes:
+                    if genome_id in n_items_map:
+                        self._population_index.add(n_items_map[genome_id])
+                self._population_genomes = genomes
+            candidates += self._population_index.knn(item, neighbors)
+
+        distances = [None] * len(candidates)
+        for i, n in enumerate(candidates):
+            distances[i] = ItemsDistance(
+                first_item = n,
+                second_item = item,
+                distance = self.novelty_metric(n, item))
+
+        return distances
+
     def _novelty_avg_knn(self, item, n_items_map, genomes=None, neighbors=None):
         """
         The function to calculate the novelty score of a given item within the provided population if any
@@ -318,17 +600,20 @@ class NoveltyArchive:
             The density within the vicinity of the provided NoveltyItem calculated using the K-nearest neighbor
             algorithm. This density can be used either as a novelty score value or as a fitness value.
         """
+        # if neighbors size not set - use value from archive parameters
+        if neighbors is None:
+            neighbors = self.neighbors
+
         distances = None
-        if genomes is not None:
+        if self.knn_index is not None:
+            distances = self._map_novelty_knn(item=item, neighbors=neighbors, genomes=genomes, n_items_map=n_items_map)
+        elif genomes is not None:
             distances = self._map_novelty_in_population(item=item, genomes=genomes, n_items_map=n_items_map)
         else:
             distances = self._map_novelty(item=item)
 
         # sort by distance (novelty) in ascending order - the minimal first
         distances.sort()
-        # if neighbors size not set - use value from archive parameters
-        if neighbors is None:
-            neighbors = self.neighbors
 
         density, weight, distance_sum = 0.0, 0.0, 0.0
         length = len(distances)
@@ -347,4 +632,429 @@ class NoveltyArchive:
             if weight > 0:
                 density = distance_sum / weight
 
-        return density
\ No newline at end of file
+        return density
+
+def knn_average_distance(data, other_data, k, metric, chunk_size=1000000):
+    """
+    The function to find for each data vector the average distance to its k nearest
+    neighbors among other data vectors.
+    Arguments:
+        data:       The array of data vectors with shape (n, d)
+        other_data: The array of data vectors to look for neighbors among with shape (m, d)
+        k:          The number of nearest neighbors to consider
+        metric:     The function to calculate the distances matrix between two arrays of data vectors
+        chunk_size: The maximal number of data values differences to be calculated at once
+    Returns:
+        The array of the average distances with shape (n,)
+    """
+    density = np.zeros(len(data))
+    k = min(k, len(other_data))
+    if k == 0:
+        return density
+
+    rows = _chunk_rows(data, other_data, chunk_size)
+    for start in range(0, len(data), rows):
+        distances = metric(data[start:start + rows], other_data)
+        density[start:start + rows] = _knn_average(distances, k)
+
+    return density
+
+def pairwise_distances(data, other_data, metric, chunk_size=1000000):
+    """
+    The function to calculate the distances matrix between two arrays of data vectors
+    in chunks of rows, so that the differences of all pairs are never held at once.
+    Arguments:
+        data:       The array of data vectors with shape (n, d)
+        other_data: The array of data vectors with shape (m, d)
+        metric:     The function to calculate the distances matrix between two arrays of data vectors
+        chunk_size: The maximal number of data values differences to be calculated at once
+    Returns:
+        The distances matrix with shape (n, m)
+    """
+    distances = np.empty((len(data), len(other_data)))
+    if len(other_data) == 0:
+        return distances
+
+    rows = _chunk_rows(data, other_data, chunk_size)
+    for start in range(0, len(data), rows):
+        distances[start:start + rows] = metric(data[start:start + rows], other_data)
+
+    return distances
+
+def _chunk_rows(data, other_data, chunk_size):
+    """
+    The function to find the number of data rows which differences with all other data
+    vectors fit into the chunk of given size.
+    """
+    return max(1, chunk_size // (max(1, len(other_data)) * max(1, data.shape[1])))
+
+def _knn_average(distances, k):
+    """
+    The function to find the average of k smallest distances in each row of distances matrix.
+    """
+    if k < distances.shape[1]:
+        distances = np.partition(distances, k - 1, axis=1)[:, :k]
+    return np.sort(distances, axis=1).sum(axis=1) / float(k)
+
+class NoveltyContext:
+    """
+    The distances between the items of current population and the archived items calculated
+    once per generation with the batch metric. They are shared by the novelty evaluation of 
+    individuals against the archive and by the novelty evaluation of population against the 
+    archive and population. The population items added to the archive during generation are 
+    tracked incrementally, since the distances to them are already known.
+    """
+    def __init__(self, archive_items, population_items, batch_metric, chunk_size=1000000):
+        """
+        Creates new context and calculates the distances.
+        Arguments:
+            archive_items:      The list of archived NoveltyItems at the start of generation.
+            population_items:   The list of NoveltyItems of population.
+            batch_metric:       The function to calculate the matrix of novelty metric values 
+                                between two arrays of data vectors.
+            chunk_size:         The maximal number of data values differences to be calculated at once
+        """
+        self.items = population_items
+        self._indices = dict((id(item), j) for j, item in enumerate(population_items))
+        self._archive_indices = dict((id(item), i) for i, item in enumerate(archive_items))
+        # the mask of archived items not evicted during generation
+        self.archived = np.ones(len(archive_items), dtype=bool)
+        data = np.array([item.data for item in population_items], dtype=float)
+        archive_data = np.array([item.data for item in archive_items], dtype=float)
+        archive_data = archive_data.reshape(len(archive_items), data.shape[1])
+        # the distances from population items to archived items with shape (P, A)
+        self.archive_distances = pairwise_distances(data, archive_data, batch_metric, chunk_size)
+        # the distances between population items with shape (P, P)
+        self.population_distances = pairwise_distances(data, data, batch_metric, chunk_size)
+        # the indices of population items added to the archive during generation
+        self.added = []
+
+    def __contains__(self, item):
+        return id(item) in self._indices
+
+    def add_to_archive(self, item):
+        """
+        The function to register the population item added to the archive.
+        Arguments:
+            item: The NoveltyItem added to the archive.
+        Returns:
+            False if the item is not from the population of this context.
+        """
+        j = self._indices.get(id(item))
+        if j is None:
+            return False
+        self.added.append(j)
+        return True
+
+    def remove_from_archive(self, item):
+        """
+        The function to register the item evicted from the archive.
+        Arguments:
+            item: The NoveltyItem evicted from the archive.
+        Returns:
+            False if the item is not known by this context.
+        """
+        i = self._archive_indices.get(id(item))
+        if i is not None:
+            self.archived[i] = False
+            return True
+        j = self._indices.get(id(item))
+        if j is not None and j in self.added:
+            self.added.remove(j)
+            return True
+        return False
+
+    def nearest_archived_distance(self, item):
+        """
+        The function to find the distance from the population item to the closest archived item.
+        Arguments:
+            item: The NoveltyItem of population.
+        Returns:
+            The distance to the closest archived item or zero if archive is empty.
+        """
+        j = self._indices[id(item)]
+        distances = np.concatenate((self.archive_distances[j, self.archived], self.population_distances[j, self.added]))
+        if len(distances) < ArchiveSeedAmount:
+            return 0.0
+        return float(distances.min())
+
+    def knn_average_distance(self, k):
+        """
+        The function to find for each population item the average distance to its k nearest
+        neighbors among archived items and population items.
+        Arguments:
+            k: The number of nearest neighbors to consider
+        Returns:
+            The array of the average distances in order of population items.
+        """
+        distances = np.hstack((self.archive_distances[:, self.archived], self.population_distances[:, self.added], 
+                                self.population_distances))
+        k = min(k, distances.shape[1])
+        if k == 0:
+            return np.zeros(len(self.items))
+        return _knn_average(distances, k)
+
+class FittestItems:
+    """
+    The bounded collection of NoveltyItems with the highest goal-oriented fitness scores.
+    The items are held in the min-heap keyed by fitness score and insertion order, so the
+    least fit item is at the top of the heap and can be replaced in O(log K) time. Among
+    items with equal fitness the earlier inserted item ranks higher. The novelty score is
+    not a part of the key, because it is updated after the item is inserted.
+    """
+    def __init__(self, capacity=FittestAllowedSize):
+        """
+        Creates new empty collection.
+        Arguments:
+            capacity: The maximal number of items to keep.
+        """
+        self.capacity = capacity
+        # the heap of (fitness, -insertion order, item) tuples
+        self._heap = []
+        # the counter of inserted items used for stable ties resolution
+        self._counter = 0
+
+    def __len__(self):
+        return len(self._heap)
+
+    def __iter__(self):
+        """
+        The function to iterate over items in descending order by fitness.
+        """
+        for entry in sorted(self._heap, reverse=True, key=lambda e: e[:2]):
+            yield entry[2]
+
+    def push(self, item):
+        """
+        The function to add NoveltyItem if it fits into collection. When collection
+        is full the item is added only if its fitness is higher than the fitness of
+        the least fit item held, which is removed.
+        Arguments:
+            item: The NoveltyItem to be added.
+        Returns:
+            True if item was added.
+        """
+        if self.capacity <= 0:
+            return False
+        entry = (item.fitness, -self._counter, item)
+        if len(self._heap) < self.capacity:
+            heapq.heappush(self._heap, entry)
+        elif item.fitness > self._heap[0][0]:
+            heapq.heapreplace(self._heap, entry)
+        else:
+            return False
+        self._counter += 1
+        return True
+
+class KDTreeIndex:
+    """
+    The nearest neighbors index over NoveltyItem data vectors based on the KD-tree.
+    The items are appended into the pending list which is scanned linearly and merged
+    into the tree when it grows large enough, thus the index can be updated incrementally.
+    The removed items are marked as tombstones skipped by search and dropped when the
+    tree is rebuilt after enough of them accumulated.
+    The tree is searched using the Minkowski distance of order p, which must rank the
+    items the same way as the novelty metric of the archive, i.e., p=2 for
+    maze_novelty_metric_euclidean and p=1 for maze_novelty_metric.
+    """
+    def __init__(self, p=2, leaf_size=16, approximate=False, epsilon=0.5, rebuild_ratio=0.25):
+        """
+        Creates new empty index.
+        Arguments:
+            p:              The order of the Minkowski distance (1 or 2).
+            leaf_size:      The maximal number of items in the tree leaf.
+            approximate:    The flag to indicate whether to use approximate search, which
+                            returns neighbors within (1 + epsilon) factor of true distance.
+            epsilon:        The approximation factor of approximate search.
+            rebuild_ratio:  The ratio of pending or removed items to the tree items which
+                            triggers the tree rebuild.
+        """
+        self.p = p
+        self.leaf_size = leaf_size
+        self.approximate = approximate
+        self.epsilon = epsilon
+        self.rebuild_ratio = rebuild_ratio
+        # the items, the flags of items not removed, and related trees by the data vectors dimension
+        self._items = {}
+        self._alive = {}
+        self._trees = {}
+        # the number of removed items by the data vectors dimension
+        self._removed = {}
+        # the index of each item in the list of items of its dimension
+        self._positions = {}
+
+    def __len__(self):
+        return sum(len(items) - self._removed[dim] for dim, items in self._items.items())
+
+    def new_index(self):
+        """
+        The function to create new empty index with the same parameters.
+        Returns:
+            The new empty KDTreeIndex
+        """
+        return KDTreeIndex(p=self.p, leaf_size=self.leaf_size, approximate=self.approximate,
+                            epsilon=self.epsilon, rebuild_ratio=self.rebuild_ratio)
+
+    def add(self, item):
+        """
+        The function to add NoveltyItem into this index.
+        Arguments:
+            item: The NoveltyItem to be added.
+        """
+        dim = len(item.data)
+        items = self._items.setdefault(dim, [])
+        self._positions[id(item)] = len(items)
+        items.append(item)
+        self._alive.setdefault(dim, []).append(True)
+        self._removed.setdefault(dim, 0)
+
+    def remove(self, item):
+        """
+        The function to remove NoveltyItem from this index. The item is marked as removed
+        and the items of the same dimension are compacted when there are too many removed.
+        Arguments:
+            item: The NoveltyItem to be removed.
+        """
+        position = self._positions.pop(id(item), None)
+        if position is None:
+            return
+        dim = len(item.data)
+        self._alive[dim][position] = False
+        self._removed[dim] += 1
+        items = self._items[dim]
+        if self._removed[dim] > max(self.leaf_size, len(items) * self.rebuild_ratio):
+            # drop the removed items and the tree over them
+            items = [n for n, alive in zip(items, self._alive[dim]) if alive]
+            self._items[dim] = items
+            self._alive[dim] = [True] * len(items)
+            self._removed[dim] = 0
+            self._trees.pop(dim, None)
+            for i, n in enumerate(items):
+                self._positions[id(n)] = i
+
+    def knn(self, item, k):
+        """
+        The function to find the nearest neighbors of the given item.
+        Arguments:
+            item:   The NoveltyItem to find neighbors for.
+            k:      The number of neighbors to find.
+        Returns:
+            The list of k nearest NoveltyItems from this index if the data vectors 
+            dimension of the item is the same as of indexed items. The indexed items 
+            with other dimensions are returned as is.
+        """
+        dim = len(item.data)
+        found = []
+        for d, items in self._items.items():
+            if d != dim:
+                # the items which can not be compared by the tree distance
+                found.extend(n for n, alive in zip(items, self._alive[d]) if alive)
+
+        items = self._items.get(dim)
+        if items is None or k <= 0:
+            return found
+
+        tree = self._tree(dim)
+        alive = self._alive[dim]
+        query = np.asarray(item.data, dtype=float)
+        # the max-heap of (-distance, index) of the best candidates
+        best = []
+        if tree.root is not None:
+            self._search(tree, tree.root, query, k, best, alive)
+        # scan the pending items not yet included into the tree
+        for i in range(tree.size, len(items)):
+            if alive[i]:
+                distance = self._distance(np.asarray(items[i].data, dtype=float)[None, :], query)[0]
+                self._push(best, k, distance, i)
+
+        found.extend(items[i] for _, i in best)
+        return found
+
+    def _tree(self, dim):
+        """
+        The function to get the tree for items of given dimension rebuilding it if there
+        are too many pending items.
+        """
+        items = self._items[dim]
+        tree = self._trees.get(dim)
+        pending = len(items) - (tree.size if tree is not None else 0)
+        if tree is None or pending > max(self.leaf_size, tree.size * self.rebuild_ratio):
+            tree = _KDTree(np.array([i.data for i in items], dtype=float), self.leaf_size)
+            self._trees[dim] = tree
+        return tree
+
+    def _search(self, tree, node, query, k, best, alive):
+        """
+        The function to search the tree node for the nearest neighbors of the query
+        skipping the removed items.
+        """
+        if node.indices is not None:
+            # the leaf node
+            distances = self._distance(tree.points[node.indices], query)
+            for distance, i in zip(distances, node.indices):
+                if alive[i]:
+                    self._push(best, k, distance, i)
+            return
+
+        diff = query[node.axis] - node.split
+        near, far = (node.left, node.right) if diff <= 0 else (node.right, node.left)
+        self._search(tree, near, query, k, best, alive)
+        # the lower bound of distance from query to the items of the far node
+        bound = abs(diff)
+        if self.approximate:
+            bound *= 1.0 + self.epsilon
+        if len(best) < k or bound < -best[0][0]:
+            self._search(tree, far, query, k, best, alive)
+
+    def _distance(self, points, query):
+        diff = np.abs(points - query)
+        if self.p == 1:
+            return diff.sum(axis=1)
+        return np.sqrt((diff * diff).sum(axis=1))
+
+    def _push(self, best, k, distance, i):
+        if len(best) < k:
+            heapq.heappush(best, (-distance, i))
+        elif distance < -best[0][0]:
+            heapq.heapreplace(best, (-distance, i))
+
+class _KDTreeNode:
+    """
+    The node of the KD-tree. The leaf nodes hold indices of points, while the inner
+    nodes hold the splitting axis and value along with the child nodes.
+    """
+    def __init__(self, indices=None, axis=0, split=0.0, left=None, right=None):
+        self.indices = indices
+        self.axis = axis
+        self.split = split
+        self.left = left
+        self.right = right
+
+class _KDTree:
+    """
+    The static KD-tree built over the array of points.
+    """
+    def __init__(self, points, leaf_size):
+        self.points = points
+        self.size = len(points)
+        self.root = self._build(np.arange(self.size), leaf_size) if self.size > 0 else None
+
+    def _build(self, indices, leaf_size):
+        if len(indices) <= leaf_size:
+            return _KDTreeNode(indices=indices)
+
+        points = self.points[indices]
+        # split along the axis with the largest spread at the median
+        spread = points.max(axis=0) - points.min(axis=0)
+        axis = int(np.argmax(spread))
+        if spread[axis] == 0:
+            return _KDTreeNode(indices=indices)
+
+        order = np.argsort(points[:, axis], kind='stable')
+        middle = len(indices) // 2
+        split = points[order[middle - 1], axis]
+        left = indices[order[:middle]]
+        right = indices[order[middle:]]
+        return _KDTreeNode(axis=axis, split=split, 
+                            left=self._build(left, leaf_size),
+                            right=self._build(right, leaf_size))
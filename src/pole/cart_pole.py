@@ -5,6 +5,10 @@
 import math
 import random
 
+import numpy as np
+
+from utils.compiled_net import as_population
+
 #
 # The constants defining physics of cart-pole apparatus
 #
@@ -21,12 +25,14 @@ FOURTHIRDS = 4.0/3.0
 # the number seconds between state updates 
 TAU = 0.02 # sec
 
-# set random seed
-random.seed(42)
-
 # The maximal fitness score value
 MAX_FITNESS = 1.0
 
+# The minimal number of active carts to be simulated in batch. The fewer carts
+# are simulated one by one, because the overhead of vectorized operations exceeds
+# their gain for so small batches.
+MIN_BATCH_SIZE = 8
+
 def two_ouputs_action_evaluator(nn_output):
     action = 1
     if nn_output[0] > nn_output[1]:
@@ -34,6 +40,22 @@ def two_ouputs_action_evaluator(nn_output):
 
     return action
 
+def two_ouputs_action_evaluator_batch(nn_outputs):
+    """
+    The vectorized counterpart of two_ouputs_action_evaluator.
+    Arguments:
+        nn_outputs: The array of ANN outputs with shape (N, 2).
+    Returns:
+        The array of binary actions with shape (N,)
+    """
+    nn_outputs = np.asarray(nn_outputs)
+    return np.logical_not(nn_outputs[:, 0] > nn_outputs[:, 1]).astype(int)
+
+# The vectorized counterparts of action evaluators
+BATCH_ACTION_EVALUATORS = {
+    two_ouputs_action_evaluator: two_ouputs_action_evaluator_batch,
+}
+
 def do_step(action, x, x_dot, theta, theta_dot):
     """
     The function to perform the one step of simulation over
@@ -69,7 +91,141 @@ def do_step(action, x, x_dot, theta, theta_dot):
 
     return x_ret, x_dot_ret, theta_ret, theta_dot_ret
 
-def run_cart_pole_simulation(net, max_bal_steps, action_evaluator, random_start=True):
+def do_step_batch(actions, state):
+    """
+    The function to perform the one step of simulation over the batch
+    of cart-pole apparatuses at once.
+    Arguments:
+        actions:    The array with binary actions defining direction of
+                    force to be applied to each cart, shape (N,).
+        state:      The array with state variables of carts, shape (N, 4), where
+                    each row holds (x, x_dot, theta, theta_dot). The array
+                    is updated in place.
+    Returns:
+        The state array with numerically approximated values of state variables
+        after current time step (TAU)
+    """
+    x, x_dot, theta, theta_dot = state[:, 0], state[:, 1], state[:, 2], state[:, 3]
+    # Find the force direction
+    force = np.where(actions <= 0, -FORCE_MAG, FORCE_MAG)
+    # Pre-calcuate cosine and sine to optimize performance 
+    cos_theta = np.cos(theta)
+    sin_theta = np.sin(theta)
+
+    temp = (force + POLEMASS_LENGTH * theta_dot * theta_dot * sin_theta) / TOTAL_MASS
+    # The angular acceleration of the pole
+    theta_acc = (GRAVITY * sin_theta - cos_theta * temp) / (LENGTH * (FOURTHIRDS - MASSPOLE * cos_theta * cos_theta / TOTAL_MASS))
+    # The linear acceleration of the cart
+    x_acc = temp - POLEMASS_LENGTH * theta_acc * cos_theta / TOTAL_MASS
+
+    # Update the four state variables, using Euler's method. The positions
+    # must be updated before velocities as they depend on the old values.
+    x += TAU * x_dot
+    x_dot += TAU * x_acc
+    theta += TAU * theta_dot
+    theta_dot += TAU * theta_acc
+
+    return state
+
+def random_start_state(rng=None):
+    """
+    The function to generate random initial state of the cart-pole apparatus.
+    Arguments:
+        rng:    The random numbers generator or None to use the global one.
+    Returns:
+        The tuple with initial values of state variables (x, x_dot, theta, theta_dot)
+    """
+    if rng is None:
+        rng = random
+    x = (rng.random() * 4.8 - 2.4) / 2.0 # -1.4 < x < 1.4
+    x_dot = (rng.random() * 3 - 1.5) / 4.0 # -0.375 < x_dot < 0.375
+    theta = (rng.random() * 0.42 - 0.21) / 2.0 # -0.105 < theta < 0.105
+    theta_dot = (rng.random() * 4 - 2) / 4.0 # -0.5 < theta_dot < 0.5
+    return x, x_dot, theta, theta_dot
+
+class CycleDetector:
+    """
+    The detector of periodic trajectories of the cart-pole simulation. The simulation
+    step is deterministic function of the state, and so is the control ANN if it is
+    stateless, i.e., the feed-forward network which outputs depend only on the current
+    inputs. For such ANN once the exact state repeats the trajectory will repeat itself
+    forever without violating constraints. The ANNs keeping activations of neurons
+    between calls (e.g., MultiNEAT networks) must not be used with the detector,
+    because the repeated state does not imply the repeated output for them.
+    The repeats are searched with Brent's algorithm: the state is saved at steps 0, 1, 3,
+    7, 15 and so on, and each following state is compared with the saved one exactly. Thus
+    any period is found in less than twice the number of steps of the trajectory prefix
+    and the period. The states of all carts are saved at the same steps, and the pole angle
+    is compared first, so the detection costs one comparison per cart per step unless the
+    angle repeats.
+    """
+    def __init__(self):
+        """
+        Creates new detector for the batch of simulated carts or the single cart.
+        """
+        self.step = 0
+        # The states saved and the step they were saved at
+        self.saved = None
+        self.saved_step = 0
+        # The number of steps to compare states with saved ones
+        self.power = 1
+
+    def update(self, state):
+        """
+        The function to register current states of carts before the actions applied.
+        Arguments:
+            state:      The array with state variables of carts, shape (N, 4)
+        Returns:
+            The array with indices of carts which states repeat the saved ones.
+        """
+        periodic = np.zeros(0, dtype=int)
+        if self.saved is not None:
+            periodic = np.flatnonzero(state[:, 2] == self.saved[:, 2])
+            if len(periodic) > 0:
+                periodic = periodic[(state[periodic] == self.saved[periodic]).all(axis=1)]
+        if self._save_due():
+            self.saved = state.copy()
+        return periodic
+
+    def repeats(self, state):
+        """
+        The function to register current state of the single cart before the action applied.
+        It is the scalar counterpart of update.
+        Arguments:
+            state:      The tuple with state variables (x, x_dot, theta, theta_dot)
+        Returns:
+            True if the state repeats the saved one.
+        """
+        if state == self.saved:
+            return True
+        if self._save_due():
+            self.saved = state
+        return False
+
+    def select(self, mask):
+        """
+        The function to keep only carts selected by provided mask.
+        Arguments:
+            mask: The boolean mask of carts to keep
+        """
+        if self.saved is not None:
+            self.saved = self.saved[mask]
+
+    def _save_due(self):
+        """
+        The function to advance the step counter and to check whether the current
+        state must be saved as the next one to compare with.
+        """
+        t = self.step
+        self.step += 1
+        if self.saved is not None and t - self.saved_step < self.power:
+            return False
+        if self.saved is not None:
+            self.power *= 2
+        self.saved_step = t
+        return True
+
+def run_cart_pole_simulation(net, max_bal_steps, action_evaluator, random_start=True, detect_cycles=False, rng=None):
     """
     The function to run cart-pole apparatus simulation for a
     certain number of time steps as maximum.
@@ -80,6 +236,11 @@ def run_cart_pole_simulation(net, max_bal_steps, action_evaluator, random_start=
         action_evaluator:   The function to evaluate the action type from the ANN output value.
         random_start:       If evaluates to True than cart-pole simulation 
                             starts from random initial positions.
+        detect_cycles:      The flag to stop simulation once the trajectory became periodic,
+                            i.e., balancing forever. Must be False unless the ANN is
+                            stateless (see CycleDetector).
+        rng:                The random numbers generator for the initial state or None
+                            to use the global one.
     Returns:
         the number of steps that the control ANN was able to
         maintain the single-pole balancer in stable state.
@@ -87,10 +248,9 @@ def run_cart_pole_simulation(net, max_bal_steps, action_evaluator, random_start=
     # Set random initial state if appropriate
     x, x_dot, theta, theta_dot = 0.0, 0.0, 0.0, 0.0
     if random_start:
-        x = (random.random() * 4.8 - 2.4) / 2.0 # -1.4 < x < 1.4
-        x_dot = (random.random() * 3 - 1.5) / 4.0 # -0.375 < x_dot < 0.375
-        theta = (random.random() * 0.42 - 0.21) / 2.0 # -0.105 < theta < 0.105
-        theta_dot = (random.random() * 4 - 2) / 4.0 # -0.5 < theta_dot < 0.5
+        x, x_dot, theta, theta_dot = random_start_state(rng)
+
+    detector = CycleDetector() if detect_cycles else None
 
     # Run simulation for specified number of steps while
     # cart-pole system stays within contstraints
@@ -107,6 +267,10 @@ def run_cart_pole_simulation(net, max_bal_steps, action_evaluator, random_start=
         # Make action values discrete
         action = action_evaluator(output)
 
+        # Check if trajectory became periodic
+        if detector is not None and detector.repeats((x, x_dot, theta, theta_dot)):
+            return max_bal_steps
+
         # Apply action to the simulated cart-pole
         x, x_dot, theta, theta_dot = do_step(   action = action, 
                                                 x = x, 
@@ -120,22 +284,294 @@ def run_cart_pole_simulation(net, max_bal_steps, action_evaluator, random_start=
 
     return max_bal_steps
 
-def eval_fitness(net, action_evaluator, max_bal_steps=500000):
+def run_cart_pole_simulation_batch(nets, max_bal_steps, action_evaluator, random_start=True, detect_cycles=False, rngs=None):
     """
-    The function to evaluate fitness score of phenotype produced
-    provided ANN
+    The function to run cart-pole apparatus simulation for the batch of control
+    ANNs at once. The state of all carts is kept in one array and advanced with 
+    vectorized simulation step, while carts that violated constraints are
+    masked out from further simulation.
     Arguments:
-        net:                The ANN of the phenotype to be evaluated.
+        nets:               The list of ANNs of the phenotypes to be evaluated or the
+                            PopulationNetwork activating all phenotypes at once.
+        max_bal_steps:      The maximum nubmer of time steps to
+                            execute simulation.
         action_evaluator:   The function to evaluate the action type from the ANN output value.
+        random_start:       If evaluates to True than cart-pole simulation 
+                            starts from random initial positions.
+        detect_cycles:      The flag to stop simulation of carts which trajectories became
+                            periodic, i.e., balancing forever. Must be False unless the ANNs
+                            are stateless (see CycleDetector).
+        rngs:               The list of random numbers generators for the initial state
+                            of each cart or None to use the global one.
+    Returns:
+        the array with number of steps that each control ANN was able to
+        maintain the single-pole balancer in stable state.
+    """
+    population, state, detector = start_simulation_batch(nets, random_start, detect_cycles, rngs)
+
+    # The number of balancing steps for each ANN
+    steps = np.full(len(population), max_bal_steps, dtype=int)
+    # The indices of ANNs which carts are still within constraints
+    active = np.arange(len(population))
+    simulate_batch(population, state, active, steps, 
+                    first_step=0, 
+                    last_step=max_bal_steps, 
+                    action_evaluator=action_evaluator, 
+                    detector=detector)
+    return steps
+
+def run_cart_pole_simulation_staged(nets, max_bal_steps, action_evaluator, min_horizon=1000, eta=2, 
+                                    random_start=True, detect_cycles=False, rngs=None):
+    """
+    The function to run cart-pole apparatus simulation for the batch of control
+    ANNs with successive halving of evaluation horizon. All ANNs are simulated for
+    the short horizon first, than only the best 1/eta of surviving carts continue the
+    simulation up to the horizon increased eta times and so on until max_bal_steps
+    reached. The surviving carts are ranked by the accumulated squared deviation of
+    cart position and pole angle from zero, i.e., the most stable ones continue.
+    Arguments:
+        nets:               The list of ANNs of the phenotypes to be evaluated or the
+                            PopulationNetwork activating all phenotypes at once.
         max_bal_steps:      The maximum nubmer of time steps to
                             execute simulation.
+        action_evaluator:   The function to evaluate the action type from the ANN output value.
+        min_horizon:        The number of time steps of the first stage, at least one.
+        eta:                The rate of horizon increase and survivors reduction between stages,
+                            at least two.
+        random_start:       If evaluates to True than cart-pole simulation 
+                            starts from random initial positions.
+        detect_cycles:      The flag to stop simulation of periodic trajectories (see CycleDetector).
+        rngs:               The list of random numbers generators for the initial state
+                            of each cart or None to use the global one.
     Returns:
-        The phenotype fitness score in range [0, 1]
+        the array with number of steps that each control ANN was able to
+        maintain the single-pole balancer in stable state. For ANNs eliminated
+        at some stage it is the horizon of that stage.
     """
-    # First we run simulation loop returning number of successfull
-    # simulation steps
-    steps = run_cart_pole_simulation(net, max_bal_steps, action_evaluator=action_evaluator)
+    if min_horizon < 1 or eta < 2:
+        raise ValueError("Staged evaluation requires min_horizon >= 1 and eta >= 2, got: %s, %s" % (min_horizon, eta))
+    population, state, detector = start_simulation_batch(nets, random_start, detect_cycles, rngs)
+
+    # The number of balancing steps for each ANN
+    steps = np.full(len(population), max_bal_steps, dtype=int)
+    # The indices of ANNs which carts are still within constraints
+    active = np.arange(len(population))
+    # The accumulated deviation of carts from the balanced state
+    deviation = np.zeros(len(population))
+    first_step, horizon = 0, min_horizon
+    while True:
+        horizon = min(horizon, max_bal_steps)
+        population, state, active = simulate_batch(population, state, active, steps, 
+                                                    first_step=first_step, 
+                                                    last_step=horizon, 
+                                                    action_evaluator=action_evaluator, 
+                                                    detector=detector,
+                                                    deviation=deviation)
+        if horizon == max_bal_steps or len(active) == 0:
+            break
+
+        # keep only the most stable survivors for the next stage
+        n_keep = int(math.ceil(len(active) / float(eta)))
+        kept = np.zeros(len(active), dtype=bool)
+        kept[np.argsort(deviation[active], kind='stable')[:n_keep]] = True
+        steps[active[~kept]] = horizon
+        active = active[kept]
+        state = state[kept]
+        population = population.select(kept)
+        if detector is not None:
+            detector.select(kept)
+
+        first_step, horizon = horizon, horizon * eta
+
+    return steps
+
+def start_simulation_batch(nets, random_start=True, detect_cycles=False, rngs=None):
+    """
+    The function to prepare the batch simulation of provided control ANNs.
+    Arguments:
+        nets:               The list of ANNs of the phenotypes to be evaluated or the
+                            PopulationNetwork activating all phenotypes at once.
+        random_start:       If evaluates to True than cart-pole simulation 
+                            starts from random initial positions.
+        detect_cycles:      The flag to stop simulation of periodic trajectories (see CycleDetector).
+        rngs:               The list of random numbers generators for the initial state
+                            of each cart or None to use the global one.
+    Returns:
+        The tuple with population network, initial states array and cycle
+        detector (None if detection disabled).
+    """
+    population = as_population(nets)
+    n_nets = len(population)
+    # Set random initial states if appropriate. The random values drawn in the same
+    # order as if each ANN was evaluated by run_cart_pole_simulation one after another.
+    state = np.zeros((n_nets, 4))
+    if random_start:
+        for i in range(n_nets):
+            state[i] = random_start_state(None if rngs is None else rngs[i])
+
+    detector = CycleDetector() if detect_cycles else None
+
+    return population, state, detector
+
+def simulate_batch(population, state, active, steps, first_step, last_step, action_evaluator, 
+                    detector=None, deviation=None):
+    """
+    The function to advance the batch simulation over the specified range of time steps.
+    The carts that violated constraints are masked out from further simulation.
+    Arguments:
+        population:         The PopulationNetwork with ANNs of active carts.
+        state:              The array with state variables of active carts, shape (N, 4).
+        active:             The indices of ANNs of active carts.
+        steps:              The array to store number of balancing steps of failed carts.
+        first_step:         The index of the first time step to simulate.
+        last_step:          The index of the time step to stop simulation before.
+        action_evaluator:   The function to evaluate the action type from the ANN output value.
+        detector:           The CycleDetector of active carts or None.
+        deviation:          The array to accumulate squared deviation of carts from
+                            balanced state or None.
+    Returns:
+        The tuple with population network, states array and indices of ANNs 
+        for the carts which are still active.
+    """
+    # The input offsets and scales to be applied to the state variables
+    offsets = np.array([2.4, 1.5, 0.21, 2.0])
+    scales = np.array([4.8, 3.0, 0.42, 4.0])
+    evaluate_actions = BATCH_ACTION_EVALUATORS.get(action_evaluator)
+    for step in range(first_step, last_step):
+        if len(active) == 0:
+            break
+
+        # Finish the simulation of few remaining carts one by one
+        if len(active) < MIN_BATCH_SIZE:
+            kept = np.zeros(len(active), dtype=bool)
+            for i in range(len(active)):
+                cart_detector = CycleDetector() if detector is not None else None
+                kept[i] = simulate_cart(population.network(i), state[i], active[i], steps, 
+                                        first_step=step, 
+                                        last_step=last_step, 
+                                        action_evaluator=action_evaluator, 
+                                        detector=cart_detector, 
+                                        deviation=deviation)
+            active = active[kept]
+            state = state[kept]
+            population = population.select(kept)
+            if detector is not None:
+                detector.select(kept)
+            break
+
+        # Load scaled inputs
+        inputs = (state + offsets) / scales
+
+        # Activate the NETs and make action values discrete
+        outputs = population.activate(inputs)
+        if evaluate_actions is not None:
+            actions = evaluate_actions(outputs)
+        else:
+            actions = np.fromiter((action_evaluator(output) for output in outputs), dtype=int, count=len(active))
+
+        # Remove carts with periodic trajectories from the simulation as balancing forever
+        if detector is not None:
+            periodic = detector.update(state)
+            if len(periodic) > 0:
+                kept = np.ones(len(active), dtype=bool)
+                kept[periodic] = False
+                active = active[kept]
+                state = state[kept]
+                actions = actions[kept]
+                population = population.select(kept)
+                detector.select(kept)
+                if len(active) == 0:
+                    break
+
+        # Apply actions to the simulated cart-poles
+        do_step_batch(actions, state)
+
+        # Check for failure due constraints violation. If so, store number of steps
+        # and remove failed carts from the simulation.
+        failed = (state[:, 0] < -2.4) | (state[:, 0] > 2.4) | (state[:, 2] < -0.21) | (state[:, 2] > 0.21)
+        if failed.any():
+            steps[active[failed]] = step
+            passed = ~failed
+            active = active[passed]
+            state = state[passed]
+            population = population.select(passed)
+            if detector is not None:
+                detector.select(passed)
+
+        if deviation is not None:
+            deviation[active] += (state[:, 0] / 2.4) ** 2 + (state[:, 2] / 0.21) ** 2
+
+    return population, state, active
+
+def simulate_cart(net, state, index, steps, first_step, last_step, action_evaluator, 
+                    detector=None, deviation=None):
+    """
+    The function to advance the simulation of the single cart of the batch over the
+    specified range of time steps. It performs the same steps as simulate_batch, but
+    with scalar operations.
+    Arguments:
+        net:                The ANN of the cart.
+        state:              The array with state variables of the cart, shape (4,). The
+                            array is updated in place.
+        index:              The index of ANN of the cart.
+        steps:              The array to store number of balancing steps if cart failed.
+        first_step:         The index of the first time step to simulate.
+        last_step:          The index of the time step to stop simulation before.
+        action_evaluator:   The function to evaluate the action type from the ANN output value.
+        detector:           The CycleDetector of the cart or None.
+        deviation:          The array to accumulate squared deviation of carts from
+                            balanced state or None.
+    Returns:
+        True if the cart is still active, i.e., it neither violated constraints
+        nor was found balancing forever.
+    """
+    x, x_dot, theta, theta_dot = state.tolist()
+    cart_deviation = None if deviation is None else float(deviation[index])
+    active = True
+    input = [None] * 4 # the inputs
+    for step in range(first_step, last_step):
+        # Load scaled inputs
+        input[0] = (x + 2.4) / 4.8
+        input[1] = (x_dot + 1.5) / 3.0
+        input[2] = (theta + 0.21) / 0.42
+        input[3] = (theta_dot + 2.0) / 4.0
+
+        # Activate the NET and make action value discrete
+        action = action_evaluator(net.activate(input))
+
+        # Check if trajectory became periodic
+        if detector is not None and detector.repeats((x, x_dot, theta, theta_dot)):
+            active = False
+            break
 
+        # Apply action to the simulated cart-pole
+        x, x_dot, theta, theta_dot = do_step(action, x, x_dot, theta, theta_dot)
+
+        # Check for failure due constraints violation
+        if x < -2.4 or x > 2.4 or theta < -0.21 or theta > 0.21:
+            steps[index] = step
+            active = False
+            break
+
+        if cart_deviation is not None:
+            x_scaled, theta_scaled = x / 2.4, theta / 0.21
+            cart_deviation += x_scaled * x_scaled + theta_scaled * theta_scaled
+
+    state[:] = x, x_dot, theta, theta_dot
+    if deviation is not None:
+        deviation[index] = cart_deviation
+    return active
+
+def fitness_score(steps, max_bal_steps):
+    """
+    The function to calculate fitness score from the number of balancing steps.
+    Arguments:
+        steps:          The number of steps that the control ANN was able to
+                        maintain the single-pole balancer in stable state.
+        max_bal_steps:  The maximum nubmer of time steps of simulation.
+    Returns:
+        The phenotype fitness score in range [0, 1]
+    """
     if steps == max_bal_steps:
         # the maximal fitness
         return MAX_FITNESS
@@ -153,7 +589,62 @@ def eval_fitness(net, action_evaluator, max_bal_steps=500000):
         # The fitness value is a complement of the loss value
         return MAX_FITNESS - error
 
+def eval_fitness(net, action_evaluator, max_bal_steps=500000, detect_cycles=False, rng=None):
+    """
+    The function to evaluate fitness score of phenotype produced
+    provided ANN
+    Arguments:
+        net:                The ANN of the phenotype to be evaluated.
+        action_evaluator:   The function to evaluate the action type from the ANN output value.
+        max_bal_steps:      The maximum nubmer of time steps to
+                            execute simulation.
+        detect_cycles:      The flag to stop simulation of periodic trajectories (see CycleDetector).
+        rng:                The random numbers generator for the initial state or None
+                            to use the global one.
+    Returns:
+        The phenotype fitness score in range [0, 1]
+    """
+    # First we run simulation loop returning number of successfull
+    # simulation steps
+    steps = run_cart_pole_simulation(net, max_bal_steps, 
+                                    action_evaluator=action_evaluator, 
+                                    detect_cycles=detect_cycles,
+                                    rng=rng)
 
+    return fitness_score(steps, max_bal_steps)
 
+def eval_fitness_batch(nets, action_evaluator, max_bal_steps=500000, detect_cycles=False, min_horizon=None, eta=2, 
+                        rngs=None):
+    """
+    The function to evaluate fitness scores of phenotypes produced
+    provided ANNs in one batch, e.g., the whole generation.
+    Arguments:
+        nets:               The list of ANNs of the phenotypes to be evaluated or the
+                            PopulationNetwork activating all phenotypes at once.
+        action_evaluator:   The function to evaluate the action type from the ANN output value.
+        max_bal_steps:      The maximum nubmer of time steps to
+                            execute simulation.
+        detect_cycles:      The flag to stop simulation of periodic trajectories (see CycleDetector).
+        min_horizon:        The number of time steps of the first stage of evaluation with
+                            successive halving of horizon or None to simulate all ANNs
+                            up to max_bal_steps.
+        eta:                The rate of horizon increase and survivors reduction between stages.
+        rngs:               The list of random numbers generators for the initial state
+                            of each cart or None to use the global one.
+    Returns:
+        The array with phenotype fitness scores in range [0, 1] in order of provided ANNs
+    """
+    if min_horizon is None:
+        steps = run_cart_pole_simulation_batch(nets, max_bal_steps, 
+                                                action_evaluator=action_evaluator, 
+                                                detect_cycles=detect_cycles,
+                                                rngs=rngs)
+    else:
+        steps = run_cart_pole_simulation_staged(nets, max_bal_steps, 
+                                                action_evaluator=action_evaluator, 
+                                                min_horizon=min_horizon,
+                                                eta=eta,
+                                                detect_cycles=detect_cycles,
+                                                rngs=rngs)
 
-
+    return np.array([fitness_score(s, max_bal_steps) for s in steps])
@@ -5,6 +5,10 @@
 import math
 import random
 
+import numpy as np
+
+from utils.compiled_net import as_population
+
 #
 # The constants defining physics of cart-2-poles apparatus
 #
@@ -240,21 +244,16 @@ def reset_state(state):
     state[2] = math.pi / 180.0 # the one_degree
     return state
 
-def eval_fitness(net, max_bal_steps=100000):
+def fitness_score(steps, max_bal_steps):
     """
-    Evaluates fitness of the genome that was used to generate 
-    provided net
+    The function to calculate fitness score from the number of balancing steps.
     Arguments:
-        net: The feed-forward neural network generated from genome
-        max_bal_steps: The maximum nubmer of time steps to
-            execute simulation.
+        steps:          The number of steps that the control ANN was able to
+                        maintain the cart-two-pole system in stable state.
+        max_bal_steps:  The maximum nubmer of time steps of simulation.
     Returns:
         The phenotype fitness score in range [0, 1]
     """
-    # First we run simulation loop returning number of successfull
-    # simulation steps
-    steps = run_markov_simulation(net, max_bal_steps)
-
     if steps == max_bal_steps:
         # the maximal fitness
         return MAX_FITNESS
@@ -270,4 +269,377 @@ def eval_fitness(net, max_bal_steps=100000):
         # The loss value is in range [0, 1]
         error = (log_max_steps - log_steps) / log_max_steps
         # The fitness value is a complement of the loss value
-        return MAX_FITNESS - error
\ No newline at end of file
+        return MAX_FITNESS - error
+
+def eval_fitness(net, max_bal_steps=100000):
+    """
+    Evaluates fitness of the genome that was used to generate 
+    provided net
+    Arguments:
+        net: The feed-forward neural network generated from genome
+        max_bal_steps: The maximum nubmer of time steps to
+            execute simulation.
+    Returns:
+        The phenotype fitness score in range [0, 1]
+    """
+    # First we run simulation loop returning number of successfull
+    # simulation steps
+    steps = run_markov_simulation(net, max_bal_steps)
+
+    return fitness_score(steps, max_bal_steps)
+
+def eval_fitness_batch(nets, max_bal_steps=100000, min_horizon=None, eta=2):
+    """
+    Evaluates fitness of the genomes that were used to generate 
+    provided nets in one batch, e.g., the whole generation.
+    Arguments:
+        nets: The list of feed-forward neural networks generated from genomes or the
+            PopulationNetwork activating all of them at once.
+        max_bal_steps: The maximum nubmer of time steps to
+            execute simulation.
+        min_horizon: The number of time steps of the first stage of evaluation with
+            successive halving of horizon or None to simulate all nets up to max_bal_steps.
+        eta: The rate of horizon increase and survivors reduction between stages, at least two.
+    Returns:
+        The array with phenotype fitness scores in range [0, 1] in order of provided nets
+    """
+    if min_horizon is None:
+        steps = run_markov_simulation_batch(nets, max_bal_steps)
+    else:
+        steps = run_markov_simulation_staged(nets, max_bal_steps, min_horizon=min_horizon, eta=eta)
+
+    return np.array([fitness_score(s, max_bal_steps) for s in steps])
+
+def run_markov_simulation_batch(nets, max_bal_steps=100000):
+    """
+    The function to run cart-two-pole apparatus simulation for the batch of 
+    control ANNs at once for a certain number of time steps as maximum.
+    Arguments:
+        nets: The list of ANNs of the phenotypes to be evaluated or the
+            PopulationNetwork activating all phenotypes at once.
+        max_bal_steps: The maximum nubmer of time steps to
+            execute simulation.
+    Returns:
+        the array with number of steps that each control ANN was able to
+        maintain the cart-two-pole system in stable state.
+    """
+    population = as_population(nets)
+    n_nets = len(population)
+    batch = CartTwoPoleBatch(size=n_nets)
+
+    # The number of balancing steps for each ANN
+    steps = np.full(n_nets, max_bal_steps, dtype=int)
+    # The indices of ANNs which systems are still within constraints
+    active = np.arange(n_nets)
+    simulate_batch(population, batch, active, steps, first_step=0, last_step=max_bal_steps)
+
+    return steps
+
+def run_markov_simulation_staged(nets, max_bal_steps=100000, min_horizon=1000, eta=2):
+    """
+    The function to run cart-two-pole apparatus simulation for the batch of control
+    ANNs with successive halving of evaluation horizon. All ANNs are simulated for
+    the short horizon first, than only the best 1/eta of surviving systems continue the
+    simulation up to the horizon increased eta times and so on until max_bal_steps
+    reached. The surviving systems are ranked by the accumulated squared deviation of
+    cart position and poles angles from zero, i.e., the most stable ones continue.
+    Arguments:
+        nets: The list of ANNs of the phenotypes to be evaluated or the
+            PopulationNetwork activating all phenotypes at once.
+        max_bal_steps: The maximum nubmer of time steps to
+            execute simulation.
+        min_horizon: The number of time steps of the first stage, at least one.
+        eta: The rate of horizon increase and survivors reduction between stages, at least two.
+    Returns:
+        the array with number of steps that each control ANN was able to
+        maintain the cart-two-pole system in stable state. For ANNs eliminated
+        at some stage it is the horizon of that stage.
+    """
+    if min_horizon < 1 or eta < 2:
+        raise ValueError("Staged evaluation requires min_horizon >= 1 and eta >= 2, got: %s, %s" % (min_horizon, eta))
+    population = as_population(nets)
+    n_nets = len(population)
+    batch = CartTwoPoleBatch(size=n_nets)
+
+    # The number of balancing steps for each ANN
+    steps = np.full(n_nets, max_bal_steps, dtype=int)
+    # The indices of ANNs which systems are still within constraints
+    active = np.arange(n_nets)
+    # The accumulated deviation of systems from the balanced state
+    deviation = np.zeros(n_nets)
+    first_step, horizon = 0, min_horizon
+    while True:
+        horizon = min(horizon, max_bal_steps)
+        population, active = simulate_batch(population, batch, active, steps, 
+                                            first_step=first_step, 
+                                            last_step=horizon, 
+                                            deviation=deviation)
+        if horizon == max_bal_steps or len(active) == 0:
+            break
+
+        # keep only the most stable survivors for the next stage
+        n_keep = int(math.ceil(len(active) / float(eta)))
+        kept = np.zeros(len(active), dtype=bool)
+        kept[np.argsort(deviation[active], kind='stable')[:n_keep]] = True
+        steps[active[~kept]] = horizon
+        active = active[kept]
+        batch.compact(kept)
+        population = population.select(kept)
+
+        first_step, horizon = horizon, horizon * eta
+
+    return steps
+
+def simulate_batch(population, batch, active, steps, first_step, last_step, deviation=None):
+    """
+    The function to advance the batch simulation over the specified range of time steps.
+    The systems that violated constraints are removed from the batch.
+    Arguments:
+        population: The PopulationNetwork with ANNs of active systems.
+        batch: The CartTwoPoleBatch with active systems.
+        active: The indices of ANNs of active systems.
+        steps: The array to store number of balancing steps of failed systems.
+        first_step: The index of the first time step to simulate.
+        last_step: The index of the time step to stop simulation before.
+        deviation: The array to accumulate squared deviation of systems from
+            balanced state or None.
+    Returns:
+        The tuple with population network and indices of ANNs for the systems
+        which are still active.
+    """
+    # The input offsets and scales to be applied to the state variables
+    offsets = np.array([2.4, 1.5, THIRTY_SIX_DEG_IN_RAD, 2.0, THIRTY_SIX_DEG_IN_RAD, 2.0])
+    scales = np.array([4.8, 3.0, THIRTY_SIX_DEG_IN_RAD * 2.0, 4.0, THIRTY_SIX_DEG_IN_RAD * 2.0, 4.0])
+    for step in range(first_step, last_step):
+        if batch.size == 0:
+            break
+
+        state = batch.state[:batch.size]
+        # scale inputs
+        inputs = (state + offsets) / scales
+
+        # Activate the NETs and make action values discrete
+        outputs = np.asarray(population.activate(inputs))
+        actions = np.logical_not(outputs[:, 0] < 0.5).astype(int)
+
+        # Apply actions to the simulated cart-two-poles
+        batch.apply_action(actions)
+
+        # check if simulations still within bounds
+        failed = batch.outside_bounds()
+        if failed.any():
+            steps[active[failed]] = step
+            passed = ~failed
+            active = active[passed]
+            batch.compact(passed)
+            population = population.select(passed)
+
+        if deviation is not None:
+            state = batch.state[:batch.size]
+            deviation[active] += (state[:, 0] / 2.4) ** 2 + \
+                ((state[:, 2] / THIRTY_SIX_DEG_IN_RAD) ** 2) + ((state[:, 4] / THIRTY_SIX_DEG_IN_RAD) ** 2)
+
+    return population, active
+
+class CartTwoPoleBatch:
+    """
+    The batch of cart-two-pole apparatuses simulated at once. The state variables
+    of all systems are kept in the array of shape (N, 6) with rows holding
+    (x, x_dot, theta1, theta1_dot, theta2, theta2_dot). All intermediate values
+    of the Runge-Kutta integration are stored in the buffers allocated once 
+    at creation, thus no arrays allocated during simulation steps.
+    """
+    # The simulation time step size
+    TAU = 0.01
+
+    def __init__(self, size):
+        """
+        Creates new batch of simulated systems in initial state.
+        Arguments:
+            size: The number of systems in the batch.
+        """
+        self.size = size
+        self.state = np.zeros((size, 6))
+        # the buffers to hold state derivatives and intermediate state of integration
+        self._dydx = np.zeros((size, 6))
+        self._yt = np.zeros((size, 6))
+        self._dyt = np.zeros((size, 6))
+        self._dym = np.zeros((size, 6))
+        # the buffer to hold force applied to each cart
+        self._force = np.zeros(size)
+        # the buffers to hold intermediate values of system dynamics calculations
+        self._scratch = np.zeros((11, size))
+        # the buffer to hold constraints test results
+        self._failed = np.zeros(size, dtype=bool)
+        self._bound = np.zeros(size, dtype=bool)
+
+        self.reset()
+
+    def reset(self):
+        """
+        The function to reset state of all systems in the batch to initial values.
+        """
+        self.state[:] = 0
+        self.state[:, 2] = math.pi / 180.0 # the one_degree
+
+    def compact(self, keep):
+        """
+        The function to remove systems from the batch leaving only the specified ones.
+        Arguments:
+            keep: The boolean mask of current systems to keep in the batch.
+        """
+        kept = self.state[:self.size][keep]
+        self.size = len(kept)
+        self.state[:self.size] = kept
+
+    def apply_action(self, actions):
+        """
+        Method to apply control actions to the simulated systems in the batch.
+        Arguments:
+            actions: The array with binary actions defining direction of
+                     force to be applied to each cart.
+        Returns:
+            The view of updated state of systems in the batch.
+        """
+        n = self.size
+        y, dydx, force = self.state[:n], self._dydx[:n], self._force[:n]
+        # action has binary values, thus force is -FORCE_MAG for 0 and FORCE_MAG for 1
+        np.multiply(actions, 2.0 * FORCE_MAG, out=force)
+        force -= FORCE_MAG
+
+        # The control inputs frequency is two times less than simulation
+        # step frequency - hence do two simulation steps
+        for _ in range(2):
+            # do one simulation step and store derivatives
+            self._calc_step(force, y, dydx)
+            # do Runge-Kutta numerical approximation and update state
+            self._rk4(force, y, dydx, self.TAU)
+
+        return y
+
+    def outside_bounds(self):
+        """
+        Function to test whether systems in the batch are outside of the constraints.
+        Returns:
+            The boolean array where True marks system violated constraints.
+        """
+        n = self.size
+        y, failed, bound = self.state[:n], self._failed[:n], self._bound[:n]
+        np.less(y[:, 0], -2.4, out=failed)
+        failed |= np.greater(y[:, 0], 2.4, out=bound)
+        for i in (2, 4):
+            failed |= np.less(y[:, i], -THIRTY_SIX_DEG_IN_RAD, out=bound)
+            failed |= np.greater(y[:, i], THIRTY_SIX_DEG_IN_RAD, out=bound)
+        return failed
+
+    def _calc_step(self, force, y, dydx):
+        """
+        The function to perform calculations of system dynamics for one step of
+        simulations. It is the batch counterpart of the calc_step function.
+        Arguments:
+            force:  The force applied to each cart.
+            y:      The state variables of systems.
+            dydx:   The array to store derivatives of the state variables.
+        """
+        n = len(force)
+        cos_theta_1, sin_theta_1, g_sin_theta_1, cos_theta_2, sin_theta_2, g_sin_theta_2, \
+            temp_1, temp_2, fi, mi, aux = (buffer[:n] for buffer in self._scratch)
+        theta1, theta1_dot, theta2, theta2_dot = y[:, 2], y[:, 3], y[:, 4], y[:, 5]
+        # Calculate projections of forces for the poles
+        np.cos(theta1, out=cos_theta_1)
+        np.sin(theta1, out=sin_theta_1)
+        np.multiply(sin_theta_1, GRAVITY, out=g_sin_theta_1)
+        np.cos(theta2, out=cos_theta_2)
+        np.sin(theta2, out=sin_theta_2)
+        np.multiply(sin_theta_2, GRAVITY, out=g_sin_theta_2)
+        # Calculate intermediate values
+        ml_1    = LENGTH_1 * MASS_POLE_1
+        ml_2    = LENGTH_2 * MASS_POLE_2
+        np.multiply(theta1_dot, MUP, out=temp_1)
+        temp_1 /= ml_1
+        np.multiply(theta2_dot, MUP, out=temp_2)
+        temp_2 /= ml_2
+        # the cart acceleration nominator: force + fi_1 + fi_2
+        np.add(temp_1, g_sin_theta_1, out=fi)
+        fi *= cos_theta_1
+        fi *= 0.75 * MASS_POLE_1
+        np.multiply(theta1_dot, theta1_dot, out=aux)
+        aux *= sin_theta_1
+        aux *= ml_1
+        fi += aux
+        np.add(temp_2, g_sin_theta_2, out=aux)
+        aux *= cos_theta_2
+        aux *= 0.75 * MASS_POLE_2
+        fi += aux
+        np.multiply(theta2_dot, theta2_dot, out=aux)
+        aux *= sin_theta_2
+        aux *= ml_2
+        fi += aux
+        fi += force
+        # the cart acceleration denominator: mi_1 + mi_2 + MASS_CART
+        np.multiply(cos_theta_1, cos_theta_1, out=mi)
+        mi *= -0.75
+        mi += 1
+        mi *= MASS_POLE_1
+        np.multiply(cos_theta_2, cos_theta_2, out=aux)
+        aux *= -0.75
+        aux += 1
+        aux *= MASS_POLE_2
+        mi += aux
+        mi += MASS_CART
+        # Calculate the results: cart acceleration and poles angular accelerations
+        x_ddot, theta_1_ddot, theta_2_ddot = dydx[:, 1], dydx[:, 3], dydx[:, 5]
+        np.divide(fi, mi, out=x_ddot)
+        np.multiply(x_ddot, cos_theta_1, out=theta_1_ddot)
+        theta_1_ddot += g_sin_theta_1
+        theta_1_ddot += temp_1
+        theta_1_ddot *= -0.75 / LENGTH_1
+        np.multiply(x_ddot, cos_theta_2, out=theta_2_ddot)
+        theta_2_ddot += g_sin_theta_2
+        theta_2_ddot += temp_2
+        theta_2_ddot *= -0.75 / LENGTH_2
+        # copy the state derivatives
+        dydx[:, 0] = y[:, 1] # x_dot
+        dydx[:, 2] = theta1_dot
+        dydx[:, 4] = theta2_dot
+
+    def _rk4(self, force, y, dydx, tau):
+        """
+        The Runge-Kutta fourth order method of numerical approximation of
+        the double-pole-cart systems dynamics. It is the batch counterpart of
+        the rk4 function and it updates provided state variables (y) in place.
+        Arguments:
+            force:  The force applied to each cart.
+            y:      The current systems state variables.
+            dydx:   The derivatives of current state variables
+            tau:    The simulation approximation time step size
+        """
+        n = len(force)
+        yt, dyt, dym = self._yt[:n], self._dyt[:n], self._dym[:n]
+        hh = tau / 2.0
+        # update intermediate state
+        np.multiply(dydx, hh, out=yt)
+        yt += y
+        # do simulation step and store derivatives
+        self._calc_step(force, yt, dyt)
+
+        # update intermediate state
+        np.multiply(dyt, hh, out=yt)
+        yt += y
+        # do simulation step and store derivatives
+        self._calc_step(force, yt, dym)
+
+        # update intermediate state
+        np.multiply(dym, tau, out=yt)
+        yt += y
+        dym += dyt
+        # do simulation step and store derivatives
+        self._calc_step(force, yt, dyt)
+
+        # find system state after approximation
+        h6 = tau / 6.0
+        dym *= 2.0
+        dym += dydx
+        dym += dyt
+        dym *= h6
+        y += dym
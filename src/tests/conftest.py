@@ -0,0 +1,61 @@
+#
+# The common fixtures of the tests. The modules of experiments are imported
+# relative to the source directory, thus it is added to the search path.
+#
+import os
+import sys
+import random
+
+import neat
+import pytest
+
+SRC_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if SRC_DIR not in sys.path:
+    sys.path.insert(0, SRC_DIR)
+
+def load_config(path):
+    """
+    The function to load NEAT-Python configuration from the file relative to the source directory.
+    Arguments:
+        path: The path to the configuration file.
+    Returns:
+        The NEAT-Python configuration.
+    """
+    return neat.Config(neat.DefaultGenome, neat.DefaultReproduction, 
+                        neat.DefaultSpeciesSet, neat.DefaultStagnation, 
+                        os.path.join(SRC_DIR, path))
+
+@pytest.fixture(scope='session')
+def xor_config():
+    return load_config('xor/xor_config.ini')
+
+@pytest.fixture(scope='session')
+def single_pole_config():
+    return load_config('pole/single_pole_config.ini')
+
+@pytest.fixture(scope='session')
+def two_pole_config():
+    return load_config('pole/two_pole_markov_config.ini')
+
+@pytest.fixture
+def mutated_genomes():
+    """
+    The factory of genomes mutated from the initial ones with seeded random numbers, 
+    thus having hidden nodes, disabled connections and different activation functions.
+    """
+    def create(config, n_genomes, seed, n_mutations=20, activations=('sigmoid', 'tanh', 'relu', 'identity')):
+        state = random.getstate()
+        random.seed(seed)
+        genomes = []
+        for key in range(n_genomes):
+            genome = neat.DefaultGenome(key)
+            genome.configure_new(config.genome_config)
+            for _ in range(n_mutations):
+                genome.mutate(config.genome_config)
+            for node_key, node in genome.nodes.items():
+                if node_key not in config.genome_config.output_keys:
+                    node.activation = random.choice(activations)
+            genomes.append(genome)
+        random.setstate(state)
+        return genomes
+    return create
@@ -0,0 +1,131 @@
+#
+# The tests of the batch cart-pole simulations checking that they produce the same
+# results as the reference scalar simulations.
+#
+import math
+import random
+
+import numpy as np
+import neat
+import pytest
+
+import pole.cart_pole as cart
+import pole.cart_two_pole as two_pole
+from utils.compiled_net import PopulationNetwork
+
+def linear_controllers(config, n_genomes, seed):
+    """
+    The function to create genomes of linear controllers pushing the cart in the direction
+    of the weighted sum of state variables, so that some of them are balancing for long.
+    """
+    rng = random.Random(seed)
+    genomes = []
+    for key in range(n_genomes):
+        genome = neat.DefaultGenome(key)
+        genome.configure_new(config.genome_config)
+        weights = [rng.uniform(-5.0, 5.0) for _ in range(4)]
+        for (i, o), cg in genome.connections.items():
+            cg.weight = weights[-i - 1] if o == 1 else -weights[-i - 1]
+            cg.enabled = True
+        for o, sign in ((0, 1.0), (1, -1.0)):
+            genome.nodes[o].bias = sign * 0.5 * sum(weights)
+            genome.nodes[o].response = 1.0
+        genomes.append(genome)
+    return genomes
+
+def test_two_outputs_action_evaluator_batch():
+    outputs = np.array([[0.1, 0.9], [0.9, 0.1], [0.5, 0.5], [np.nan, 0.5], [0.5, np.nan]])
+    expected = [cart.two_ouputs_action_evaluator(output) for output in outputs]
+    assert cart.two_ouputs_action_evaluator_batch(outputs).tolist() == expected
+
+@pytest.mark.parametrize('detect_cycles', [False, True])
+@pytest.mark.parametrize('min_batch_size', [0, cart.MIN_BATCH_SIZE, 1000])
+def test_batch_matches_scalar(single_pole_config, monkeypatch, min_batch_size, detect_cycles):
+    monkeypatch.setattr(cart, 'MIN_BATCH_SIZE', min_batch_size)
+    max_steps = 3000
+    genomes = linear_controllers(single_pole_config, 60, seed=3)
+    expected = [cart.run_cart_pole_simulation(neat.nn.FeedForwardNetwork.create(genome, single_pole_config), max_steps,
+                                            action_evaluator=cart.two_ouputs_action_evaluator,
+                                            detect_cycles=detect_cycles,
+                                            rng=random.Random(i))
+                for i, genome in enumerate(genomes)]
+    # both failing and balancing carts are simulated
+    assert 0 < expected.count(max_steps) < len(genomes)
+
+    steps = cart.run_cart_pole_simulation_batch(PopulationNetwork.create(genomes, single_pole_config), max_steps,
+                                                action_evaluator=cart.two_ouputs_action_evaluator,
+                                                detect_cycles=detect_cycles,
+                                                rngs=[random.Random(i) for i in range(len(genomes))])
+    assert steps.tolist() == expected
+
+def periodic_states(prefix, period, n_steps):
+    """
+    The function to create the sequence of states which repeats with given period after the prefix.
+    """
+    states = np.zeros((n_steps, 4))
+    for t in range(n_steps):
+        k = t if t < prefix else prefix + (t - prefix) % period
+        states[t] = [0.1 * k, -0.2 * k, 0.01 * k, 0.5]
+    return states
+
+def test_cycle_detector():
+    n_steps = 200
+    # the carts with different prefixes and periods of trajectories, the last one is not periodic
+    sequences = [periodic_states(0, 1, n_steps), periodic_states(5, 7, n_steps),
+                periodic_states(30, 17, n_steps), periodic_states(n_steps, 1, n_steps)]
+    # the state which differs from the periodic one only in cart velocity
+    sequences[3][:, 2] = sequences[2][:, 2]
+
+    detector = cart.CycleDetector()
+    found = [None] * len(sequences)
+    for t in range(n_steps):
+        for i in detector.update(np.array([seq[t] for seq in sequences])):
+            # the periodic carts keep repeating, only the first repeat is recorded
+            if found[i] is None:
+                found[i] = t
+    for (prefix, period), t in zip([(0, 1), (5, 7), (30, 17)], found):
+        # the repeat is found within less than twice the number of steps of prefix and period
+        assert prefix + period <= t < 2 * (prefix + period) + 1
+    assert found[3] is None
+
+    # the scalar detector finds the same repeats
+    for seq, t in zip(sequences, found):
+        detector = cart.CycleDetector()
+        repeats = [detector.repeats(tuple(state)) for state in seq.tolist()]
+        assert (repeats.index(True) if True in repeats else None) == t
+
+def test_staged_keeps_steps_of_survivors(single_pole_config):
+    max_steps, min_horizon, eta = 3000, 50, 3
+    genomes = linear_controllers(single_pole_config, 60, seed=4)
+    full = cart.run_cart_pole_simulation_batch(PopulationNetwork.create(genomes, single_pole_config), max_steps,
+                                                action_evaluator=cart.two_ouputs_action_evaluator,
+                                                rngs=[random.Random(i) for i in range(len(genomes))])
+    staged = cart.run_cart_pole_simulation_staged(PopulationNetwork.create(genomes, single_pole_config), max_steps,
+                                                action_evaluator=cart.two_ouputs_action_evaluator,
+                                                min_horizon=min_horizon,
+                                                eta=eta,
+                                                rngs=[random.Random(i) for i in range(len(genomes))])
+    horizons = [min(min_horizon * eta ** k, max_steps) for k in range(int(math.log(max_steps, eta)) + 1)]
+    for s, f in zip(staged, full):
+        # the eliminated carts are assigned the horizon of the stage they were eliminated at
+        assert s == f or (s < f and s in horizons)
+    assert any(s == f == max_steps for s, f in zip(staged, full))
+
+def test_staged_rejects_invalid_schedule(single_pole_config):
+    nets = PopulationNetwork.create(linear_controllers(single_pole_config, 2, seed=5), single_pole_config)
+    with pytest.raises(ValueError):
+        cart.run_cart_pole_simulation_staged(nets, 100, cart.two_ouputs_action_evaluator, min_horizon=0)
+    with pytest.raises(ValueError):
+        cart.run_cart_pole_simulation_staged(nets, 100, cart.two_ouputs_action_evaluator, min_horizon=10, eta=1)
+
+def test_two_pole_batch_matches_scalar(two_pole_config, mutated_genomes):
+    max_steps = 1000
+    genomes = mutated_genomes(two_pole_config, 60, seed=6, activations=('sigmoid',))
+    nets = [neat.nn.FeedForwardNetwork.create(genome, two_pole_config) for genome in genomes]
+    expected = [two_pole.run_markov_simulation(net, max_steps) for net in nets]
+    assert len(set(expected)) > 1
+
+    steps = two_pole.run_markov_simulation_batch(nets, max_steps)
+    assert steps.tolist() == expected
+    steps = two_pole.run_markov_simulation_batch(PopulationNetwork.create(genomes, two_pole_config), max_steps)
+    assert steps.tolist() == expected
@@ -0,0 +1,80 @@
+#
+# The tests of the phenotype compiler checking that compiled networks produce
+# the same outputs as the NEAT-Python feed-forward networks.
+#
+import numpy as np
+import neat
+import pytest
+
+from utils.compiled_net import CompiledNetwork, PopulationNetwork, NetworkList, as_population, prune_genome
+
+def random_inputs(config, n_samples, seed):
+    rng = np.random.default_rng(seed)
+    return rng.uniform(-1.0, 1.0, size=(n_samples, config.genome_config.num_inputs))
+
+@pytest.mark.parametrize('prune', [True, False])
+def test_compiled_network_matches_feed_forward(xor_config, mutated_genomes, prune):
+    inputs = random_inputs(xor_config, 20, seed=1)
+    for genome in mutated_genomes(xor_config, 30, seed=1):
+        expected = neat.nn.FeedForwardNetwork.create(genome, xor_config)
+        net = CompiledNetwork.create(genome, xor_config, prune=prune)
+        for i in inputs:
+            np.testing.assert_allclose(net.activate(i.tolist()), expected.activate(i.tolist()), rtol=1e-12, atol=1e-12)
+        np.testing.assert_allclose(net.activate_batch(inputs), [expected.activate(i.tolist()) for i in inputs],
+                                    rtol=1e-12, atol=1e-12)
+
+def test_population_network_matches_feed_forward(xor_config, mutated_genomes):
+    genomes = mutated_genomes(xor_config, 40, seed=2)
+    expected = [neat.nn.FeedForwardNetwork.create(genome, xor_config) for genome in genomes]
+    population = PopulationNetwork.create(genomes, xor_config)
+    assert len(population) == len(genomes)
+    compiled = [CompiledNetwork.create(genome, xor_config) for genome in genomes]
+    assert population.removed_nodes == sum(net.removed_nodes for net in compiled)
+    assert population.removed_links == sum(net.removed_links for net in compiled)
+    for step in range(10):
+        # each network receives its own inputs
+        inputs = random_inputs(xor_config, len(genomes), seed=step)
+        outputs = population.activate(inputs)
+        for g, net in enumerate(expected):
+            np.testing.assert_allclose(outputs[g], net.activate(inputs[g].tolist()), rtol=1e-12, atol=1e-12)
+
+def test_population_network_select_and_network(xor_config, mutated_genomes):
+    genomes = mutated_genomes(xor_config, 25, seed=3)
+    expected = [neat.nn.FeedForwardNetwork.create(genome, xor_config) for genome in genomes]
+    population = PopulationNetwork.create(genomes, xor_config)
+    mask = np.arange(len(genomes)) % 3 != 1
+    selected = population.select(mask)
+    indices = np.flatnonzero(mask)
+    inputs = random_inputs(xor_config, len(indices), seed=3)
+    outputs = selected.activate(inputs)
+    for row, g in enumerate(indices):
+        np.testing.assert_allclose(outputs[row], expected[g].activate(inputs[row].tolist()), rtol=1e-12, atol=1e-12)
+        # the single network extracted from the population
+        net = selected.network(row)
+        np.testing.assert_allclose(net.activate(inputs[row].tolist()), outputs[row], rtol=1e-12, atol=1e-12)
+
+def test_network_list_adapter(xor_config, mutated_genomes):
+    genomes = mutated_genomes(xor_config, 5, seed=4)
+    nets = [neat.nn.FeedForwardNetwork.create(genome, xor_config) for genome in genomes]
+    population = as_population(nets)
+    assert isinstance(population, NetworkList)
+    assert as_population(population) is population
+    inputs = random_inputs(xor_config, len(nets), seed=4)
+    outputs = population.activate(inputs)
+    assert outputs == [net.activate(i.tolist()) for net, i in zip(nets, inputs)]
+    assert population.select([False, True, False, True, False]).nets == [nets[1], nets[3]]
+    assert population.network(2) is nets[2]
+
+def test_prune_genome_keeps_outputs(xor_config, mutated_genomes):
+    inputs = random_inputs(xor_config, 10, seed=5)
+    for genome in mutated_genomes(xor_config, 30, seed=5, n_mutations=40):
+        pruned, removed_nodes, removed_links = prune_genome(genome, xor_config)
+        assert removed_nodes >= 0 and removed_links >= 0
+        assert len(pruned.nodes) == len(genome.nodes) - removed_nodes
+        # the compiled network removes the same links, but counts only the nodes it would evaluate
+        compiled = CompiledNetwork.create(genome, xor_config)
+        assert compiled.removed_links == removed_links and compiled.removed_nodes <= removed_nodes
+        expected = neat.nn.FeedForwardNetwork.create(genome, xor_config)
+        net = neat.nn.FeedForwardNetwork.create(pruned, xor_config)
+        for i in inputs:
+            assert net.activate(i.tolist()) == pytest.approx(expected.activate(i.tolist()), rel=1e-12, abs=1e-12)
@@ -0,0 +1,111 @@
+#
+# The tests of the common experiment evaluator checking that the interrupted experiment
+# is resumed from the stored results of finished trials.
+#
+import argparse
+import json
+import os
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from types import SimpleNamespace
+
+import pytest
+
+import experiment
+
+# The seeds of trials run by the fake experiment
+trial_seeds = []
+# The ID of the trial to be interrupted by the fake experiment or None
+interrupted = {'trial': None}
+# The setting assigned in the main process to be passed to the worker processes
+setting = 'default'
+
+def fake_trial(config, trial_id, n_generations, out_dir, save_results, view_results, seed, timer):
+    """
+    The fake experiment trial which is interrupted at the trial with ID given by interrupted['trial'].
+    """
+    if trial_id == interrupted['trial']:
+        raise RuntimeError("The trial interrupted: %d" % trial_id)
+    trial_seeds.append(seed)
+    with timer.phase('evaluation'):
+        pass
+    return trial_id % 2 == 0, n_generations, float(trial_id), 0.5 + trial_id
+
+def run(out_dir, config, **args):
+    settings = dict(trials=4, generations=3, workers=1, seed=None, resume=False)
+    settings.update(args)
+    return experiment.evaluate_experiment(argparse.Namespace(**settings), fake_trial, config, str(out_dir),
+                                        experiment_name='fake', library='test')
+
+@pytest.fixture(autouse=True)
+def clear_trials():
+    del trial_seeds[:]
+    interrupted['trial'] = None
+
+def stored_records(out_dir):
+    with open(os.path.join(str(out_dir), experiment.TRIALS_FILE)) as file:
+        return [json.loads(line) for line in file]
+
+def test_resume_skips_finished_trials(tmp_path):
+    interrupted['trial'] = 2
+    with pytest.raises(RuntimeError):
+        run(tmp_path, SimpleNamespace(param=1), seed=11)
+    first_seeds = list(trial_seeds)
+    assert len(first_seeds) == 2
+    assert [r['trial'] for r in stored_records(tmp_path)] == [0, 1]
+
+    # the master seed is taken from the stored trials, and only unfinished trials are run
+    del trial_seeds[:]
+    interrupted['trial'] = None
+    results = run(tmp_path, SimpleNamespace(param=1), resume=True)
+    assert results.seed == 11
+    assert trial_seeds == [experiment.derive_seed(11, i) for i in (2, 3)]
+    assert [r['trial'] for r in stored_records(tmp_path)] == [0, 1, 2, 3]
+    assert results.fitness.tolist() == [0.5, 1.5, 2.5, 3.5]
+    assert results.results.tolist() == [True, False, True, False]
+
+def test_resume_without_stored_trials_runs_all(tmp_path):
+    results = run(tmp_path, SimpleNamespace(param=1), seed=5, resume=True)
+    assert len(trial_seeds) == 4
+    assert results.fitness.tolist() == [0.5, 1.5, 2.5, 3.5]
+
+def test_changed_configuration_is_not_resumed(tmp_path):
+    run(tmp_path, SimpleNamespace(param=1), seed=5)
+    del trial_seeds[:]
+    run(tmp_path, SimpleNamespace(param=2), seed=5, resume=True)
+    assert len(trial_seeds) == 4
+    del trial_seeds[:]
+    run(tmp_path, SimpleNamespace(param=1), seed=5, resume=True, generations=5)
+    assert len(trial_seeds) == 4
+
+def test_without_resume_runs_all_trials(tmp_path):
+    run(tmp_path, SimpleNamespace(param=1), seed=5)
+    del trial_seeds[:]
+    run(tmp_path, SimpleNamespace(param=1), seed=5)
+    assert len(trial_seeds) == 4
+
+def read_setting(_):
+    return setting
+
+def test_worker_settings_in_spawned_processes():
+    global setting
+    setting = 'assigned'
+    try:
+        initializer, initargs = experiment.worker_settings(__name__, ('setting',))
+        with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context('spawn'),
+                                initializer=initializer, initargs=initargs) as executor:
+            assert executor.submit(read_setting, 0).result() == 'assigned'
+    finally:
+        setting = 'default'
+
+def double_batch(genome_list, timer=None):
+    if timer is not None:
+        timer.count('evaluated_genomes', len(genome_list))
+    return [genome * 2 for genome in genome_list]
+
+@pytest.mark.parametrize('backend', ['serial', 'thread', 'process'])
+def test_evaluator_collects_counts_of_workers(backend):
+    timer = experiment.PhaseTimer()
+    with experiment.GenomeListEvaluator(double_batch, workers=2, chunk_size=3, backend=backend, timer=timer) as evaluator:
+        assert evaluator.evaluate(list(range(10))) == [genome * 2 for genome in range(10)]
+    assert timer.totals()[1] == {'evaluated_genomes': 10}
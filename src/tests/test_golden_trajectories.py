@@ -0,0 +1,46 @@
+#
+# The tests of the golden trajectories checker checking that it accepts the batch engines
+# and catches the engines failing at other steps than the reference ones.
+#
+import numpy as np
+import pytest
+
+import pole.cart_pole as cart
+import golden_trajectories as golden
+
+def cart_pole_unbounded(starts, weights, n_steps, record_every):
+    """
+    The single-pole carts simulated at once without checking the constraints bounds.
+    """
+    records = np.full((len(starts), n_steps // record_every + 1, starts.shape[1]), np.nan)
+    state = starts.copy()
+    records[:, 0] = state
+    for step in range(1, n_steps + 1):
+        state = cart.do_step_batch(golden.linear_actions(state, weights), state)
+        if step % record_every == 0:
+            records[:, step // record_every] = state
+    return records
+
+@pytest.fixture(scope='module')
+def golden_path(tmp_path_factory):
+    path = str(tmp_path_factory.mktemp('golden') / 'golden.npz')
+    golden.record(path, ['cart_pole', 'cart_two_pole'], runs=16, n_steps={'cart_pole': 2000, 'cart_two_pole': 2000},
+                record_every=10, seed=42)
+    return path
+
+def test_batch_engine_matches_golden(golden_path):
+    data = np.load(golden_path)
+    # some of the golden runs fail
+    assert np.isnan(data['cart_pole/states']).any() and np.isnan(data['cart_two_pole/states']).any()
+    assert golden.check(golden_path, 'batch') == []
+
+def test_engine_without_bounds_diverges(golden_path, tmp_path, monkeypatch):
+    monkeypatch.setitem(golden.ENGINES['cart_pole'], 'unbounded', cart_pole_unbounded)
+    assert golden.check(golden_path, 'unbounded') == ['cart_pole']
+
+    # the changed failure is allowed if the golden states come within tolerance of the bounds
+    data = dict(np.load(golden_path))
+    data['cart_pole/margins'] = np.where(np.isfinite(data['cart_pole/margins']), 1e-12, np.inf)
+    path = str(tmp_path / 'near_bounds.npz')
+    np.savez_compressed(path, **data)
+    assert golden.check(path, 'unbounded') == []
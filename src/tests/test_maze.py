@@ -0,0 +1,137 @@
+#
+# The tests of the maze simulation checking the spatial index over walls and
+# the batch maze environment against the reference scalar environment.
+#
+import os
+import copy
+import math
+import random
+
+import numpy as np
+import pytest
+
+import maze.geometry as geometry
+import maze.maze_environment as maze
+from maze.novelty_archive import NoveltyItem
+
+MAZE_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'maze')
+
+class LinearController:
+    """
+    The stateless controller with sigmoid outputs of the weighted sum of inputs.
+    """
+    def __init__(self, weights):
+        self.weights = weights
+
+    def activate(self, inputs):
+        outputs = []
+        for w in self.weights:
+            z = sum(wi * xi for wi, xi in zip(w, inputs)) + w[-1]
+            outputs.append(1.0 / (1.0 + math.exp(-z)))
+        return outputs
+
+class AllWalls:
+    """
+    The trivial spatial index returning all walls for any query.
+    """
+    def __init__(self, lines):
+        self.lines = lines
+
+    def query_line(self, line):
+        return self.lines
+
+    def query_point(self, point, radius):
+        return self.lines
+
+def controllers(n_controllers, seed):
+    rng = random.Random(seed)
+    return [LinearController([[rng.gauss(0.0, 0.05) for _ in range(10)] + [rng.gauss(0.0, 1.0)] for _ in range(2)])
+            for _ in range(n_controllers)]
+
+def random_segments(rng, n_segments, extent=100.0):
+    lines = []
+    for _ in range(n_segments):
+        a = geometry.Point(rng.uniform(0.0, extent), rng.uniform(0.0, extent))
+        angle = rng.uniform(0.0, 2.0 * math.pi)
+        length = rng.uniform(0.0, extent / 3.0)
+        b = geometry.Point(a.x + length * math.cos(angle), a.y + length * math.sin(angle))
+        lines.append(geometry.Line(a, b))
+    return lines
+
+@pytest.fixture(scope='module')
+def maze_env():
+    env = maze.read_environment(os.path.join(MAZE_DIR, 'medium_maze.txt'))
+    env.location_sample_rate = 50
+    return env
+
+@pytest.mark.parametrize('cell_size', [None, 3.0, 40.0])
+def test_segment_grid_finds_all_nearby_segments(cell_size):
+    rng = random.Random(1)
+    lines = random_segments(rng, 60)
+    grid = geometry.SegmentGrid(lines, cell_size=cell_size)
+    for _ in range(200):
+        point = geometry.Point(rng.uniform(-20.0, 120.0), rng.uniform(-20.0, 120.0))
+        radius = rng.uniform(0.0, 15.0)
+        found = grid.query_point(point, radius)
+        assert len(set(map(id, found))) == len(found)
+        expected = [line for line in lines if line.distance(point) <= radius]
+        assert set(map(id, expected)) <= set(map(id, found))
+
+        end = geometry.Point(point.x + rng.uniform(-50.0, 50.0), point.y + rng.uniform(-50.0, 50.0))
+        ray = geometry.Line(point, end)
+        found = grid.query_line(ray)
+        expected = [line for line in lines if line.intersection(ray)[0]]
+        assert set(map(id, expected)) <= set(map(id, found))
+
+def test_environment_with_grid_matches_all_walls(maze_env):
+    indexed = maze_env.spawn_agent()
+    brute = maze.MazeEnvironment(agent=copy.deepcopy(indexed.agent), walls=maze_env.walls,
+                                exit_point=maze_env.exit_point, walls_index=AllWalls(maze_env.walls))
+    net = controllers(1, seed=2)[0]
+    for _ in range(300):
+        indexed.update(net.activate(indexed.create_net_inputs()))
+        brute.update(net.activate(brute.create_net_inputs()))
+        assert indexed.create_net_inputs() == brute.create_net_inputs()
+        assert (indexed.agent.location.x, indexed.agent.location.y) == (brute.agent.location.x, brute.agent.location.y)
+
+def test_batch_environment_matches_scalar(maze_env):
+    nets = controllers(12, seed=3)
+    batch = maze.MazeEnvironmentBatch(maze_env, len(nets))
+    envs = [maze_env.spawn_agent() for _ in nets]
+    for _ in range(200):
+        inputs = batch.create_net_inputs()
+        for a, env in enumerate(envs):
+            np.testing.assert_allclose(inputs[a], env.create_net_inputs(), rtol=1e-9, atol=1e-9)
+        batch.update([net.activate(i) for net, i in zip(nets, inputs.tolist())])
+        for net, env in zip(nets, envs):
+            env.update(net.activate(env.create_net_inputs()))
+        np.testing.assert_allclose(batch.x, [env.agent.location.x for env in envs], rtol=1e-9, atol=1e-9)
+        np.testing.assert_allclose(batch.y, [env.agent.location.y for env in envs], rtol=1e-9, atol=1e-9)
+        np.testing.assert_allclose(batch.heading, [env.agent.heading for env in envs], rtol=1e-9, atol=1e-9)
+
+def test_batch_evaluation_matches_scalar(maze_env):
+    nets = controllers(12, seed=4)
+    time_steps = 400
+    expected_items = [NoveltyItem() for _ in nets]
+    expected = [maze.maze_simulation_evaluate(maze_env.spawn_agent(), net, time_steps, n_item=item)
+                for net, item in zip(nets, expected_items)]
+
+    items = [NoveltyItem() for _ in nets]
+    fitness = maze.maze_simulation_evaluate_batch(maze.MazeEnvironmentBatch(maze_env, len(nets)), nets, time_steps,
+                                                n_items=items)
+    np.testing.assert_allclose(fitness, expected, rtol=1e-9)
+    for item, expected_item in zip(items, expected_items):
+        assert item.fitness == pytest.approx(expected_item.fitness, rel=1e-9)
+        np.testing.assert_allclose(item.data, expected_item.data, rtol=1e-9, atol=1e-9)
+
+def test_cast_rays_in_chunks_of_walls():
+    rng = random.Random(5)
+    walls = maze.walls_array(random_segments(rng, 40))
+    x, y = np.array([rng.uniform(0.0, 100.0) for _ in range(30)]), np.array([rng.uniform(0.0, 100.0) for _ in range(30)])
+    headings = np.array([rng.uniform(0.0, 360.0) for _ in range(30)])
+    angles = [-90.0, -45.0, 0.0, 45.0, 90.0, -180.0]
+    expected = maze.cast_rays(x, y, headings, angles, 50.0, walls)
+    assert (expected < 50.0).any()
+    for chunk_size in (1, 7 * len(x) * len(angles), 10 ** 9):
+        assert np.array_equal(maze.cast_rays(x, y, headings, angles, 50.0, walls, chunk_size=chunk_size), expected)
+    assert np.array_equal(maze.cast_rays(x, y, headings, angles, 50.0, walls[:0]), np.full((30, 6), 50.0))
@@ -0,0 +1,148 @@
+#
+# The tests of the novelty archive checking the eviction policies of the archive of
+# bounded size, the collection of the fittest items, and the nearest neighbors index.
+#
+import random
+from collections import namedtuple
+
+import numpy as np
+import pytest
+
+import maze.maze_environment as maze
+import maze.novelty_archive as archive
+
+Genome = namedtuple('Genome', ['key'])
+
+def random_items(n_items, seed, dim=4):
+    rng = random.Random(seed)
+    items = []
+    for key in range(n_items):
+        item = archive.NoveltyItem(genomeId=key, fitness=rng.random())
+        item.data = [rng.uniform(0.0, 100.0) for _ in range(dim)]
+        items.append(item)
+    return items
+
+def add_items(novelty_archive, items):
+    """
+    The function to add items to the archive one by one, each as the only member of its population.
+    """
+    for item in items:
+        genome = Genome(item.genomeId)
+        novelty_archive.evaluate_individual_novelty(genome=genome,
+                                                    genomes=[(genome.key, genome)],
+                                                    n_items_map={genome.key: item})
+
+def least_novel_archive(items, max_size, metric):
+    """
+    The reference implementation of 'least_novel' eviction policy comparing all pairs of items.
+    """
+    kept = []
+    for item in items:
+        kept.append(item)
+        if len(kept) > max_size:
+            nearest = [min(metric(a, b) for b in kept if b is not a) for a in kept]
+            del kept[int(np.argmin(nearest))]
+    return kept
+
+def test_unbounded_archive_keeps_all_items():
+    items = random_items(30, seed=1)
+    novelty_archive = archive.NoveltyArchive(threshold=-1.0, metric=maze.maze_novelty_metric)
+    add_items(novelty_archive, items)
+    assert novelty_archive.novel_items == items
+    assert novelty_archive.items_evicted == 0
+
+def test_oldest_eviction():
+    items = random_items(30, seed=2)
+    novelty_archive = archive.NoveltyArchive(threshold=-1.0, metric=maze.maze_novelty_metric, max_size=8)
+    add_items(novelty_archive, items)
+    assert novelty_archive.novel_items == items[-8:]
+    assert (novelty_archive.items_added, novelty_archive.items_evicted) == (30, 22)
+    assert all(item.in_archive for item in items[-8:])
+    assert not any(item.in_archive for item in items[:-8])
+
+@pytest.mark.parametrize('batch_metric', [None, maze.maze_novelty_metric_batch])
+@pytest.mark.parametrize('knn_index', [None, archive.KDTreeIndex(p=1, leaf_size=4)])
+def test_least_novel_eviction(batch_metric, knn_index):
+    items = random_items(60, seed=3)
+    novelty_archive = archive.NoveltyArchive(threshold=-1.0,
+                                            metric=maze.maze_novelty_metric,
+                                            batch_metric=batch_metric,
+                                            knn_index=knn_index.new_index() if knn_index is not None else None,
+                                            max_size=10,
+                                            eviction='least_novel')
+    add_items(novelty_archive, items)
+    expected = least_novel_archive(items, 10, maze.maze_novelty_metric)
+    assert novelty_archive.novel_items == expected
+    assert novelty_archive.items_evicted == 50
+    if novelty_archive.knn_index is not None:
+        assert len(novelty_archive.knn_index) == 10
+
+def test_reservoir_eviction_is_seeded():
+    items = random_items(100, seed=4)
+    archives = []
+    for seed in (7, 7, 8):
+        novelty_archive = archive.NoveltyArchive(threshold=-1.0, metric=maze.maze_novelty_metric, max_size=10,
+                                                eviction='reservoir', seed=seed)
+        add_items(novelty_archive, items)
+        assert len(novelty_archive.novel_items) == 10
+        assert novelty_archive.items_evicted == 90
+        archives.append([item.genomeId for item in novelty_archive.novel_items])
+    assert archives[0] == archives[1]
+    assert archives[0] != archives[2]
+
+def test_unknown_eviction_policy():
+    with pytest.raises(ValueError):
+        archive.NoveltyArchive(threshold=1.0, metric=maze.maze_novelty_metric, max_size=10, eviction='random')
+
+def test_fittest_items_ordering():
+    rng = random.Random(5)
+    fittest = archive.FittestItems(capacity=5)
+    items = []
+    for key in range(50):
+        # the repeated fitness scores to test ties resolution
+        item = archive.NoveltyItem(genomeId=key, fitness=rng.randint(0, 10) / 10.0, novelty=rng.random())
+        items.append(item)
+        fittest.push(item)
+        # the earlier inserted item ranks higher among items with equal fitness
+        expected = sorted(items, key=lambda i: -i.fitness)[:5]
+        assert list(fittest) == expected
+    assert len(fittest) == 5
+
+def test_fittest_items_of_archive():
+    items = random_items(20, seed=6)
+    novelty_archive = archive.NoveltyArchive(threshold=1.0, metric=maze.maze_novelty_metric, fittest_size=3)
+    n_items_map = {item.genomeId: item for item in items}
+    for item in items:
+        novelty_archive.update_fittest_with_genome(Genome(item.genomeId), n_items_map)
+    assert list(novelty_archive.fittest_items) == sorted(items, key=lambda i: -i.fitness)[:3]
+    assert len(archive.FittestItems(capacity=0)) == 0 and not archive.FittestItems(capacity=0).push(items[0])
+
+@pytest.mark.parametrize('p', [1, 2])
+def test_kd_tree_index_matches_brute_force(p):
+    items = random_items(300, seed=7, dim=3)
+    index = archive.KDTreeIndex(p=p, leaf_size=8)
+    indexed = []
+    rng = random.Random(7)
+    for item in items:
+        index.add(item)
+        indexed.append(item)
+        if rng.random() < 0.3:
+            removed = indexed.pop(rng.randrange(len(indexed)))
+            index.remove(removed)
+        assert len(index) == len(indexed)
+        query = random_items(1, seed=rng.randrange(1000), dim=3)[0]
+        distance = lambda n: np.linalg.norm(np.subtract(n.data, query.data), ord=p)
+        found = index.knn(query, 5)
+        expected = sorted(indexed, key=distance)[:5]
+        assert sorted(distance(n) for n in found) == pytest.approx([distance(n) for n in expected])
+
+@pytest.mark.parametrize('chunk_size', [1, 37, 10 ** 9])
+def test_context_distances_in_chunks(chunk_size):
+    archived, population = random_items(23, seed=8), random_items(17, seed=9)
+    context = archive.NoveltyContext(archived, population, maze.maze_novelty_metric_batch, chunk_size=chunk_size)
+    data, archive_data = np.array([i.data for i in population]), np.array([i.data for i in archived])
+    np.testing.assert_array_equal(context.archive_distances, maze.maze_novelty_metric_batch(data, archive_data))
+    np.testing.assert_array_equal(context.population_distances, maze.maze_novelty_metric_batch(data, data))
+
+    context = archive.NoveltyContext([], population, maze.maze_novelty_metric_batch, chunk_size=chunk_size)
+    assert context.archive_distances.shape == (17, 0)
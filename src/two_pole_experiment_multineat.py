@@ -21,21 +21,65 @@ import utils
 import pole.cart_two_pole as cart
 
 from experiment import evaluate_experiment
-from experiment import ANNWrapper
+from experiment import PhaseTimer
+from experiment import ANNWrapper, prune_multineat_network
+from experiment import GenomeListEvaluator
+from experiment import worker_settings
+from experiment import FitnessCache, multineat_genome_hash
+
+# The number of time steps of the first stage of evaluation with successive
+# halving of horizon or None to simulate all genomes for the full horizon
+min_horizon = None
+# The rate of horizon increase and survivors reduction between stages
+horizon_eta = 2
+# The number of worker processes to evaluate genomes of each generation
+eval_workers = 1
+# The number of genomes evaluated by worker process at once or None to split evenly
+eval_chunk_size = None
+# The maximal number of fitness scores cached for structurally identical genomes (0 - disabled)
+fitness_cache_size = 10000
+
+# The names of settings assigned from command line arguments to initialize worker processes with
+WORKER_SETTINGS = ('min_horizon', 'horizon_eta', 'eval_workers', 'eval_chunk_size', 'fitness_cache_size')
 
 def evaluate(genome):
     multi_net = NEAT.NeuralNetwork()
     genome.BuildPhenotype(multi_net)
+    multi_net, _, _ = prune_multineat_network(multi_net)
 
     multi_net.Flush()
     fitness = cart.eval_fitness(net=ANNWrapper(multi_net))
     return fitness
 
+def evaluate_batch(genome_list, timer=None):
+    """
+    The function to evaluate fitness scores of all genomes in the list
+    using batch cart-two-pole simulation.
+    Arguments:
+        genome_list: The list of genomes to be evaluated
+        timer:       The PhaseTimer to count neurons and links removed by pruning into or None
+    Returns:
+        The list of fitness scores in order of genomes in the list
+    """
+    nets = []
+    for genome in genome_list:
+        multi_net = NEAT.NeuralNetwork()
+        genome.BuildPhenotype(multi_net)
+        multi_net, removed_neurons, removed_links = prune_multineat_network(multi_net)
+        if timer is not None:
+            timer.count('pruned_nodes', removed_neurons)
+            timer.count('pruned_links', removed_links)
+        multi_net.Flush()
+        nets.append(ANNWrapper(multi_net))
+
+    fitnesses = cart.eval_fitness_batch(nets=nets, min_horizon=min_horizon, eta=horizon_eta)
+    return fitnesses.tolist()
 
 def get_fitness(genome):
     return genome.GetFitness()
 
-def run_experiment(config_file, trial_id, n_generations, out_dir, view_results=False, save_results=True):
+def run_experiment(config_file, trial_id, n_generations, out_dir, view_results=False, save_results=True, seed=None, 
+                    timer=None):
     """
     The function to run the experiment against hyper-parameters 
     defined in the provided configuration file.
@@ -49,6 +93,8 @@ def run_experiment(config_file, trial_id, n_generations, out_dir, view_results=F
         out_dir:        The directory to save intermediate results.
         view_results:   The flag to control if intermediate results should be displayed after each trial
         save_results:   The flag to control whether intermediate results should be saved after each trial.
+        seed:           The random seed of the trial or None to use current time.
+        timer:          The PhaseTimer to report phases durations and counts into or None.
     Returns:
         The tuple (solution_found, generation, complexity, best_genome_fitness) that has flag indicating whether
         solution was found, the generation when solution was found, the complextity of best genome, and the fitness
@@ -59,35 +105,52 @@ def run_experiment(config_file, trial_id, n_generations, out_dir, view_results=F
     pop = NEAT.Population(g, params, True, 1.0, trial_id)
 
      # set random seed
-    seed = int(time.time())
+    if seed is None:
+        seed = int(time.time())
     pop.RNG.Seed(seed)
 
     generations = 0
     solved = False
     best_trial_fitness = 0
     best_trial_complexity = 0
-    for generation in range(n_generations):
-        genome_list = NEAT.GetGenomeList(pop)
-        fitness_list = EvaluateGenomeList_Serial(genome_list, evaluate, display=view_results)
-        NEAT.ZipFitness(genome_list, fitness_list)
-        generations = generation
-        best = max(genome_list, key=get_fitness)
-        best_fitness = best.GetFitness()
-        complexity = best.NumNeurons() + best.NumLinks()
-        solved = best_fitness >= cart.MAX_FITNESS # Changed to correspond limit used with other tested libraries
-        if solved:
-            best_trial_fitness = best_fitness
-            best_trial_complexity = complexity
-            print("Trial: %2d\tgeneration: %d\tfitness: %f\tcomplexity: %d\tseed: %d" % 
-                    (trial_id, generations, best_trial_fitness, complexity, seed))
-            break
-        # check if best fitness in this generation is better than current maximum
-        if best_fitness > best_trial_fitness:
-            best_trial_complexity = complexity
-            best_trial_fitness = best_fitness
-
-        # move to the next epoch
-        pop.Epoch()
+    # The fitness scores are cached only if each genome is evaluated on its own, the
+    # staged evaluation ranks genomes of the generation against each other
+    cache = FitnessCache(multineat_genome_hash, max_size=fitness_cache_size, deterministic=min_horizon is None)
+    initializer, initargs = worker_settings(__name__, WORKER_SETTINGS)
+    if timer is None:
+        timer = PhaseTimer()
+    evaluator = GenomeListEvaluator(evaluate_batch, workers=eval_workers, chunk_size=eval_chunk_size, cache=cache,
+                                    initializer=initializer, initargs=initargs, timer=timer)
+    try:
+        for generation in range(n_generations):
+            timer.start_generation()
+            genome_list = NEAT.GetGenomeList(pop)
+            with timer.phase('evaluation'):
+                fitness_list = evaluator.evaluate(genome_list)
+                NEAT.ZipFitness(genome_list, fitness_list)
+            timer.count('evaluated_genomes', len(genome_list))
+            generations = generation
+            best = max(genome_list, key=get_fitness)
+            best_fitness = best.GetFitness()
+            complexity = best.NumNeurons() + best.NumLinks()
+            solved = best_fitness >= cart.MAX_FITNESS # Changed to correspond limit used with other tested libraries
+            if solved:
+                best_trial_fitness = best_fitness
+                best_trial_complexity = complexity
+                print("Trial: %2d\tgeneration: %d\tfitness: %f\tcomplexity: %d\tseed: %d" % 
+                        (trial_id, generations, best_trial_fitness, complexity, seed))
+                break
+            # check if best fitness in this generation is better than current maximum
+            if best_fitness > best_trial_fitness:
+                best_trial_complexity = complexity
+                best_trial_fitness = best_fitness
+
+            # move to the next epoch
+            with timer.phase('reproduction'):
+                pop.Epoch()
+    finally:
+        evaluator.close()
+    evaluator.print_statistics()
             
     if not solved:
         print("Trial: %2d\tFAILED\t\tfitness: %f\tcomplexity: %d\tseed: %d" % 
@@ -133,7 +196,36 @@ if __name__ == '__main__':
                         help='The number of generations for the evolutionary process.')
     parser.add_argument('-t', '--trials', type=int, default=10,
                         help="The number of experiment trials.")
+    parser.add_argument('-w', '--workers', type=int, default=1,
+                        help="The number of worker processes to run experiment trials in parallel.")
+    parser.add_argument('--min_horizon', type=int, default=None,
+                        help="The first stage horizon of evaluation with successive halving (None - full horizon for all genomes).")
+    parser.add_argument('--horizon_eta', type=int, default=2,
+                        help="The rate of horizon increase and survivors reduction between evaluation stages.")
+    parser.add_argument('--eval_workers', type=int, default=1,
+                        help="The number of worker processes to evaluate genomes of each generation.")
+    parser.add_argument('--eval_chunk_size', type=int, default=None,
+                        help="The number of genomes evaluated by worker process at once (None - split evenly).")
+    parser.add_argument('--fitness_cache_size', type=int, default=10000,
+                        help="The maximal number of fitness scores cached for structurally identical genomes (0 - disabled).")
+    parser.add_argument('--seed', type=int, default=None,
+                        help="The master seed to derive random seeds of trials (None - current time).")
+    parser.add_argument('--cpu_time_score', action='store_true',
+                        help="Estimate efficiency score with CPU time per epoch rather than with wall-clock time.")
+    parser.add_argument('--trace_memory', action='store_true',
+                        help="Trace memory allocations of trials with tracemalloc to find peak memory usage (slow).")
+    parser.add_argument('--resume', action='store_true',
+                        help="Resume the interrupted experiment skipping trials with results stored in the output directory.")
     args = parser.parse_args()
+    if args.min_horizon is not None and args.min_horizon < 1:
+        parser.error("The first stage horizon must be at least one time step: %d" % args.min_horizon)
+    if args.horizon_eta < 2:
+        parser.error("The rate of horizon increase must be at least two: %d" % args.horizon_eta)
+    min_horizon = args.min_horizon
+    horizon_eta = args.horizon_eta
+    eval_workers = args.eval_workers
+    eval_chunk_size = args.eval_chunk_size
+    fitness_cache_size = args.fitness_cache_size
 
     # The current working directory
     local_dir = os.path.dirname(__file__)
@@ -142,7 +234,11 @@ if __name__ == '__main__':
     out_dir = os.path.join(local_dir, '../out/pole/multineat')
 
     # Clean results of previous run if any or init the ouput directory
-    utils.clear_output(out_dir=out_dir)
+    if args.resume:
+        # keep results of trials finished before
+        os.makedirs(out_dir, exist_ok=True)
+    else:
+        utils.clear_output(out_dir=out_dir)
 
     # Prepare hyper-parameters
     params = build_parameters()
@@ -152,10 +248,19 @@ if __name__ == '__main__':
     print("  MultiNEAT Library")
     print("  Two Pole-Balancing Experiment")
     print("************************************\n")
+    initializer, initargs = worker_settings(__name__, WORKER_SETTINGS)
     results = evaluate_experiment(args, 
                         eval_function=run_experiment, 
                         config=params, 
                         max_fitness=cart.MAX_FITNESS, # The maximal fitness score in accordance with fitness function definition
-                        out_dir=out_dir)
+                        out_dir=out_dir, 
+                        experiment_name='two_pole',
+                        library='MultiNEAT',
+                        initializer=initializer,
+                        initargs=initargs)
                         
-    results.print_statistics()
\ No newline at end of file
+    results.print_statistics()
+
+    # Store results of trials along with phases durations and counts
+    results.write_json(os.path.join(out_dir, 'results.json'))
+    results.write_csv(os.path.join(out_dir, 'results.csv'))
@@ -18,24 +18,76 @@ import utils
 # The cart-pole simulator
 import pole.cart_two_pole as cart
 
+# The compiled phenotypes
+from utils.compiled_net import PopulationNetwork
+
 from experiment import evaluate_experiment
+from experiment import PhaseTimer, PhaseTimerReporter, OUTPUT_PHASE
+from experiment import GenomeListEvaluator
+from experiment import worker_settings
+from experiment import FitnessCache, neat_genome_hash
+
+# The number of time steps of the first stage of evaluation with successive
+# halving of horizon or None to simulate all genomes for the full horizon
+min_horizon = None
+# The rate of horizon increase and survivors reduction between stages
+horizon_eta = 2
+# The backend of genomes evaluator: 'serial', 'process', or 'thread'
+eval_backend = 'serial'
+# The number of workers to evaluate genomes of each generation
+eval_workers = 1
+# The number of genomes evaluated by worker at once or None to split evenly
+eval_chunk_size = None
+# The maximal number of fitness scores cached for structurally identical genomes (0 - disabled)
+fitness_cache_size = 10000
+
+# The names of settings assigned from command line arguments to initialize worker processes with
+WORKER_SETTINGS = ('min_horizon', 'horizon_eta', 'eval_backend', 'eval_workers', 'eval_chunk_size', 'fitness_cache_size')
+
+def evaluate_batch(genome_list, config, timer=None):
+    """
+    The function to evaluate fitness scores of all genomes in the list
+    using batch cart-two-pole simulation.
+    Arguments:
+        genome_list:    The list of genomes to be evaluated
+        config:         The configuration settings with algorithm
+                        hyper-parameters
+        timer:          The PhaseTimer to count nodes and links removed by pruning into or None
+    Returns:
+        The list of fitness scores in order of genomes in the list
+    """
+    # compile phenotypes of all genomes to be activated at once
+    nets = PopulationNetwork.create(genome_list, config)
+    if timer is not None:
+        timer.count('pruned_nodes', nets.removed_nodes)
+        timer.count('pruned_links', nets.removed_links)
+
+    # evaluate all genomes in one batch
+    fitnesses = cart.eval_fitness_batch(nets, min_horizon=min_horizon, eta=horizon_eta)
+    return fitnesses.tolist()
 
-def eval_genomes(genomes, config):
+def eval_genomes(genomes, config, evaluator=None):
     """
     The function to evaluate the fitness of each genome in 
     the genomes list.
     Arguments:
-        genomes: The list of genomes from population in the 
-                 current generation
-        config:  The configuration settings with algorithm
-                 hyper-parameters
+        genomes:    The list of genomes from population in the 
+                    current generation
+        config:     The configuration settings with algorithm
+                    hyper-parameters
+        evaluator:  The GenomeListEvaluator to evaluate genomes with or None
+                    to evaluate them in the current thread.
     """
-    for _, genome in genomes:
-        genome.fitness = 0.0
-        net = neat.nn.FeedForwardNetwork.create(genome, config)
-        genome.fitness = cart.eval_fitness(net)
+    genome_list = [genome for _, genome in genomes]
+    if evaluator is None:
+        fitnesses = evaluate_batch(genome_list, config)
+    else:
+        fitnesses = evaluator.evaluate(genome_list, config)
+    for (_, genome), fitness in zip(genomes, fitnesses):
+        genome.fitness = float(fitness)
 
-def run_experiment(config_file, trial_id, n_generations, out_dir, view_results=False, save_results=True):
+def run_experiment(config_file, trial_id, n_generations, out_dir, view_results=False, save_results=True, seed=None, 
+                    timer=None):
     """
     The function to run the experiment against hyper-parameters 
     defined in the provided configuration file.
@@ -44,9 +96,12 @@ def run_experiment(config_file, trial_id, n_generations, out_dir, view_results=F
     Arguments:
         config_file: the path to the file with experiment 
                     configuration
+        seed:       the random seed of the trial or None to use current time
+        timer:      the PhaseTimer to report phases durations and counts into or None.
     """
     # set random seed
-    seed = int(time.time())
+    if seed is None:
+        seed = int(time.time())
     random.seed(seed)
 
     # Load configuration.
@@ -62,8 +117,39 @@ def run_experiment(config_file, trial_id, n_generations, out_dir, view_results=F
     stats = neat.StatisticsReporter()
     p.add_reporter(stats)
 
+    # Add the reporter of generations and reproduction phase durations
+    if timer is None:
+        timer = PhaseTimer()
+    p.add_reporter(PhaseTimerReporter(timer))
+
+    # The fitness scores are cached only if each genome is evaluated on its own, the
+    # staged evaluation ranks genomes of the generation against each other
+    cache = FitnessCache(neat_genome_hash, max_size=fitness_cache_size, deterministic=min_horizon is None)
+
+    # Create the evaluator of genomes with workers reused by all generations
+    initializer, initargs = worker_settings(__name__, WORKER_SETTINGS)
+    evaluator = GenomeListEvaluator(evaluate_batch, 
+                                    workers=eval_workers, 
+                                    chunk_size=eval_chunk_size, 
+                                    backend=eval_backend,
+                                    initializer=initializer,
+                                    initargs=initargs,
+                                    cache=cache,
+                                    timer=timer)
+
+    # The fitness function reporting the evaluation phase
+    def fitness_function(genomes, config):
+        with timer.phase('evaluation'):
+            eval_genomes(genomes, config, evaluator=evaluator)
+        timer.count('evaluated_genomes', len(genomes))
+
     # Run for up to N generations.
-    best_genome = p.run(eval_genomes, n=n_generations)
+    try:
+        best_genome = p.run(fitness_function, n=n_generations)
+    finally:
+        evaluator.close()
+    if evaluator.backend != 'serial' or cache.enabled:
+        evaluator.print_statistics()
 
     # Check if the best genome is a winning Sinle-Pole balancing controller 
     #net = neat.nn.FeedForwardNetwork.create(best_genome, config)
@@ -81,10 +167,11 @@ def run_experiment(config_file, trial_id, n_generations, out_dir, view_results=F
 
     # Visualize the experiment results
     if save_results:
-        node_names = {-1:'x', -2:'dot_x', -3:'θ_1', -4:'dot_θ_1', -5:'θ_2', -6:'dot_θ_2', 0:'action'}
-        visualize.draw_net(config, best_genome, view=view_results, node_names=node_names, directory=out_dir, fmt='svg')
-        visualize.plot_stats(stats, ylog=False, view=view_results, filename=os.path.join(out_dir, 'avg_fitness.svg'))
-        visualize.plot_species(stats, view=view_results, filename=os.path.join(out_dir, 'speciation.svg'))
+        with timer.phase(OUTPUT_PHASE):
+            node_names = {-1:'x', -2:'dot_x', -3:'θ_1', -4:'dot_θ_1', -5:'θ_2', -6:'dot_θ_2', 0:'action'}
+            visualize.draw_net(config, best_genome, view=view_results, node_names=node_names, directory=out_dir, fmt='svg')
+            visualize.plot_stats(stats, ylog=False, view=view_results, filename=os.path.join(out_dir, 'avg_fitness.svg'))
+            visualize.plot_species(stats, view=view_results, filename=os.path.join(out_dir, 'speciation.svg'))
 
     return solution_found, p.generation, complexity, best_genome_fitness
 
@@ -96,9 +183,41 @@ if __name__ == '__main__':
                         help='The number of generations for the evolutionary process.')
     parser.add_argument('-t', '--trials', type=int, default=10,
                         help="The number of experiment trials.")
+    parser.add_argument('-w', '--workers', type=int, default=1,
+                        help="The number of worker processes to run experiment trials in parallel.")
+    parser.add_argument('--min_horizon', type=int, default=None,
+                        help="The first stage horizon of evaluation with successive halving (None - full horizon for all genomes).")
+    parser.add_argument('--horizon_eta', type=int, default=2,
+                        help="The rate of horizon increase and survivors reduction between evaluation stages.")
+    parser.add_argument('--eval_backend', default='serial', choices=['serial', 'process', 'thread'],
+                        help="The backend of workers to evaluate genomes of each generation.")
+    parser.add_argument('--eval_workers', type=int, default=1,
+                        help="The number of workers to evaluate genomes of each generation.")
+    parser.add_argument('--eval_chunk_size', type=int, default=None,
+                        help="The number of genomes evaluated by worker at once (None - split evenly).")
+    parser.add_argument('--fitness_cache_size', type=int, default=10000,
+                        help="The maximal number of fitness scores cached for structurally identical genomes (0 - disabled).")
+    parser.add_argument('--seed', type=int, default=None,
+                        help="The master seed to derive random seeds of trials (None - current time).")
+    parser.add_argument('--cpu_time_score', action='store_true',
+                        help="Estimate efficiency score with CPU time per epoch rather than with wall-clock time.")
+    parser.add_argument('--trace_memory', action='store_true',
+                        help="Trace memory allocations of trials with tracemalloc to find peak memory usage (slow).")
+    parser.add_argument('--resume', action='store_true',
+                        help="Resume the interrupted experiment skipping trials with results stored in the output directory.")
     parser.add_argument('-s', '--save_results', type=bool, default=False,
                         help="Controls whether to save intermediate execution results.")
     args = parser.parse_args()
+    if args.min_horizon is not None and args.min_horizon < 1:
+        parser.error("The first stage horizon must be at least one time step: %d" % args.min_horizon)
+    if args.horizon_eta < 2:
+        parser.error("The rate of horizon increase must be at least two: %d" % args.horizon_eta)
+    min_horizon = args.min_horizon
+    horizon_eta = args.horizon_eta
+    eval_backend = args.eval_backend
+    eval_workers = args.eval_workers
+    eval_chunk_size = args.eval_chunk_size
+    fitness_cache_size = args.fitness_cache_size
 
     # The current working directory
     local_dir = os.path.dirname(__file__)
@@ -112,18 +231,31 @@ if __name__ == '__main__':
     out_dir = os.path.join(local_dir, '../out/two_poles/neat')
 
     # Clean results of previous run if any or init the ouput directory
-    utils.clear_output(out_dir=out_dir)
+    if args.resume:
+        # keep results of trials finished before
+        os.makedirs(out_dir, exist_ok=True)
+    else:
+        utils.clear_output(out_dir=out_dir)
 
     # Run the experiment for a number of trials
     print("\n************************************")
     print("  NEAT-Python Library")
     print("  Two Pole-Balancing Experiment")
     print("************************************\n")
+    initializer, initargs = worker_settings(__name__, WORKER_SETTINGS)
     results = evaluate_experiment(args, 
                         eval_function=run_experiment, 
                         config=config_path, 
                         max_fitness=cart.MAX_FITNESS, # the maximal allowed fitness value as given by fitness function
                         out_dir=out_dir, 
-                        save_results=args.save_results)
+                        save_results=args.save_results, 
+                        experiment_name='two_pole',
+                        library='NEAT-Python',
+                        initializer=initializer,
+                        initargs=initargs)
     
-    results.print_statistics()
\ No newline at end of file
+    results.print_statistics()
+
+    # Store results of trials along with phases durations and counts
+    results.write_json(os.path.join(out_dir, 'results.json'))
+    results.write_csv(os.path.join(out_dir, 'results.csv'))
@@ -0,0 +1,518 @@
+#
+# The phenotype compiler which turns NEAT-Python genomes into the layered
+# weight matrices form. The compiled networks are activated with NumPy matrix
+# multiplications either for many input vectors at once or for the whole
+# population of networks padded to the common shape.
+#
+import copy
+
+import numpy as np
+
+from neat.graphs import feed_forward_layers
+from neat.nn import FeedForwardNetwork
+from neat.activations import ActivationFunctionSet
+from neat.aggregations import sum_aggregation
+
+def sigmoid_activation(z):
+    z = np.clip(5.0 * z, -60.0, 60.0)
+    return 1.0 / (1.0 + np.exp(-z))
+
+def tanh_activation(z):
+    z = np.clip(2.5 * z, -60.0, 60.0)
+    return np.tanh(z)
+
+def sin_activation(z):
+    z = np.clip(5.0 * z, -60.0, 60.0)
+    return np.sin(z)
+
+def gauss_activation(z):
+    z = np.clip(z, -3.4, 3.4)
+    return np.exp(-5.0 * z**2)
+
+def relu_activation(z):
+    return np.maximum(z, 0.0)
+
+def softplus_activation(z):
+    z = np.clip(5.0 * z, -60.0, 60.0)
+    return 0.2 * np.log(1 + np.exp(z))
+
+def identity_activation(z):
+    return z
+
+def clamped_activation(z):
+    return np.clip(z, -1.0, 1.0)
+
+def exp_activation(z):
+    z = np.clip(z, -60.0, 60.0)
+    return np.exp(z)
+
+def abs_activation(z):
+    return np.abs(z)
+
+def hat_activation(z):
+    return np.maximum(0.0, 1 - np.abs(z))
+
+def square_activation(z):
+    return z ** 2
+
+def cube_activation(z):
+    return z ** 3
+
+# The vectorized counterparts of the NEAT-Python activation functions by name
+ACTIVATIONS = {
+    'sigmoid':  sigmoid_activation,
+    'tanh':     tanh_activation,
+    'sin':      sin_activation,
+    'gauss':    gauss_activation,
+    'relu':     relu_activation,
+    'softplus': softplus_activation,
+    'identity': identity_activation,
+    'clamped':  clamped_activation,
+    'exp':      exp_activation,
+    'abs':      abs_activation,
+    'hat':      hat_activation,
+    'square':   square_activation,
+    'cube':     cube_activation,
+}
+# The names of vectorized activation functions
+ACTIVATION_NAMES = {activation: name for name, activation in ACTIVATIONS.items()}
+
+class CompiledNetwork:
+    """
+    The feed-forward network compiled into the layered weight matrices form.
+    It can be used as a drop-in replacement for neat.nn.FeedForwardNetwork.
+    """
+    def __init__(self, n_inputs, n_outputs, n_values, layers):
+        """
+        Creates new compiled network.
+        Arguments:
+            n_inputs:   The number of network inputs.
+            n_outputs:  The number of network outputs.
+            n_values:   The number of values of all network nodes. The inputs values stored
+                        first followed by the outputs values and the hidden nodes values.
+            layers:     The list of compiled layers as returned by compile_layers.
+        """
+        self.n_inputs = n_inputs
+        self.n_outputs = n_outputs
+        self.n_values = n_values
+        self.layers = layers
+        # the values of the network nodes
+        self.values = np.zeros(n_values)
+        # the numbers of nodes and links removed by pruning
+        self.removed_nodes = 0
+        self.removed_links = 0
+
+    def activate(self, inputs):
+        """
+        Function to activate this network with given inputs
+        Argumnets:
+            inputs: the list with network inputs.
+        Returns:
+            The list of network outputs.
+        """
+        if self.n_inputs != len(inputs):
+            raise RuntimeError("Expected {0:n} inputs, got {1:n}".format(self.n_inputs, len(inputs)))
+
+        values = self.values
+        values[:self.n_inputs] = inputs
+        for weights, bias, response, nodes, activations in self.layers:
+            z = bias + response * weights.dot(values)
+            for name, indices in activations:
+                values[nodes[indices]] = ACTIVATIONS[name](z[indices])
+
+        return values[self.n_inputs:self.n_inputs + self.n_outputs].tolist()
+
+    def activate_batch(self, inputs):
+        """
+        Function to activate this network with many input vectors at once.
+        Argumnets:
+            inputs: the array of network inputs with shape (batch_size, n_inputs).
+        Returns:
+            The array of network outputs with shape (batch_size, n_outputs).
+        """
+        inputs = np.asarray(inputs, dtype=float)
+        values = np.zeros((len(inputs), self.n_values))
+        values[:, :self.n_inputs] = inputs
+        for weights, bias, response, nodes, activations in self.layers:
+            z = bias + response * values.dot(weights.T)
+            for name, indices in activations:
+                values[:, nodes[indices]] = ACTIVATIONS[name](z[:, indices])
+
+        return values[:, self.n_inputs:self.n_inputs + self.n_outputs]
+
+    @staticmethod
+    def create(genome, config, prune=True):
+        """
+        Receives a genome and returns its compiled phenotype.
+        Arguments:
+            genome: The NEAT-Python genome.
+            config: The NEAT-Python configuration.
+            prune:  The flag to control whether nodes not contributing to outputs should be removed.
+        Returns:
+            The CompiledNetwork.
+        """
+        genome_config = config.genome_config
+        n_values, layers, (removed_nodes, removed_links) = compile_layers(genome, config, prune)
+        net = CompiledNetwork(len(genome_config.input_keys), len(genome_config.output_keys), n_values, layers)
+        net.removed_nodes, net.removed_links = removed_nodes, removed_links
+        return net
+
+class PopulationNetwork:
+    """
+    The networks of the population compiled into the layered weight matrices form
+    and padded to the common shape. It allows to activate all networks of the population
+    at once, each with its own input vector.
+    """
+    def __init__(self, n_inputs, n_outputs, weights, bias, response, nodes, activations):
+        """
+        Creates new population network.
+        Arguments:
+            n_inputs:       The number of inputs of each network.
+            n_outputs:      The number of outputs of each network.
+            weights:        The weights array with shape (layers, networks, layer_width, values + 1)
+            bias:           The nodes bias array with shape (layers, networks, layer_width)
+            response:       The nodes response array with shape (layers, networks, layer_width)
+            nodes:          The indices of nodes values with shape (layers, networks, layer_width). The
+                            padded nodes refer the last placeholder value.
+            activations:    The list with (activation, mask) tuples for each layer, where mask
+                            is the boolean array (networks, layer_width) marking nodes with
+                            this activation function or None if all nodes in the layer use it.
+        """
+        self.n_inputs = n_inputs
+        self.n_outputs = n_outputs
+        self.weights = weights
+        self.bias = bias
+        self.response = response
+        self.nodes = nodes
+        self.activations = activations
+        # the values of the nodes of all networks
+        self.values = np.zeros(weights.shape[1:2] + weights.shape[3:])
+        self._rows = np.arange(len(self.values))[:, None]
+        # the numbers of nodes and links removed by pruning from all networks
+        self.removed_nodes = 0
+        self.removed_links = 0
+
+    def __len__(self):
+        return len(self.values)
+
+    def activate(self, inputs):
+        """
+        Function to activate all networks with given inputs.
+        Argumnets:
+            inputs: the array of inputs with shape (networks, n_inputs), one
+                    input vector per network.
+        Returns:
+            The array of network outputs with shape (networks, n_outputs).
+        """
+        values = self.values
+        values[:, :self.n_inputs] = inputs
+        for l, activations in enumerate(self.activations):
+            z = np.matmul(self.weights[l], values[:, :, None])[:, :, 0]
+            z *= self.response[l]
+            z += self.bias[l]
+            if len(activations) == 1 and activations[0][1] is None:
+                a = activations[0][0](z)
+            else:
+                a = np.zeros_like(z)
+                for activation, mask in activations:
+                    a[mask] = activation(z[mask])
+            values[self._rows, self.nodes[l]] = a
+
+        return values[:, self.n_inputs:self.n_inputs + self.n_outputs]
+
+    def network(self, index):
+        """
+        Function to get the single network of the population as NEAT-Python network, which
+        is activated with single input vector much faster than the population network of one.
+        Arguments:
+            index: The index of network in the population.
+        Returns:
+            The neat.nn.FeedForwardNetwork with the nodes and connections of selected network.
+        """
+        functions = ActivationFunctionSet()
+        placeholder = self.values.shape[1] - 1
+        node_evals = []
+        for l, layer_activations in enumerate(self.activations):
+            names = {}
+            for activation, mask in layer_activations:
+                indices = range(self.nodes.shape[2]) if mask is None else np.flatnonzero(mask[index])
+                for i in indices:
+                    names[i] = ACTIVATION_NAMES[activation]
+            for i, node in enumerate(self.nodes[l, index].tolist()):
+                if node == placeholder:
+                    continue
+                weights = self.weights[l, index, i]
+                links = [(j, float(weights[j])) for j in np.flatnonzero(weights).tolist()]
+                node_evals.append((node, functions.get(names[i]), sum_aggregation, 
+                                    float(self.bias[l, index, i]), float(self.response[l, index, i]), links))
+        inputs = list(range(self.n_inputs))
+        outputs = list(range(self.n_inputs, self.n_inputs + self.n_outputs))
+        return FeedForwardNetwork(inputs, outputs, node_evals)
+
+    def select(self, mask):
+        """
+        Function to create population network holding only selected networks.
+        Arguments:
+            mask: The boolean mask or indices of networks to be selected.
+        Returns:
+            The new PopulationNetwork with selected networks.
+        """
+        activations = []
+        for layer_activations in self.activations:
+            activations.append([(activation, m if m is None else m[mask]) for activation, m in layer_activations])
+        return PopulationNetwork(self.n_inputs, self.n_outputs, self.weights[:, mask], self.bias[:, mask],
+                                self.response[:, mask], self.nodes[:, mask], activations)
+
+    @staticmethod
+    def create(genomes, config, prune=True):
+        """
+        Receives genomes and returns their phenotypes compiled into the population network.
+        Arguments:
+            genomes: The list of NEAT-Python genomes.
+            config:  The NEAT-Python configuration.
+            prune:   The flag to control whether nodes not contributing to outputs should be removed.
+        Returns:
+            The PopulationNetwork.
+        """
+        genome_config = config.genome_config
+        compiled = [compile_layers(genome, config, prune) for genome in genomes]
+        n_networks = len(compiled)
+        n_layers = max([len(layers) for _, layers, _ in compiled] + [0])
+        width = max([len(layer[3]) for _, layers, _ in compiled for layer in layers] + [0])
+        # the last value is a placeholder to store values of padded nodes
+        n_values = max([n for n, _, _ in compiled] + [0]) + 1
+        placeholder = n_values - 1
+
+        weights = np.zeros((n_layers, n_networks, width, n_values))
+        bias = np.zeros((n_layers, n_networks, width))
+        response = np.zeros((n_layers, n_networks, width))
+        nodes = np.full((n_layers, n_networks, width), placeholder, dtype=int)
+        names = np.full((n_layers, n_networks, width), None, dtype=object)
+        for g, (n, layers, _) in enumerate(compiled):
+            for l, (w, b, r, n_idx, activations) in enumerate(layers):
+                size = len(n_idx)
+                weights[l, g, :size, :n] = w
+                bias[l, g, :size] = b
+                response[l, g, :size] = r
+                nodes[l, g, :size] = n_idx
+                for name, indices in activations:
+                    names[l, g, indices] = name
+
+        activations = []
+        for l in range(n_layers):
+            used = set(name for name in names[l].flat if name is not None)
+            if len(used) <= 1:
+                # padded nodes will be written into placeholder value
+                name = used.pop() if used else 'identity'
+                activations.append([(ACTIVATIONS[name], None)])
+            else:
+                activations.append([(ACTIVATIONS[name], names[l] == name) for name in sorted(used)])
+
+        population = PopulationNetwork(len(genome_config.input_keys), len(genome_config.output_keys),
+                                    weights, bias, response, nodes, activations)
+        population.removed_nodes = sum(removed_nodes for _, _, (removed_nodes, _) in compiled)
+        population.removed_links = sum(removed_links for _, _, (_, removed_links) in compiled)
+        return population
+
+class NetworkList:
+    """
+    The adapter providing PopulationNetwork interface for the list of networks
+    which can be activated only one by one, e.g., MultiNEAT networks.
+    """
+    def __init__(self, nets):
+        """
+        Creates new adapter for the list of networks.
+        Arguments:
+            nets: The list of networks with activate function.
+        """
+        self.nets = nets
+
+    def __len__(self):
+        return len(self.nets)
+
+    def activate(self, inputs):
+        """
+        Function to activate all networks with given inputs.
+        Argumnets:
+            inputs: the array of inputs with shape (networks, n_inputs), one
+                    input vector per network.
+        Returns:
+            The list of network outputs.
+        """
+        if isinstance(inputs, np.ndarray):
+            inputs = inputs.tolist()
+        return [net.activate(i) for net, i in zip(self.nets, inputs)]
+
+    def network(self, index):
+        """
+        Function to get the single network of the list.
+        Arguments:
+            index: The index of network in the list.
+        Returns:
+            The selected network.
+        """
+        return self.nets[index]
+
+    def select(self, mask):
+        """
+        Function to create adapter holding only selected networks.
+        Arguments:
+            mask: The boolean mask or indices of networks to be selected.
+        Returns:
+            The new NetworkList with selected networks.
+        """
+        indices = np.arange(len(self.nets))[mask]
+        return NetworkList([self.nets[i] for i in indices])
+
+def as_population(nets):
+    """
+    The function to get population network interface for provided networks.
+    Arguments:
+        nets: The PopulationNetwork or the list of networks.
+    Returns:
+        The PopulationNetwork or NetworkList adapter for the list of networks.
+    """
+    if isinstance(nets, (PopulationNetwork, NetworkList)):
+        return nets
+    return NetworkList(nets)
+
+def compile_layers(genome, config, prune=True):
+    """
+    The function to compile the feed-forward phenotype of genome into the layered
+    weight matrices form. The nodes are evaluated layer by layer in the same order as
+    in the neat.nn.FeedForwardNetwork.
+    Arguments:
+        genome: The NEAT-Python genome.
+        config: The NEAT-Python configuration.
+        prune:  The flag to control whether nodes not contributing to outputs should be removed.
+    Returns:
+        The tuple (n_values, layers, removed) with total number of nodes values, the list of layers,
+        and the tuple (removed_nodes, removed_links) with the numbers of evaluated nodes and enabled
+        connections removed by pruning. Each layer is a tuple (weights, bias, response, nodes, activations),
+        where weights is the matrix (layer_width, n_values), nodes holds indices of layer nodes values and
+        activations is the list of (activation name, indices) tuples for the layer nodes.
+    """
+    genome_config = config.genome_config
+    input_keys, output_keys = genome_config.input_keys, genome_config.output_keys
+
+    # Gather expressed connections.
+    connections = [cg.key for cg in genome.connections.values() if cg.enabled]
+    node_layers = feed_forward_layers(input_keys, output_keys, connections)
+    removed = (0, 0)
+    if prune:
+        n_nodes, n_links = sum(len(layer) for layer in node_layers), len(connections)
+        node_layers, connections = prune_layers(input_keys, output_keys, connections, node_layers)
+        removed = (n_nodes - sum(len(layer) for layer in node_layers), n_links - len(connections))
+
+    # Assign values indices: inputs first, then outputs, and hidden nodes in order of evaluation
+    index = {}
+    for key in input_keys + output_keys:
+        index[key] = len(index)
+    for layer in node_layers:
+        for node in layer:
+            if node not in index:
+                index[node] = len(index)
+    n_values = len(index)
+
+    layers = []
+    for layer in node_layers:
+        layer = sorted(layer, key=lambda node: index[node])
+        position = dict((node, i) for i, node in enumerate(layer))
+        weights = np.zeros((len(layer), n_values))
+        bias = np.zeros(len(layer))
+        response = np.zeros(len(layer))
+        names = {}
+        for conn_key in connections:
+            inode, onode = conn_key
+            if onode in position:
+                weights[position[onode], index[inode]] += genome.connections[conn_key].weight
+
+        for i, node in enumerate(layer):
+            ng = genome.nodes[node]
+            if ng.aggregation != 'sum':
+                raise RuntimeError("Unsupported aggregation function: %s" % ng.aggregation)
+            if ng.activation not in ACTIVATIONS:
+                raise RuntimeError("Unsupported activation function: %s" % ng.activation)
+            bias[i] = ng.bias
+            response[i] = ng.response
+            names.setdefault(ng.activation, []).append(i)
+
+        nodes = np.array([index[node] for node in layer], dtype=int)
+        if len(names) == 1:
+            # all nodes of the layer share the same activation function
+            activations = [(name, slice(None)) for name in names]
+        else:
+            activations = [(name, np.array(indices, dtype=int)) for name, indices in names.items()]
+        layers.append((weights, bias, response, nodes, activations))
+
+    return n_values, layers, removed
+
+def prune_layers(input_keys, output_keys, connections, node_layers):
+    """
+    The function to remove nodes which do not contribute to the outputs from the
+    layers of the feed-forward network. The node is evaluated only if all its inputs
+    are evaluated, thus the nodes not reachable from the inputs never evaluated and
+    the nodes feeding only such nodes are evaluated for nothing. The values of the
+    outputs are not affected by pruning.
+    Arguments:
+        input_keys:     The keys of input nodes.
+        output_keys:    The keys of output nodes.
+        connections:    The list of enabled connections keys (input node, output node).
+        node_layers:    The list of sets of nodes keys in layers as returned by feed_forward_layers.
+    Returns:
+        The tuple (node_layers, connections) with pruned layers and connections between
+        the remaining nodes.
+    """
+    evaluated = set(input_keys)
+    for layer in node_layers:
+        evaluated.update(layer)
+
+    # walk backward from the evaluated outputs through the connections
+    incoming = {}
+    for inode, onode in connections:
+        if inode in evaluated and onode in evaluated:
+            incoming.setdefault(onode, []).append(inode)
+    used = set(node for node in output_keys if node in evaluated)
+    pending = list(used)
+    while pending:
+        node = pending.pop()
+        for inode in incoming.get(node, []):
+            if inode not in used:
+                used.add(inode)
+                pending.append(inode)
+
+    node_layers = [set(node for node in layer if node in used) for layer in node_layers]
+    node_layers = [layer for layer in node_layers if len(layer) > 0]
+    connections = [conn_key for conn_key in connections if conn_key[1] in used]
+    return node_layers, connections
+
+def prune_genome(genome, config):
+    """
+    The function to prune the phenotype of genome down to the minimal network, i.e.,
+    the nodes reachable from the inputs and contributing to the outputs.
+    Arguments:
+        genome: The NEAT-Python genome.
+        config: The NEAT-Python configuration.
+    Returns:
+        The tuple (pruned, removed_nodes, removed_links) with the copy of genome holding 
+        only nodes and enabled connections of the minimal network, and the numbers of
+        removed nodes and enabled connections.
+    """
+    genome_config = config.genome_config
+    input_keys, output_keys = genome_config.input_keys, genome_config.output_keys
+
+    connections = [cg.key for cg in genome.connections.values() if cg.enabled]
+    node_layers = feed_forward_layers(input_keys, output_keys, connections)
+    node_layers, pruned_connections = prune_layers(input_keys, output_keys, connections, node_layers)
+
+    # the output nodes are kept even if they are never evaluated
+    nodes = set(output_keys)
+    for layer in node_layers:
+        nodes.update(layer)
+
+    pruned = copy.copy(genome)
+    pruned.nodes = dict((key, ng) for key, ng in genome.nodes.items() if key in nodes)
+    pruned.connections = dict((key, genome.connections[key]) for key in pruned_connections)
+    removed_nodes = len(genome.nodes) - len(pruned.nodes)
+    removed_links = len(connections) - len(pruned.connections)
+    return pruned, removed_nodes, removed_links
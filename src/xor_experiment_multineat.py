@@ -46,10 +46,29 @@ from concurrent.futures import ProcessPoolExecutor, as_completed
 
 import utils
 from experiment import evaluate_experiment
-
-def evaluate(genome):
+from experiment import PhaseTimer
+from experiment import GenomeListEvaluator
+from experiment import worker_settings
+from experiment import prune_multineat_network
+from experiment import FitnessCache, multineat_genome_hash
+
+# The number of worker processes to evaluate genomes of each generation
+eval_workers = 1
+# The number of genomes evaluated by worker process at once or None to split evenly
+eval_chunk_size = None
+# The maximal number of fitness scores cached for structurally identical genomes (0 - disabled)
+fitness_cache_size = 10000
+
+# The names of settings assigned from command line arguments to initialize worker processes with
+WORKER_SETTINGS = ('eval_workers', 'eval_chunk_size', 'fitness_cache_size')
+
+def evaluate(genome, timer=None):
     net = NEAT.NeuralNetwork()
     genome.BuildPhenotype(net)
+    net, removed_neurons, removed_links = prune_multineat_network(net)
+    if timer is not None:
+        timer.count('pruned_nodes', removed_neurons)
+        timer.count('pruned_links', removed_links)
 
     error = 0
 
@@ -85,6 +104,18 @@ def evaluate(genome):
 
     return (4 - error) ** 2
 
+def evaluate_batch(genome_list, display=False, timer=None):
+    """
+    The function to evaluate fitness scores of all genomes in the list.
+    Arguments:
+        genome_list: The list of genomes to be evaluated
+        display:     The flag to control if evaluation progress should be displayed
+        timer:       The PhaseTimer to count neurons and links removed by pruning into or None
+    Returns:
+        The list of fitness scores in order of genomes in the list
+    """
+    return EvaluateGenomeList_Serial(genome_list, lambda genome: evaluate(genome, timer), display=display)
+
 def build_parameters():
     params = NEAT.Parameters()
     params.PopulationSize = 100
@@ -140,37 +171,53 @@ def build_parameters():
 def get_fitness(genome):
     return genome.GetFitness()
 
-def run_experiment(params, trial_id, n_generations, out_dir=None, view_results=False, save_results=True):
+def run_experiment(params, trial_id, n_generations, out_dir=None, view_results=False, save_results=True, seed=None, 
+                    timer=None):
     g = NEAT.Genome(0, 3, 0, 1, False, NEAT.ActivationFunction.UNSIGNED_SIGMOID,
                     NEAT.ActivationFunction.UNSIGNED_SIGMOID, 0, params, 0)
     pop = NEAT.Population(g, params, True, 1.0, trial_id)
 
     # set random seed
-    seed = int(time.time())
+    if seed is None:
+        seed = int(time.time())
     pop.RNG.Seed(seed)
 
     generations = 0
     solved = False
     max_fitness = 0
     complexity = 0
-    for generation in range(n_generations):
-        genome_list = NEAT.GetGenomeList(pop)
-        fitness_list = EvaluateGenomeList_Serial(genome_list, evaluate, display=view_results)
-        NEAT.ZipFitness(genome_list, fitness_list)
-        generations = generation
-        best = max(genome_list, key=get_fitness)
-        best_fitness = best.GetFitness()
-        complexity = best.NumNeurons() + best.NumLinks()
-        solved = best_fitness > 15.5 # Changed to correspond limit used with other tested libraries
-        if solved:
-            max_fitness = best_fitness
-            print("Trial: %2d\tgeneration: %d\tfitness: %f\tcomplexity: %d\tseed: %d" % (trial_id, generations, max_fitness, complexity, seed))
-            break
-        # check if best fitness in this generation is better than current maximum
-        max_fitness = max(best_fitness, max_fitness)
-
-        # move to the next epoch
-        pop.Epoch()
+    cache = FitnessCache(multineat_genome_hash, max_size=fitness_cache_size, deterministic=True)
+    initializer, initargs = worker_settings(__name__, WORKER_SETTINGS)
+    if timer is None:
+        timer = PhaseTimer()
+    evaluator = GenomeListEvaluator(evaluate_batch, workers=eval_workers, chunk_size=eval_chunk_size, cache=cache,
+                                    initializer=initializer, initargs=initargs, timer=timer)
+    try:
+        for generation in range(n_generations):
+            timer.start_generation()
+            genome_list = NEAT.GetGenomeList(pop)
+            with timer.phase('evaluation'):
+                fitness_list = evaluator.evaluate(genome_list, view_results)
+                NEAT.ZipFitness(genome_list, fitness_list)
+            timer.count('evaluated_genomes', len(genome_list))
+            generations = generation
+            best = max(genome_list, key=get_fitness)
+            best_fitness = best.GetFitness()
+            complexity = best.NumNeurons() + best.NumLinks()
+            solved = best_fitness > 15.5 # Changed to correspond limit used with other tested libraries
+            if solved:
+                max_fitness = best_fitness
+                print("Trial: %2d\tgeneration: %d\tfitness: %f\tcomplexity: %d\tseed: %d" % (trial_id, generations, max_fitness, complexity, seed))
+                break
+            # check if best fitness in this generation is better than current maximum
+            max_fitness = max(best_fitness, max_fitness)
+
+            # move to the next epoch
+            with timer.phase('reproduction'):
+                pop.Epoch()
+    finally:
+        evaluator.close()
+    evaluator.print_statistics()
             
     if not solved:
         print("Trial: %2d\tFAILED\t\tfitness: %f\tcomplexity: %d\tseed: %d" % (trial_id, max_fitness, complexity, seed))
@@ -184,7 +231,26 @@ if __name__ == '__main__':
                         help='The number of generations for the evolutionary process.')
     parser.add_argument('-t', '--trials', type=int, default=10,
                         help="The number of experiment trials.")
+    parser.add_argument('-w', '--workers', type=int, default=1,
+                        help="The number of worker processes to run experiment trials in parallel.")
+    parser.add_argument('--eval_workers', type=int, default=1,
+                        help="The number of worker processes to evaluate genomes of each generation.")
+    parser.add_argument('--eval_chunk_size', type=int, default=None,
+                        help="The number of genomes evaluated by worker process at once (None - split evenly).")
+    parser.add_argument('--fitness_cache_size', type=int, default=10000,
+                        help="The maximal number of fitness scores cached for structurally identical genomes (0 - disabled).")
+    parser.add_argument('--seed', type=int, default=None,
+                        help="The master seed to derive random seeds of trials (None - current time).")
+    parser.add_argument('--cpu_time_score', action='store_true',
+                        help="Estimate efficiency score with CPU time per epoch rather than with wall-clock time.")
+    parser.add_argument('--trace_memory', action='store_true',
+                        help="Trace memory allocations of trials with tracemalloc to find peak memory usage (slow).")
+    parser.add_argument('--resume', action='store_true',
+                        help="Resume the interrupted experiment skipping trials with results stored in the output directory.")
     args = parser.parse_args()
+    eval_workers = args.eval_workers
+    eval_chunk_size = args.eval_chunk_size
+    fitness_cache_size = args.fitness_cache_size
 
     # The current working directory
     local_dir = os.path.dirname(__file__)
@@ -193,7 +259,11 @@ if __name__ == '__main__':
     out_dir = os.path.join(local_dir, '../out/xor/multineat')
 
     # Clean results of previous run if any or init the ouput directory
-    utils.clear_output(out_dir=out_dir)
+    if args.resume:
+        # keep results of trials finished before
+        os.makedirs(out_dir, exist_ok=True)
+    else:
+        utils.clear_output(out_dir=out_dir)
 
     # Prepare hyper-parameters
     params = build_parameters()
@@ -203,10 +273,19 @@ if __name__ == '__main__':
     print("  MultiNEAT Library")
     print("  XOR Experiment")
     print("**************************\n")
+    initializer, initargs = worker_settings(__name__, WORKER_SETTINGS)
     results = evaluate_experiment(args, 
                         eval_function=run_experiment, 
                         config=params, 
                         max_fitness=16.0, # The maximal fitness score in accordance with fitness function definition
-                        out_dir=out_dir)
+                        out_dir=out_dir, 
+                        experiment_name='xor',
+                        library='MultiNEAT',
+                        initializer=initializer,
+                        initargs=initargs)
                         
-    results.print_statistics()
\ No newline at end of file
+    results.print_statistics()
+
+    # Store results of trials along with phases durations and counts
+    results.write_json(os.path.join(out_dir, 'results.json'))
+    results.write_csv(os.path.join(out_dir, 'results.csv'))
@@ -18,52 +18,94 @@ import neat
 import utils.visualize as visualize
 import utils
 
+# The compiled phenotypes
+from utils.compiled_net import CompiledNetwork
+
 from experiment import evaluate_experiment
+from experiment import PhaseTimer, PhaseTimerReporter, OUTPUT_PHASE
+from experiment import GenomeListEvaluator
+from experiment import worker_settings
+from experiment import FitnessCache, neat_genome_hash
 
 # The XOR inputs and expected corresponding outputs for fitness evaluation
 xor_inputs  = [(0.0, 0.0), (0.0, 1.0), (1.0, 0.0), (1.0, 1.0)]
 xor_outputs = [   (0.0,),     (1.0,),     (1.0,),     (0.0,)]
 
+# The backend of genomes evaluator: 'serial', 'process', or 'thread'
+eval_backend = 'serial'
+# The number of workers to evaluate genomes of each generation
+eval_workers = 1
+# The number of genomes evaluated by worker at once or None to split evenly
+eval_chunk_size = None
+# The maximal number of fitness scores cached for structurally identical genomes (0 - disabled)
+fitness_cache_size = 10000
+
+# The names of settings assigned from command line arguments to initialize worker processes with
+WORKER_SETTINGS = ('eval_backend', 'eval_workers', 'eval_chunk_size', 'fitness_cache_size')
+
 def eval_fitness(net):
     """
     Evaluates fitness of the genome that was used to generate 
     provided net
     Arguments:
-        net: The feed-forward neural network generated from genome
+        net: The compiled feed-forward neural network generated from genome
     Returns:
         The fitness score - the higher score the means the better 
         fit organism. Maximal score: 16.0
     """
-    error_sum = 0.0
-    for xi, xo in zip(xor_inputs, xor_outputs):
-        output = net.activate(xi)
-        error_sum += abs(output[0] - xo[0])
+    # activate with all XOR inputs at once
+    outputs = net.activate_batch(xor_inputs)
+    error_sum = float(np.sum(np.abs(outputs - xor_outputs)))
     # Calculate amplified fitness
     fitness = (4 - error_sum) ** 2
     return fitness
 
-def eval_genomes(genomes, config):
+def evaluate_batch(genome_list, config, timer=None):
     """
-    The function to evaluate the fitness of each genome in 
-    the genomes list. 
+    The function to evaluate fitness scores of all genomes in the list.
     The provided configuration is used to create feed-forward 
     neural network from each genome and after that created
     the neural network evaluated in its ability to solve
-    XOR problem. As a result of this function execution, the
-    the fitness score of each genome updated to the newly
-    evaluated one.
+    XOR problem.
     Arguments:
-        genomes: The list of genomes from population in the 
-                current generation
-        config: The configuration settings with algorithm
-                hyper-parameters
+        genome_list:    The list of genomes to be evaluated
+        config:         The configuration settings with algorithm
+                        hyper-parameters
+        timer:          The PhaseTimer to count nodes and links removed by pruning into or None
+    Returns:
+        The list of fitness scores in order of genomes in the list
     """
-    for _, genome in genomes:
-        genome.fitness = 4.0
-        net = neat.nn.FeedForwardNetwork.create(genome, config)
-        genome.fitness = eval_fitness(net)
+    fitnesses = []
+    for genome in genome_list:
+        net = CompiledNetwork.create(genome, config)
+        fitnesses.append(eval_fitness(net))
+        if timer is not None:
+            timer.count('pruned_nodes', net.removed_nodes)
+            timer.count('pruned_links', net.removed_links)
+    return fitnesses
 
-def run_experiment(config_file, trial_id, n_generations, out_dir, view_results=False, save_results=True):
+def eval_genomes(genomes, config, evaluator=None):
+    """
+    The function to evaluate the fitness of each genome in 
+    the genomes list.
+    Arguments:
+        genomes:    The list of genomes from population in the 
+                    current generation
+        config:     The configuration settings with algorithm
+                    hyper-parameters
+        evaluator:  The GenomeListEvaluator to evaluate genomes with or None
+                    to evaluate them in the current thread.
+    """
+    genome_list = [genome for _, genome in genomes]
+    if evaluator is None:
+        fitnesses = evaluate_batch(genome_list, config)
+    else:
+        fitnesses = evaluator.evaluate(genome_list, config)
+    for (_, genome), fitness in zip(genomes, fitnesses):
+        genome.fitness = float(fitness)
+
+def run_experiment(config_file, trial_id, n_generations, out_dir, view_results=False, save_results=True, seed=None, 
+                    timer=None):
     """
     The function to run XOR experiment against hyper-parameters 
     defined in the provided configuration file.
@@ -77,9 +119,12 @@ def run_experiment(config_file, trial_id, n_generations, out_dir, view_results=F
         out_dir:        the directory to store experiment outputs
         view_results:   the flag to control whether to view result visualizations
         save_results:   the flag to control whether to save resulting stats into files
+        seed:           the random seed of the trial or None to use current time
+        timer:          the PhaseTimer to report phases durations and counts into or None.
     """
     # set random seed
-    seed = int(time.time())
+    if seed is None:
+        seed = int(time.time())
     random.seed(seed)
 
     # Load configuration.
@@ -95,8 +140,37 @@ def run_experiment(config_file, trial_id, n_generations, out_dir, view_results=F
     stats = neat.StatisticsReporter()
     p.add_reporter(stats)
 
+    # Add the reporter of generations and reproduction phase durations
+    if timer is None:
+        timer = PhaseTimer()
+    p.add_reporter(PhaseTimerReporter(timer))
+
+    cache = FitnessCache(neat_genome_hash, max_size=fitness_cache_size, deterministic=True)
+
+    # Create the evaluator of genomes with workers reused by all generations
+    initializer, initargs = worker_settings(__name__, WORKER_SETTINGS)
+    evaluator = GenomeListEvaluator(evaluate_batch, 
+                                    workers=eval_workers, 
+                                    chunk_size=eval_chunk_size, 
+                                    backend=eval_backend,
+                                    initializer=initializer,
+                                    initargs=initargs,
+                                    cache=cache,
+                                    timer=timer)
+
+    # The fitness function reporting the evaluation phase
+    def fitness_function(genomes, config):
+        with timer.phase('evaluation'):
+            eval_genomes(genomes, config, evaluator=evaluator)
+        timer.count('evaluated_genomes', len(genomes))
+
     # Run for up to n_generations generations.
-    best_genome = p.run(eval_genomes, n_generations)
+    try:
+        best_genome = p.run(fitness_function, n=n_generations)
+    finally:
+        evaluator.close()
+    if evaluator.backend != 'serial' or cache.enabled:
+        evaluator.print_statistics()
     
     # Check if the best genome is an adequate XOR solver
     net = neat.nn.FeedForwardNetwork.create(best_genome, config)
@@ -113,10 +187,11 @@ def run_experiment(config_file, trial_id, n_generations, out_dir, view_results=F
 
     # Visualize the experiment results
     if save_results:
-        node_names = {-1:'A', -2: 'B', 0:'A XOR B'}
-        visualize.draw_net(config, best_genome, view=view_results, node_names=node_names, directory=out_dir)
-        visualize.plot_stats(stats, ylog=False, view=view_results, filename=os.path.join(out_dir, 'avg_fitness.svg'))
-        visualize.plot_species(stats, view=view_results, filename=os.path.join(out_dir, 'speciation.svg'))
+        with timer.phase(OUTPUT_PHASE):
+            node_names = {-1:'A', -2: 'B', 0:'A XOR B'}
+            visualize.draw_net(config, best_genome, view=view_results, node_names=node_names, directory=out_dir)
+            visualize.plot_stats(stats, ylog=False, view=view_results, filename=os.path.join(out_dir, 'avg_fitness.svg'))
+            visualize.plot_species(stats, view=view_results, filename=os.path.join(out_dir, 'speciation.svg'))
 
     return solution_found, p.generation, complexity, best_genome_fitness
 
@@ -128,7 +203,29 @@ if __name__ == '__main__':
                         help='The number of generations for the evolutionary process.')
     parser.add_argument('-t', '--trials', type=int, default=10,
                         help="The number of experiment trials.")
+    parser.add_argument('-w', '--workers', type=int, default=1,
+                        help="The number of worker processes to run experiment trials in parallel.")
+    parser.add_argument('--eval_backend', default='serial', choices=['serial', 'process', 'thread'],
+                        help="The backend of workers to evaluate genomes of each generation.")
+    parser.add_argument('--eval_workers', type=int, default=1,
+                        help="The number of workers to evaluate genomes of each generation.")
+    parser.add_argument('--eval_chunk_size', type=int, default=None,
+                        help="The number of genomes evaluated by worker at once (None - split evenly).")
+    parser.add_argument('--fitness_cache_size', type=int, default=10000,
+                        help="The maximal number of fitness scores cached for structurally identical genomes (0 - disabled).")
+    parser.add_argument('--seed', type=int, default=None,
+                        help="The master seed to derive random seeds of trials (None - current time).")
+    parser.add_argument('--cpu_time_score', action='store_true',
+                        help="Estimate efficiency score with CPU time per epoch rather than with wall-clock time.")
+    parser.add_argument('--trace_memory', action='store_true',
+                        help="Trace memory allocations of trials with tracemalloc to find peak memory usage (slow).")
+    parser.add_argument('--resume', action='store_true',
+                        help="Resume the interrupted experiment skipping trials with results stored in the output directory.")
     args = parser.parse_args()
+    eval_backend = args.eval_backend
+    eval_workers = args.eval_workers
+    eval_chunk_size = args.eval_chunk_size
+    fitness_cache_size = args.fitness_cache_size
 
     # The current working directory
     local_dir = os.path.dirname(__file__)
@@ -142,18 +239,31 @@ if __name__ == '__main__':
     out_dir = os.path.join(local_dir, '../out/xor/neat')
 
     # Clean results of previous run if any or init the ouput directory
-    utils.clear_output(out_dir=out_dir)
+    if args.resume:
+        # keep results of trials finished before
+        os.makedirs(out_dir, exist_ok=True)
+    else:
+        utils.clear_output(out_dir=out_dir)
 
     # Run the experiment for a number of trials
     print("\n**************************")
     print("  NEAT-Python Library")
     print("  XOR Experiment")
     print("**************************\n")
+    initializer, initargs = worker_settings(__name__, WORKER_SETTINGS)
     results = evaluate_experiment(args, 
                         eval_function=run_experiment, 
                         config=config_path, 
                         max_fitness=16.0, # The maximal fitness score in accordance with fitness function definition
                         out_dir=out_dir, 
-                        save_results=False)
+                        save_results=False, 
+                        experiment_name='xor',
+                        library='NEAT-Python',
+                        initializer=initializer,
+                        initargs=initargs)
     
-    results.print_statistics()
\ No newline at end of file
+    results.print_statistics()
+
+    # Store results of trials along with phases durations and counts
+    results.write_json(os.path.join(out_dir, 'results.json'))
+    results.write_csv(os.path.join(out_dir, 'results.csv'))